@@ -46,10 +46,12 @@
 
 # Perform Qa interactively
 
-import logging
 import argparse
+import logging
+import sys
 from woudc_qa import \
-    qa,\
+    qa_file,\
+    QaBudget,\
     WOUDCQaExecutionError,\
     WOUDCQaNotImplementedError,\
     WOUDCQaValidationError
@@ -59,17 +61,281 @@ LOGGER = logging.getLogger(__name__)
 PARSER = \
     argparse.ArgumentParser(description='Execute Qa.')
 
-PARSER.add_argument(
+SUBPARSERS = PARSER.add_subparsers(dest='command', title='commands')
+
+QA_PARSER = SUBPARSERS.add_parser(
+    'qa',
+    help='Quality assess an extended CSV file.')
+
+QA_PARSER.add_argument(
     '--file',
     required=True,
-    help='Path to extended CSV file to be quality assessed.')
+    help='Path to extended CSV file to be quality assessed (may be gzip/bzip2 '
+         'compressed, or an archive member as archive.tar.gz!member.csv).')
+
+QA_PARSER.add_argument(
+    '--processes',
+    type=int,
+    default=0,
+    help='Worker processes evaluating profile checks of large files; '
+         '0 checks in-process (default: 0).')
+
+SERVE_PARSER = SUBPARSERS.add_parser(
+    'serve',
+    help='Run Qa as a long-running HTTP service.')
+
+SERVE_PARSER.add_argument(
+    '--host',
+    default='localhost',
+    help='Host to bind to (default: localhost).')
+
+SERVE_PARSER.add_argument(
+    '--port',
+    type=int,
+    default=8000,
+    help='Port to listen on (default: 8000).')
+
+SERVE_PARSER.add_argument(
+    '--rules',
+    help='Path to Qa rule definitions (default: packaged rules).')
+
+SERVE_PARSER.add_argument(
+    '--workers',
+    type=int,
+    help='Number of Qa worker processes (default: number of CPUs).')
+
+SERVE_PARSER.add_argument(
+    '--queue-size',
+    type=int,
+    help='Number of requests allowed to wait for a worker before '
+         'new requests are rejected (default: 2 x workers).')
+
+SERVE_PARSER.add_argument(
+    '--timeout',
+    type=int,
+    default=60,
+    help='Seconds to wait for a Qa result (default: 60).')
+
+SERVE_PARSER.add_argument(
+    '--reload-interval',
+    type=int,
+    default=5,
+    help='Seconds between checks of the Qa rule definitions for changes; '
+         '0 disables hot reload (default: 5).')
+
+SERVE_PARSER.add_argument(
+    '--verbosity',
+    choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'],
+    default='WARNING',
+    help='Logging verbosity (default: WARNING).')
+
+BATCH_PARSER = SUBPARSERS.add_parser(
+    'batch',
+    help='Quality assess many extended CSV files.')
+
+BATCH_PARSER.add_argument(
+    'paths',
+    nargs='+',
+    help='Extended CSV files, directories (searched recursively) and/or '
+         'zip/tar archives.')
+
+BATCH_PARSER.add_argument(
+    '--rules',
+    help='Path to Qa rule definitions (default: packaged rules).')
+
+BATCH_PARSER.add_argument(
+    '--db',
+    help='Path to SQLite database to store results in.')
+
+BATCH_PARSER.add_argument(
+    '--reload-interval',
+    type=int,
+    default=0,
+    help='Seconds between checks of the Qa rule definitions for changes; '
+         '0 disables hot reload (default: 0).')
+
+BATCH_PARSER.add_argument(
+    '--workers',
+    type=int,
+    default=0,
+    help='Worker processes; 0 checks files in-process (default: 0).')
+
+BATCH_PARSER.add_argument(
+    '--history',
+    help='Path to JSON file of per-dataset throughput, used to schedule '
+         'worker processes and updated after each run.')
+
+BATCH_PARSER.add_argument(
+    '--journal',
+    help='Path to progress journal of completed files (appended to).')
+
+BATCH_PARSER.add_argument(
+    '--resume',
+    action='store_true',
+    help='Skip files the journal holds as completed with the same content '
+         'and Qa rule definitions.')
+
+BATCH_PARSER.add_argument(
+    '--shard',
+    help='Only check the files of shard i of N (e.g. 2/4), assigned by a '
+         'stable hash of the file name; nodes sharing a filesystem each '
+         'run one shard into their own --db.')
+
+BATCH_PARSER.add_argument(
+    '--read-ahead',
+    type=int,
+    default=8,
+    help='Files read ahead of checking, in threads; 0 reads each file '
+         'when it is checked (default: 8).')
+
+BATCH_PARSER.add_argument(
+    '--timeseries',
+    help='Path to JSON store of recent daily values by station, which '
+         'time series checks continue across files; updated after each '
+         'run (requires --workers 0).')
+
+BATCH_PARSER.add_argument(
+    '--stats',
+    action='store_true',
+    help='Report per-stage (read, parse, check) busy and stall time and '
+         'queue depth after the run.')
+
+MERGE_PARSER = SUBPARSERS.add_parser(
+    'merge',
+    help='Merge the SQLite results of shards into one database and '
+         'report totals.')
+
+MERGE_PARSER.add_argument(
+    '--db',
+    required=True,
+    help='Path to SQLite database to merge into.')
+
+MERGE_PARSER.add_argument(
+    'shards',
+    nargs='+',
+    help='SQLite databases of shard results.')
 
-ARGS = PARSER.parse_args()
+for budget_parser in [SERVE_PARSER, BATCH_PARSER]:
+    budget_parser.add_argument(
+        '--time-budget',
+        type=float,
+        help='Seconds allowed per file; files over budget are stopped and '
+             'reported as exceeded with their results so far, and their '
+             'worker recycled (default: unlimited).')
 
-if ARGS.file is not None:
-    file_str = open(ARGS.file).read()
+    budget_parser.add_argument(
+        '--memory-budget',
+        type=float,
+        help='Growth of memory allowed per file, in megabytes '
+             '(default: unlimited).')
+
+QUERY_PARSER = SUBPARSERS.add_parser(
+    'query',
+    help='Query Qa results stored in a SQLite database.')
+
+QUERY_PARSER.add_argument(
+    '--db',
+    required=True,
+    help='Path to SQLite database of results.')
+
+QUERY_PARSER.add_argument(
+    '--dataset',
+    help='Dataset (e.g. ozonesonde).')
+
+QUERY_PARSER.add_argument(
+    '--station',
+    help='Station id or name (e.g. 043 or Lerwick).')
+
+QUERY_PARSER.add_argument(
+    '--instrument',
+    help='Instrument name (e.g. ECC).')
+
+QUERY_PARSER.add_argument(
+    '--date-from',
+    help='Earliest observation date (YYYY-MM-DD).')
+
+QUERY_PARSER.add_argument(
+    '--date-to',
+    help='Latest observation date (YYYY-MM-DD).')
+
+QUERY_PARSER.add_argument(
+    '--failed-test',
+    help='Only files failing this test id.')
+
+QUERY_PARSER.add_argument(
+    '--status',
+    choices=['passed', 'failed', 'exceeded', 'error'],
+    help='File status.')
+
+COMPILE_PARSER = SUBPARSERS.add_parser(
+    'compile-rules',
+    help='Validate Qa rule definitions and compile them into a rule pack.')
+
+COMPILE_PARSER.add_argument(
+    '--rules',
+    help='Path to Qa rule definitions (default: packaged rules).')
+
+COMPILE_PARSER.add_argument(
+    '--output',
+    help='Path to rule pack (default: rule definitions path + .pack).')
+
+CLIMATOLOGY_PARSER = SUBPARSERS.add_parser(
+    'build-climatology',
+    help='Build a climatology grid (range function RC_9) from historical '
+         'files.')
+
+CLIMATOLOGY_PARSER.add_argument(
+    'paths', nargs='+',
+    help='Files, directories and/or archives of historical files.')
+
+CLIMATOLOGY_PARSER.add_argument(
+    '--output', required=True,
+    help='Path to climatology grid.')
+
+CLIMATOLOGY_PARSER.add_argument(
+    '--table', default='PROFILE',
+    help='Profile table (default: PROFILE).')
+
+CLIMATOLOGY_PARSER.add_argument(
+    '--element', required=True,
+    help='Profile column, e.g. derived:VMR.')
+
+CLIMATOLOGY_PARSER.add_argument(
+    '--level', default='Pressure',
+    help='Column of the levels (default: Pressure, interpolated in '
+         'log(pressure)).')
+
+CLIMATOLOGY_PARSER.add_argument(
+    '--levels', required=True,
+    help='Comma-separated grid levels, e.g. 1000,500,200,100,50,20,10.')
+
+CLIMATOLOGY_PARSER.add_argument(
+    '--latitude-step', type=float, default=10,
+    help='Latitude band width in degrees (default: 10).')
+
+CLIMATOLOGY_PARSER.add_argument(
+    '--min-count', type=int, default=10,
+    help='Fewest values of a grid cell with statistics (default: 10).')
+
+ARGV = sys.argv[1:]
+# backwards compatibility: woudc-qa.py --file <file>
+if ARGV and ARGV[0].startswith('--file'):
+    ARGV.insert(0, 'qa')
+
+ARGS = PARSER.parse_args(ARGV)
+
+BUDGET = None
+if getattr(ARGS, 'time_budget', None) or getattr(ARGS, 'memory_budget', None):
+    BUDGET = QaBudget(ARGS.time_budget, ARGS.memory_budget)
+
+if ARGS.command == 'qa':
+    pool = None
+    if ARGS.processes > 0:
+        from woudc_qa import QualityChecker
+        from woudc_qa.columns import ColumnPool
+        pool = ColumnPool(QualityChecker(), ARGS.processes)
     try:
-        qa(file_str, summary=True)
+        qa_file(ARGS.file, summary=True, pool=pool)
     except WOUDCQaNotImplementedError as err:
         print err
     except WOUDCQaExecutionError as err:
@@ -79,3 +345,111 @@ if ARGS.file is not None:
         print explanation
     except Exception as err:
         print err
+    finally:
+        if pool is not None:
+            pool.close()
+elif ARGS.command == 'serve':
+    from woudc_qa.service import serve
+    logging.basicConfig(level=getattr(logging, ARGS.verbosity))
+    serve(ARGS.host, ARGS.port, ARGS.rules, ARGS.workers, ARGS.queue_size,
+          ARGS.timeout, ARGS.reload_interval, BUDGET)
+elif ARGS.command == 'batch':
+    from woudc_qa.batch import parse_shard, run_batch
+    from woudc_qa.journal import ProgressJournal
+    from woudc_qa.pipeline import PipelineStats
+    from woudc_qa.sink import SQLiteResultSink
+    from woudc_qa.timeseries import TimeSeriesStore
+    if ARGS.resume and ARGS.journal is None:
+        BATCH_PARSER.error('--resume requires --journal')
+    if ARGS.timeseries is not None and ARGS.workers:
+        BATCH_PARSER.error('--timeseries requires --workers 0')
+    shard = None
+    if ARGS.shard is not None:
+        try:
+            shard = parse_shard(ARGS.shard)
+        except ValueError as err:
+            BATCH_PARSER.error(str(err))
+    sink = None
+    journal = None
+    if ARGS.db is not None:
+        sink = SQLiteResultSink(ARGS.db)
+    if ARGS.journal is not None:
+        journal = ProgressJournal(ARGS.journal, ARGS.resume)
+    stats = None
+    if ARGS.stats:
+        stats = PipelineStats()
+    timeseries = None
+    if ARGS.timeseries is not None:
+        timeseries = TimeSeriesStore(ARGS.timeseries)
+    try:
+        for file_path, status, qa_result, message in \
+                run_batch(ARGS.paths, ARGS.rules, sink, ARGS.reload_interval,
+                          ARGS.workers, ARGS.history, journal, shard,
+                          BUDGET, ARGS.read_ahead, stats, timeseries):
+            if message is not None:
+                print '%s: %s (%s)' % (file_path, status, message)
+            else:
+                print '%s: %s' % (file_path, status)
+    finally:
+        if sink is not None:
+            sink.close()
+        if journal is not None:
+            journal.close()
+    if stats is not None:
+        print 'stage,files,busy_seconds,stall_seconds,depth_mean,depth_max'
+        for stage in stats.report():
+            print '%s,%s,%.3f,%.3f,%.1f,%s' % (
+                stage['stage'], stage['files'], stage['busy'],
+                stage['stall'], stage['depth_mean'], stage['depth_max'])
+        print 'Bound: %s' % stats.bound
+elif ARGS.command == 'compile-rules':
+    from woudc_qa import compile_rules
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    try:
+        print 'Compiled %s' % compile_rules(ARGS.rules, ARGS.output)
+    except WOUDCQaValidationError as err:
+        print '%s\n%s' % (err.message, '\n'.join(err.errors))
+        sys.exit(1)
+elif ARGS.command == 'build-climatology':
+    from woudc_qa.climatology import build_climatology
+    try:
+        levels = [float(level) for level in ARGS.levels.split(',')]
+    except ValueError as err:
+        CLIMATOLOGY_PARSER.error('invalid --levels: %s' % err)
+    files = build_climatology(ARGS.paths, ARGS.output, ARGS.table,
+                              ARGS.element, ARGS.level, levels,
+                              ARGS.latitude_step, ARGS.min_count)
+    print 'Built %s from %s files' % (ARGS.output, files)
+elif ARGS.command == 'merge':
+    from woudc_qa.sink import merge_results
+    runs, totals, warnings = merge_results(ARGS.db, ARGS.shards)
+    for run in runs:
+        print 'Shard %s/%s: %s files on %s, finished %s (rule set %s)' % (
+            run['shard'], run['shard_count'], run['files'], run['host'],
+            run['finished'], (run['rule_set'] or '')[:12])
+    print 'dataset,status,files,failed_rows'
+    statuses = {}
+    for total in totals:
+        print '%s,%s,%s,%s' % (total['dataset'], total['status'],
+                               total['files'], total['failed_rows'])
+        statuses[total['status']] = \
+            statuses.get(total['status'], 0) + total['files']
+    print 'Total: %s files (%s)' % (sum(statuses.values()), ', '.join(
+        '%s %s' % (count, status)
+        for status, count in sorted(statuses.items())))
+    for warning in warnings:
+        print 'Warning: %s' % warning
+elif ARGS.command == 'query':
+    from woudc_qa.sink import SQLiteResultSink
+    # station names are not all ASCII: text is UTF-8
+    station = ARGS.station
+    if station is not None:
+        station = station.decode('utf-8')
+    with SQLiteResultSink(ARGS.db) as sink:
+        results = sink.query(ARGS.dataset, station, ARGS.instrument,
+                             ARGS.date_from, ARGS.date_to, ARGS.failed_test,
+                             ARGS.status)
+    for result in results:
+        print ','.join([unicode(result[key]).encode('utf-8') for key in
+                        ['file_path', 'dataset', 'station', 'station_name',
+                         'instrument', 'date', 'status', 'failed_rows']])
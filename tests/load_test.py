@@ -0,0 +1,128 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+# Replay sample files against a running Qa service and report latency
+#
+# usage: python tests/load_test.py [--url URL] [--requests N]
+#                                  [--concurrency C]
+
+import argparse
+import glob
+import os
+import threading
+import time
+import urllib2
+
+__dirpath = os.path.dirname(os.path.realpath(__file__))
+
+SAMPLES = sorted(glob.glob(os.path.join(__dirpath, 'data', '*', '*.csv')))
+
+
+def percentile(values, pct):
+    """helper function: nearest-rank percentile of sorted values"""
+
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def replay(url, payloads, count, latencies, statuses, lock):
+    """helper function: post payloads round robin, recording latencies"""
+
+    for i in range(count):
+        payload = payloads[i % len(payloads)]
+        start = time.time()
+        try:
+            status = urllib2.urlopen(url, payload).getcode()
+        except urllib2.HTTPError as err:
+            status = err.code
+        except urllib2.URLError as err:
+            status = str(err.reason)
+        elapsed = time.time() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+
+def main():
+    """run load test"""
+
+    parser = argparse.ArgumentParser(
+        description='Replay sample files against a Qa service.')
+    parser.add_argument('--url', default='http://localhost:8000/qa',
+                        help='Qa service URL')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests per client')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of concurrent clients')
+    args = parser.parse_args()
+
+    payloads = [open(sample).read() for sample in SAMPLES]
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    clients = [threading.Thread(target=replay,
+                                args=(args.url, payloads, args.requests,
+                                      latencies, statuses, lock))
+               for i in range(args.concurrency)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print 'requests: %s in %.2fs (%.1f req/s)' % \
+        (len(latencies), elapsed, len(latencies) / elapsed)
+    print 'statuses: %s' % statuses
+    print 'p50: %.1f ms' % (percentile(latencies, 50) * 1000)
+    print 'p99: %.1f ms' % (percentile(latencies, 99) * 1000)
+
+
+if __name__ == '__main__':
+    main()
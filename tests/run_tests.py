@@ -43,16 +43,74 @@
 #
 # =================================================================
 
+import gzip
+import json
+import multiprocessing
 import os
+import pickle
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import zipfile
+import numpy
+from contextlib import closing
 import woudc_extcsv
-from woudc_qa import qa, WOUDCQaNotImplementedError
+from woudc_qa import qa, qa_extcsv, qa_file, load, loads, compile_rules,\
+    OUTCOMES, QA_FUNCTIONS, QaBudget, QualityChecker,\
+    WOUDCQaBudgetExceeded, WOUDCQaNotImplementedError, WOUDCQaValidationError
+from woudc_qa import archive, arrays
+from woudc_qa.arrays import evaluate as evaluate_arrays, range_codes,\
+    rolling_mean, rolling_median
+from woudc_qa.climatology import build_climatology, open_climatology
+from woudc_qa.batch import find_files, plan, run_batch, shard_of,\
+    ThroughputModel, PREFETCH, _work
+from woudc_qa.columns import ColumnPool
+from woudc_qa.dataset_handlers import OzoneSondeHandler, SpectralHandler, \
+    erythemal_weights
+from woudc_qa.journal import file_hash, ProgressJournal
+from woudc_qa.mapped import load_mapped, MappedTable
+from woudc_qa.reference import open_reference_profile
+from woudc_qa.pipeline import PipelineStats, ReadAhead
+from woudc_qa.service import QaHTTPServer, QaService,\
+    WOUDCQaServiceBusyError
+from woudc_qa.sink import merge_results, SQLiteResultSink
+from woudc_qa.timeseries import TimeSeriesStore
+from woudc_qa.util import find_violations, get_extcsv_value,\
+    get_table_instances
+from woudc_qa.watcher import RuleSetWatcher
 
 __dirpath = os.path.dirname(os.path.realpath(__file__))
 
 # test qa definitions
 WOUDC_QA_RULES = os.path.join(__dirpath, 'woudc-qa-rules-test1.csv')
 
+# test data
+DATA_DIR = os.path.join(__dirpath, 'data')
+
+# command line interface
+WOUDC_QA_SCRIPT = os.path.join(__dirpath, os.pardir, 'bin', 'woudc-qa.py')
+
+
+class CheckCountBudget(QaBudget):
+    """budget spent after a number of budget checks"""
+
+    def __init__(self, checks):
+        QaBudget.__init__(self)
+        self.checks = checks
+
+    def check(self):
+        self.checks -= 1
+        if self.checks < 0:
+            raise WOUDCQaBudgetExceeded('Check budget exceeded', 'time')
+
 
 def msg(test_id, test_description):
     """helper function to print out test id and desc"""
@@ -60,6 +118,24 @@ def msg(test_id, test_description):
     return '%s: %s' % (test_id, test_description)
 
 
+def summary_test_ids(file_s, checker=None):
+    """
+    helper function: test ids of the failed checks a file is reported
+    with, by qa summaries and by QaResult.violations
+    """
+
+    if checker is None:
+        checker = QualityChecker()
+    try:
+        qa(file_s, summary=True, checker=checker)
+        summary = set()
+    except WOUDCQaValidationError as err:
+        summary = set(error.split('-')[2] for error in err.errors)
+    violations = set(violation.test_id for violation in
+                     qa_extcsv(loads(file_s), checker=checker).violations())
+    return summary, violations
+
+
 def read_file(filename, dataset=None):
     """helper function to open test file and return content as string"""
 
@@ -235,11 +311,202 @@ class QaTest(unittest.TestCase):
         file_s = \
             read_file(
                 'data/lidar/19930208.dial.lotard.001.crestech.csv'
-            )
+            ).replace('WOUDC,Lidar', 'WOUDC,UmkehrN14')
 
         with self.assertRaises(WOUDCQaNotImplementedError):
             qa(file_s, rule_path=WOUDC_QA_RULES)
 
+    def test_lidar(self):
+        """test lidar profile and summary checks"""
+
+        file_s = read_file('data/lidar/19930208.dial.lotard.001.crestech.csv')
+        results = qa(file_s)['file1']
+        failed = dict((test_id, sorted(row for row, result in rows.items()
+                                       if row != 'test_def' and
+                                       result['result'] == '0'))
+                      for test_id, rows in results.items())
+        # negative densities at the top of the profile
+        self.assertEqual([58, 59], failed['40'])
+        # relative standard error over 50%
+        self.assertEqual(11, len(failed['41']))
+        for test_id in ['38', '42', '43', '44']:
+            self.assertEqual([], failed[test_id], test_id)
+
+        # summary and profile disagree, altitudes out of order
+        file_s = file_s.replace('61,13690,42470', '60,13690,42000')
+        file_s = file_s.replace('15130.,', '14000.,')
+        results = qa(file_s)['file1']
+        for test_id in ['42', '44']:
+            self.assertEqual('0', results[test_id][1]['result'], test_id)
+        self.assertEqual('100', results['43'][1]['result'])
+        self.assertEqual(['100', '0', '100'], [results['38'][row]['result']
+                                               for row in [2, 3, 4]])
+        for test_ids in summary_test_ids(file_s):
+            self.assertTrue(set(['38', '40', '41', '42', '44']) <= test_ids)
+        file_s = file_s.replace('60,13690,42000', '61,15690,42470')
+        for test_ids in summary_test_ids(file_s):
+            self.assertIn('43', test_ids)
+
+    def test_summary_messages(self):
+        """test failures of the functions with messages are summarized"""
+
+        # functions summaries never described are left out, as before
+        unsummarized = ['PR_1', 'TS_0', 'TS_2']
+        for category, functions in QA_FUNCTIONS.items():
+            for function in functions:
+                test_def = {
+                    'test_category': category, 'function': function,
+                    'table': 'PROFILE', 'table_index': 1,
+                    'element': 'O3PartialPressure',
+                    'function_parameter_a': '1',
+                    'function_parameter_b': '2',
+                    'function_parameter_c': 'GPHeight'
+                }
+                violations = find_violations('1', test_def,
+                                             [(1, '100'), (2, '0')])
+                if function in unsummarized:
+                    self.assertEqual([], violations, function)
+                    continue
+                self.assertEqual(1, len(violations), function)
+                self.assertTrue(violations[0].message.startswith(
+                    'WOUDC data quality assessment failed. Due to'))
+
+        file_s = read_file('data/ozonesonde/20070505.ecc.2z.6674.uah.csv')
+        with self.assertRaises(WOUDCQaValidationError) as cm:
+            qa(file_s, summary=True)
+        self.assertEqual(['2'], [error.split('-')[2]
+                                 for error in cm.exception.errors])
+
+    def test_integrated_ozone(self):
+        """test ozone column derived from the profile"""
+
+        file_s = read_file('data/ozonesonde/20070505.ecc.2z.6674.uah.csv')
+        extcsv = OzoneSondeHandler(loads(file_s)).extcsv
+        self.assertAlmostEqual(282.5, float(extcsv.sections['FLIGHT_SUMMARY']
+                                            ['derived:IntegratedO3']), 0)
+        results = qa(file_s)['file1']
+        for test_id in ['45', '46']:
+            self.assertEqual('100', results[test_id][1]['result'], test_id)
+
+        # reported column off by more than the tolerance
+        file_s = file_s.replace('282.5,1,320.4', '262.5,1,320.4')
+        results = qa(file_s)['file1']
+        self.assertEqual('0', results['45'][1]['result'])
+        self.assertEqual('100', results['46'][1]['result'])
+        for test_ids in summary_test_ids(file_s):
+            self.assertIn('45', test_ids)
+
+    def test_hydrostatic_height(self):
+        """test GPHeight against the pressure and temperature profile"""
+
+        file_s = read_file('data/ozonesonde/20070505.ecc.2z.6674.uah.csv')
+        extcsv = OzoneSondeHandler(loads(file_s)).extcsv
+        heights = get_extcsv_value(extcsv, 'PROFILE',
+                                   'derived:HydrostaticGPHeight',
+                                   payload=True)
+        self.assertEqual('197.0', heights[0])
+        self.assertAlmostEqual(10500, float(heights[104]), -2)
+        results = qa(file_s)['file1']
+        self.assertEqual([], [row for row, result in results['47'].items()
+                              if row != 'test_def' and
+                              result['result'] == '0'])
+
+        # pressure off by 30 hPa at one level
+        file_s = file_s.replace('258.80,3.110,-48.80', '228.80,3.110,-48.80')
+        results = qa(file_s)['file1']
+        self.assertEqual([105], [row for row, result in results['47'].items()
+                                 if row != 'test_def' and
+                                 result['result'] == '0'])
+        for test_ids in summary_test_ids(file_s):
+            self.assertIn('47', test_ids)
+
+    def test_statistical_check(self):
+        """test rolling window outlier check"""
+
+        file_s = read_file('data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv')
+        # a spike within the fixed bounds of the range checks
+        file_s = file_s.replace('1015.4,4.13,', '1015.4,9.13,')
+        results = qa(file_s)['file1']
+        self.assertEqual([9], [row for row, result in results['48'].items()
+                               if row != 'test_def' and
+                               result['result'] == '0'])
+        for test_ids in summary_test_ids(file_s):
+            self.assertIn('48', test_ids)
+
+        values = numpy.array([1, 5, 2, 8, 3, 3, 40, 4, 6, 5], dtype=float)
+        medians, deviations = rolling_median(values, 5)
+        means, deviations2 = rolling_mean(values, 5)
+        for start in range(6):
+            window = values[start:start + 5]
+            median = numpy.median(window)
+            self.assertEqual(median, medians[start])
+            self.assertEqual(numpy.median(abs(window - median)),
+                             deviations[start])
+            self.assertAlmostEqual(window.mean(), means[start])
+            self.assertAlmostEqual(window.std(), deviations2[start])
+
+        # chunks of WINDOW_CHUNK values, fewer windows the wider they are
+        sizes = [3, 5, 10]
+        expected = [rolling_median(values, size) for size in sizes]
+        chunk = arrays.WINDOW_CHUNK
+        arrays.WINDOW_CHUNK = 12
+        try:
+            for size, (medians, deviations) in zip(sizes, expected):
+                chunked = rolling_median(values, size)
+                self.assertEqual(medians.tolist(), chunked[0].tolist())
+                self.assertEqual(deviations.tolist(), chunked[1].tolist())
+        finally:
+            arrays.WINDOW_CHUNK = chunk
+
+    def test_shape_checks(self):
+        """test monotonicity and gradient step checks"""
+
+        file_s = read_file('data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv')
+        # pressure and height going back, an ozone jump
+        file_s = file_s.replace('1019.8,4.1,6.1,7.4,256,,8,114,',
+                                '1022.8,4.1,6.1,7.4,256,,8,101,')
+        file_s = file_s.replace('1008.6,4.22,', '1008.6,6.22,')
+        results = qa(file_s)['file1']
+        failed = dict((test_id, sorted(row for row, result in
+                                       results[test_id].items()
+                                       if row != 'test_def' and
+                                       result['result'] == '0'))
+                      for test_id in ['50', '51', '52'])
+        self.assertEqual({'50': [4], '51': [4], '52': [13, 14]}, failed)
+        for test_ids in summary_test_ids(file_s):
+            self.assertTrue(set(['50', '51', '52']) <= test_ids)
+
+        # TS_0 compares consecutive values
+        checker = QualityChecker(WOUDC_QA_RULES)
+        self.assertTrue(checker._function_ts_0(1, 3, 2))
+        self.assertFalse(checker._function_ts_0(1, 1, 2))
+
+    def test_array_outcomes(self):
+        """test vectorized profile checks match row by row checks"""
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+        file_s = read_file('data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv')
+        qa_result = qa_extcsv(loads(file_s), checker=checker)
+        rules = checker.compiled_rules['ozonesonde']
+        outcomes = evaluate_arrays(qa_result, rules)
+        self.assertTrue(outcomes)
+        for rule in rules:
+            if (rule.test_id, 1) not in outcomes:
+                continue
+            values, valid = qa_result.arrays.column(rule.table, 1,
+                                                    rule.element)
+            values = [value if ok else '' for value, ok in zip(values, valid)]
+            if rule.category == 'range':
+                expected = [checker.range_outcome(rule, value)
+                            for value in values]
+            else:
+                expected = [checker.step_outcome(rule, value, next_value)
+                            for value, next_value in zip(values, values[1:])]
+                expected.append(None)
+            self.assertEqual(expected, [OUTCOMES[code] for code in
+                                        outcomes[(rule.test_id, 1)]],
+                             rule.test_id)
+
     def test_bad_range_check3(self):
         """test range check"""
 
@@ -280,6 +547,31 @@ class QaTest(unittest.TestCase):
         self.assertEqual('100', qa_results['file1']['36'][6]['result'],
                          'range check')
 
+    def test_summary_row_ranges(self):
+        """test summary collapses consecutive failed rows"""
+
+        file_s = read_file(
+            'data/spectral/20030215.brewer.mkiv.130.epa_uga-bad.csv')
+        try:
+            qa(file_s, rule_path=WOUDC_QA_RULES, summary=True)
+            self.fail('summary check')
+        except WOUDCQaValidationError as err:
+            self.assertEqual(3, len(err.errors))
+            self.assertTrue(err.errors[0].startswith(
+                '0-error-36-GLOBAL_SUMMARY-all-Flag-1..2-'))
+            self.assertTrue(err.errors[0].endswith(' (2 rows)'))
+            self.assertTrue(err.errors[1].startswith(
+                '1-error-36-GLOBAL_SUMMARY-all-Flag-9-'))
+
+        extcsv = loads(file_s)
+        qa_result = QualityChecker(WOUDC_QA_RULES).check(extcsv)
+        violations = qa_result.violations()
+        self.assertEqual([(1, 2, 2), (9, 9, 1), (23, 23, 1)],
+                         [(v.row_start, v.row_end, v.count)
+                          for v in violations])
+        self.assertEqual(('36', 'GLOBAL_SUMMARY', 'all', 'Flag'),
+                         violations[0][:4])
+
     def test_validator_error1(self):
         """test that bad metadata throws error"""
 
@@ -321,6 +613,1034 @@ fewer commas than there are headers' in qa_results)
         self.assertEqual('File passed all defined WOUDC \
 quality assessment checks.', qa_results)
 
+    def test_reusable_checker(self):
+        """test one checker quality assesses many files"""
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+
+        # ozonesonde
+        file_s = read_file(
+            'data/ozonesonde/20130227.ECC.6A.6A28027.UKMO-sample1.csv')
+        qa_results = qa(file_s, checker=checker)
+        self.assertEqual('100', qa_results['file1']['25P'][10]['result'],
+                         'range check in profile')
+
+        # totalozone
+        file_s = read_file(
+            'data/totalozone/19870501.Dobson.Beck.092.DMI-sample1.csv')
+        qa_results2 = qa(file_s, checker=checker)
+        self.assertFalse(qa_results2['file1']['35'][1]['precond_result'],
+                         'precond result check')
+        self.assertNotIn('35', qa_results['file1'], 'fresh results')
+
+        # loaded rule definitions are left untouched
+        self.assertEqual('', checker.qa_rules['ozonesonde'][0]['table_index'],
+                         'rule definition check')
+
+    def test_checker_results_per_file(self):
+        """test checker returns a fresh result object per file"""
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+        extcsv = loads(
+            read_file('data/ozonesonde/20070505.ecc.2z.6674.uah.csv'))
+        result1 = checker.check(extcsv, 'a.csv')
+        result2 = checker.check(extcsv, 'b.csv')
+
+        self.assertEqual(['a.csv'], list(result1.qa_results.keys()))
+        self.assertEqual(['b.csv'], list(result2.qa_results.keys()))
+        self.assertEqual('ozonesonde', result1.dataset)
+        self.assertEqual(result1.qa_results['a.csv']['40'][1],
+                         result2.qa_results['b.csv']['40'][1])
+        self.assertEqual(checker.fingerprint, result1.fingerprint)
+        self.assertNotEqual(QualityChecker().fingerprint,
+                            checker.fingerprint)
+
+    def test_rule_set_watcher(self):
+        """test rule set hot reload"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rule_path = os.path.join(tmpdir, 'rules.csv')
+            shutil.copy(WOUDC_QA_RULES, rule_path)
+            checker = QualityChecker(rule_path)
+            reloaded = []
+            watcher = RuleSetWatcher(checker, reloaded.append)
+            self.assertIsNone(watcher.poll(), 'no change')
+
+            # compiled once unchanged for two polls
+            with open(rule_path, 'a') as ff:
+                ff.write('totalozone,99,1,,,,,,,,,,,DAILY,,ColumnO3,1,')
+            self.assertIsNone(watcher.poll(), 'being written')
+            with open(rule_path, 'a') as ff:
+                ff.write('range,RC_1,0,1000,,0|100,\n')
+            self.assertIsNone(watcher.poll(), 'being written')
+            self.assertEqual([], reloaded)
+            new_checker = watcher.poll()
+            self.assertEqual([new_checker], reloaded)
+            self.assertNotEqual(checker.fingerprint, new_checker.fingerprint)
+            self.assertEqual('99',
+                             new_checker.qa_rules['totalozone'][-1]['test_id'])
+
+            # a broken rule set is not swapped in
+            with open(rule_path, 'a') as ff:
+                ff.write('totalozone,100,1,,,,,,,,,,,DAILY,bad,ColumnO3,1,'
+                         'range,RC_1,0,1000,,0|100,\n')
+            self.assertIsNone(watcher.poll())
+            self.assertIsNone(watcher.poll())
+            self.assertEqual(new_checker.fingerprint, watcher.fingerprint)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_climatology(self):
+        """test range check against a climatology grid"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            grid_path = os.path.join(tmpdir, 'o3.grid')
+            files = build_climatology(
+                [os.path.join(DATA_DIR, 'ozonesonde')], grid_path,
+                'PROFILE', 'O3PartialPressure', 'Pressure',
+                [1000, 700, 500, 300, 200, 100, 50, 20, 10, 5], 30, 5)
+            self.assertEqual(3, files)
+            climatology = open_climatology(grid_path)
+            self.assertIs(climatology, open_climatology(grid_path))
+            means, deviations = climatology.statistics(
+                34.72, 5, numpy.array([1000, 850, 3, 0]),
+                numpy.array([True, True, True, False]))
+            self.assertAlmostEqual(4.13, means[0], 2)
+            self.assertTrue(means[0] > means[1] > 3.6)
+            self.assertTrue(numpy.isnan(means[2:]).all())
+
+            rule_path = os.path.join(tmpdir, 'rules.csv')
+            shutil.copy(WOUDC_QA_RULES, rule_path)
+            with open(rule_path, 'a') as ff:
+                ff.write('ozonesonde,99,1,,,,,,,,,,,PROFILE,,'
+                         'O3PartialPressure,1,range,RC_9,5,,%s,0|100,\n'
+                         % grid_path)
+            checker = QualityChecker(rule_path)
+            file_s = read_file(
+                'data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv')
+            file_s = file_s.replace('708.1,4.04,', '708.1,9.04,')
+            results = qa(file_s, checker=checker)['file1']['99']
+            self.assertEqual([277], [row for row, result in results.items()
+                                     if row != 'test_def' and
+                                     result['result'] == '0'])
+            for test_ids in summary_test_ids(file_s, checker):
+                self.assertIn('99', test_ids)
+            with ColumnPool(checker, 2, min_rows=0) as pool:
+                self.assertEqual(qa(file_s, checker=checker),
+                                 qa(file_s, pool=pool))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_reference_profile(self):
+        """test range check against a station reference profile"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, '315.csv'), 'w') as ff:
+                ff.write('Altitude,OzoneDensity\n'
+                         '13000,3.2e12\n16570,3.7e12\n19450,5.3e12\n'
+                         '22330,3.8e12\n25200,2.8e12\n28080,1.7e12\n'
+                         '30960,1.2e12\n33840,7.3e11\n36710,6.3e11\n')
+            profile = open_reference_profile(tmpdir, '315')
+            self.assertIs(profile, open_reference_profile(tmpdir, '315'))
+            self.assertIsNone(open_reference_profile(tmpdir, '043'))
+            reference = profile.interpolate(
+                numpy.array([13000, 18010, 40000]),
+                numpy.array([True, True, True]))
+            self.assertAlmostEqual(4.5e12, reference[1], -10)
+            self.assertTrue(numpy.isnan(reference[2]))
+
+            rule_path = os.path.join(tmpdir, 'rules.csv')
+            shutil.copy(WOUDC_QA_RULES, rule_path)
+            with open(rule_path, 'a') as ff:
+                ff.write('lidar,99,1,,,,,,,,,,,OZONE_PROFILE,,OzoneDensity,'
+                         '1,range,RC_10,0.5,,%s,0|100,\n' % tmpdir)
+            checker = QualityChecker(rule_path)
+            file_s = read_file(
+                'data/lidar/19930208.dial.lotard.001.crestech.csv')
+            file_s = file_s.replace('25200.,2.776e+012', '25200.,9.776e+012')
+            results = qa(file_s, checker=checker)['file1']['99']
+            # low ozone layers (rows 4, 5 and 45) and the altered row
+            self.assertEqual([4, 5, 25, 45],
+                             [row for row, result in results.items()
+                              if row != 'test_def' and
+                              result['result'] == '0'])
+            for test_ids in summary_test_ids(file_s, checker):
+                self.assertIn('99', test_ids)
+            with ColumnPool(checker, 2, min_rows=0, chunk_rows=7) as pool:
+                self.assertEqual(qa(file_s, checker=checker),
+                                 qa(file_s, pool=pool))
+            # above the reference levels
+            self.assertEqual('Error', results[60]['result'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_timeseries_check(self):
+        """test time series checks across files of a station"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rule_path = os.path.join(tmpdir, 'rules.csv')
+            shutil.copy(WOUDC_QA_RULES, rule_path)
+            with open(rule_path, 'a') as ff:
+                ff.write('totalozone,98,1,,,,,,,,,,,DAILY,,ColumnO3,1,'
+                         'timeseries,TC_1,100,3,,0|100,\n'
+                         'totalozone,99,1,,,,,,,,,,,DAILY,,ColumnO3,1,'
+                         'timeseries,TC_2,100,7,,0|100,\n')
+            checker = QualityChecker(rule_path)
+            store_path = os.path.join(tmpdir, 'series.json')
+            checker.timeseries = TimeSeriesStore(store_path)
+            may = read_file(
+                'data/totalozone/19870501.Dobson.Beck.092.DMI-sample1.csv')
+            # the next month, starting far from the end of May
+            june = may.replace('1987-05-01,0,4,365.4',
+                               '1987-05-01,0,4,520.0')
+            june = june.replace('1987-05-', '1987-06-')
+
+            results = qa(may, checker=checker)['file1']
+            # the spike of May 3rd and the day after
+            for test_id, rows in [('98', [3, 4]), ('99', [3])]:
+                self.assertEqual(rows, sorted(
+                    row for row, result in results[test_id].items()
+                    if row != 'test_def' and result['result'] == '0'))
+                self.assertIsNone(results[test_id][1]['result'])
+
+            results = qa(june, checker=checker)['file1']
+            self.assertEqual('0', results['98'][1]['result'])
+            self.assertEqual('0', results['99'][1]['result'])
+            # checked again, the file is not checked against itself
+            results = qa(june, checker=checker)['file1']
+            self.assertEqual('0', results['98'][1]['result'])
+
+            checker.timeseries.save()
+            store = TimeSeriesStore(store_path)
+            days, values = store.series('034|Dobson|092|DAILY|ColumnO3')
+            # less the days that failed, spikes included
+            self.assertEqual(50, len(days))
+            self.assertFalse(set([501.0, 520.0]) & set(values))
+            self.assertTrue(days[-1] - days[0] < store.window)
+            self.assertEqual(372.2, values[-1])
+
+            # without a store, the series starts with the file
+            results = qa(june, checker=QualityChecker(rule_path))['file1']
+            self.assertIsNone(results['98'][1]['result'])
+
+            # the spike fails the file
+            for test_ids in summary_test_ids(
+                    may, QualityChecker(rule_path)):
+                self.assertTrue(set(['98', '99']) <= test_ids)
+            with self.assertRaises(WOUDCQaValidationError) as cm:
+                qa(may, summary=True)
+            self.assertTrue(any(
+                error.startswith('0-error-54-DAILY-1-ColumnO3-3..4-')
+                for error in cm.exception.errors))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_scan_checks(self):
+        """test checks over the stacked GLOBAL scans of a spectral file"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rule_path = os.path.join(tmpdir, 'rules.csv')
+            shutil.copy(WOUDC_QA_RULES, rule_path)
+            with open(rule_path, 'a') as ff:
+                ff.write('spectral,97,1,,,,,,,,,,,GLOBAL,all,S-Irradiance,1,'
+                         'range,RC_5,0,,,0|100,\n'
+                         'spectral,98,1,,,,,,,,,,,GLOBAL,all,Wavelength,1,'
+                         'scan,SN_1,0.01,,,0|100,\n'
+                         'spectral,99,1,,,,,,,,,,,GLOBAL,all,S-Irradiance,1,'
+                         'scan,SN_2,1,0.001,,0|100,\n')
+            checker = QualityChecker(rule_path)
+            file_s = read_file(
+                'data/spectral/20030215.brewer.mkiv.130.epa_uga-good.csv')
+            scans = file_s.split('#GLOBAL\r\n')
+            # a spike, a negative value and a shifted wavelength in scan 12
+            scans[12] = scans[12].replace(
+                '320.5,4.479E-01', '320.5,4.479E+00').replace(
+                '325.0,4.322E-01', '325.0,-4.322E-01').replace(
+                '330.0,4.210E-01', '330.2,4.210E-01')
+            qa_result = qa_extcsv(loads('#GLOBAL\r\n'.join(scans)),
+                                  checker=checker)
+            rules = checker.compiled_rules['spectral']
+            outcomes = evaluate_arrays(qa_result, rules)
+            for test_id, rows in [('97', [71]), ('98', [81]),
+                                  ('99', [61, 62, 63])]:
+                for ti in range(1, 24):
+                    self.assertEqual(rows if ti == 12 else [], [
+                        row + 1 for row, code in
+                        enumerate(outcomes[(test_id, ti)])
+                        if OUTCOMES[code] is False], (test_id, ti))
+            # not assessed: the first row and rows next to the negative value
+            self.assertIsNone(OUTCOMES[outcomes[('99', 12)][0]])
+            self.assertIsNone(OUTCOMES[outcomes[('99', 12)][71]])
+            for test_ids in summary_test_ids('#GLOBAL\r\n'.join(scans),
+                                             checker):
+                self.assertTrue(set(['97', '98', '99']) <= test_ids)
+
+            # stacked range outcomes are those of each scan on its own
+            rule = [rule for rule in rules if rule.test_id == '97'][0]
+            values, valid = qa_result.arrays.column('GLOBAL', 12,
+                                                    'S-Irradiance')
+            self.assertEqual(
+                outcomes[('97', 12)],
+                bytearray(range_codes(rule, values, valid).tobytes()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_weighted_irradiance(self):
+        """test spectral summaries against integrals of their scans"""
+
+        file_s = read_file(
+            'data/spectral/20030215.brewer.mkiv.130.epa_uga-good.csv')
+        extcsv = SpectralHandler(loads(file_s)).extcsv
+        instances = get_table_instances(extcsv)
+        self.assertEqual(23, len(instances['GLOBAL']))
+        self.assertEqual('GLOBAL_SUMMARY2', instances['GLOBAL_SUMMARY'][2])
+        for ti, section in instances['GLOBAL_SUMMARY'].items():
+            summary = extcsv.sections[section]
+            # scans end at 363 nm: the CIE integral misses the UVA tail
+            ratio = float(summary['IntCIE']) / float(summary['derived:IntCIE'])
+            self.assertTrue(1 <= ratio < 1.2, ti)
+            self.assertAlmostEqual(
+                1, float(summary['IntACGIH']) /
+                float(summary['derived:IntACGIH']), 1)
+
+        results = qa(file_s)['file1']
+        self.assertEqual(['100'] * 23, [results['59'][ti]['result']
+                                        for ti in range(1, 24)])
+        results = qa(file_s.replace('4.994E+01', '9.988E+01'))['file1']
+        self.assertEqual('0', results['59'][5]['result'])
+        for test_ids in summary_test_ids(
+                file_s.replace('4.994E+01', '9.988E+01')):
+            self.assertIn('59', test_ids)
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+        self.assertTrue(checker._function_cc(0.02, 0.01, 0.1, True, 0.01))
+        self.assertFalse(checker._function_cc(0.03, 0.01, 0.1, True, 0.01))
+
+        # the erythemal action spectrum ends at 400 nm
+        weights = erythemal_weights(numpy.array([290.0, 400.0, 400.5, 450.0]))
+        self.assertEqual(1, weights[0])
+        self.assertAlmostEqual(10 ** (0.015 * (140 - 400)), weights[1])
+        self.assertEqual([0, 0], list(weights[2:]))
+        tail = '363.0,3.414E-02\r\n400.5,1.000E+00\r\n'
+        derived = [
+            SpectralHandler(loads(file_s.replace(
+                '363.0,3.414E-02\r\n', extra, 1))).extcsv.sections[
+                    'GLOBAL_SUMMARY']['derived:IntCIE']
+            for extra in [tail, tail + '450.0,1.000E+00\r\n']]
+        self.assertEqual(derived[0], derived[1])
+
+    def test_rule_pack(self):
+        """test compiling and loading rule packs"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rule_path = os.path.join(tmpdir, 'rules.csv')
+            shutil.copy(WOUDC_QA_RULES, rule_path)
+            self.assertIsNone(QualityChecker(rule_path).rule_pack)
+
+            pack_path = compile_rules(rule_path)
+            self.assertEqual(rule_path + '.pack', pack_path)
+            checker = QualityChecker(rule_path)
+            self.assertEqual(pack_path, checker.rule_pack)
+            self.assertEqual(QualityChecker(rule_path, '').fingerprint,
+                             checker.fingerprint)
+
+            file_s = read_file(
+                'data/ozonesonde/20130227.ECC.6A.6A28027.UKMO-sample1.csv')
+            self.assertEqual(qa(file_s, rule_path=WOUDC_QA_RULES),
+                             qa(file_s, checker=checker))
+            # handed to other processes with its rules decoded
+            copy = pickle.loads(pickle.dumps(checker, 2))
+            self.assertEqual(checker.fingerprint, copy.fingerprint)
+            self.assertEqual(qa(file_s, checker=checker),
+                             qa(file_s, checker=copy))
+
+            # stale rule pack: rule definitions are used
+            with open(rule_path, 'a') as ff:
+                ff.write('totalozone,99,1,,,,,,,,,,,DAILY,,ColumnO3,1,'
+                         'range,RC_1,0,1000,,0|100,\n')
+            checker = QualityChecker(rule_path)
+            self.assertIsNone(checker.rule_pack)
+            self.assertEqual('99',
+                             checker.qa_rules['totalozone'][-1]['test_id'])
+
+            # invalid rule definitions are not compiled
+            with open(rule_path, 'a') as ff:
+                ff.write('totalozone,100,1,98,100,,,,,,,,,DAILY,,ColumnO3,'
+                         '1,range,RC_1,0,,,0|100,\n')
+            with self.assertRaises(WOUDCQaValidationError) as cm:
+                compile_rules(rule_path)
+            self.assertEqual(2, len(cm.exception.errors))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_column_pool(self):
+        """test evaluating profile checks in worker processes"""
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+        with ColumnPool(checker, 2, min_rows=0) as pool:
+            for filename in [
+                    'data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv',
+                    'data/ozonesonde/20070505.ecc.2z.6674.uah.csv',
+                    'data/spectral/20030215.brewer.mkiv.130.epa_uga-bad.csv']:
+                file_s = read_file(filename)
+                self.assertEqual(qa(file_s, checker=checker),
+                                 qa(file_s, pool=pool), filename)
+
+            file_s = read_file(
+                'data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv')
+            qa_result = qa_extcsv(loads(file_s), pool=pool)
+            self.assertEqual(2992, len(qa_result.outcomes[('42', 1)]))
+            self.assertEqual(2992, len(qa_result.outcomes[('27', 1)]))
+
+    def test_column_pool_chunks(self):
+        """test row chunks give the same results as one sequential run"""
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+        file_s = read_file('data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv')
+        expected = qa(file_s, checker=checker)
+        # chunk boundaries fall between rows compared by step check 27
+        for chunk_rows in [7, 1000]:
+            with ColumnPool(checker, 3, min_rows=0,
+                            chunk_rows=chunk_rows) as pool:
+                self.assertEqual(expected, qa(file_s, pool=pool),
+                                 'chunk_rows %s' % chunk_rows)
+
+        # column, statistical and gradient checks run in the workers,
+        # their windows and halo rows reaching across chunks
+        checker = QualityChecker()
+        file_s = file_s.replace('1015.4,4.13,', '1015.4,9.13,')
+        expected = qa(file_s, checker=checker)
+        for chunk_rows in [7, 1000]:
+            with ColumnPool(checker, 3, min_rows=0,
+                            chunk_rows=chunk_rows) as pool:
+                qa_result = qa_extcsv(loads(file_s), pool=pool)
+                self.assertEqual(expected, qa_result.qa_results,
+                                 'chunk_rows %s' % chunk_rows)
+                self.assertTrue(set(['47', '48', '52']) <= set(
+                    test_id for test_id, _ in pool.evaluate(qa_result)))
+
+    def test_load_mapped(self):
+        """test memory-mapped loading parses files as woudc_extcsv"""
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+        for filename in [
+                'ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv',
+                'spectral/20030215.brewer.mkiv.130.epa_uga-bad.csv',
+                'totalozone/19870501.Dobson.Beck.092.DMI-sample1.csv']:
+            file_path = os.path.join(DATA_DIR, filename)
+            ecsv = load_mapped(file_path)
+            # tables with quoted fields are not mapped
+            tables = [ecsv.sections[table] for table in ecsv.data_tables
+                      if isinstance(ecsv.sections[table], MappedTable)]
+            self.assertFalse(any(table.materialised for table in tables))
+            self.assertEqual(loads(read_file(file_path)).__dict__,
+                             ecsv.__dict__, filename)
+            self.assertTrue(all(table.materialised for table in tables))
+
+            ecsv = load_mapped(file_path)
+            self.assertEqual(qa(read_file(file_path), checker=checker),
+                             qa_extcsv(ecsv, checker=checker).qa_results)
+        self.assertEqual(
+            qa(read_file(file_path), file_path, checker=checker),
+            qa_file(file_path, checker=checker))
+
+    def test_budget(self):
+        """test stopping checks at a file's budget"""
+
+        checker = QualityChecker(WOUDC_QA_RULES)
+        file_s = read_file('data/ozonesonde/20130227.ECC.6A.6A28027.UKMO.csv')
+        expected = qa(file_s, checker=checker)
+        self.assertEqual(expected, qa(file_s, checker=checker,
+                                      budget=QaBudget(3600, 4096)))
+
+        budget = QaBudget(0)
+        with self.assertRaises(WOUDCQaBudgetExceeded) as cm:
+            qa(file_s, checker=checker, budget=budget)
+        self.assertEqual('time', cm.exception.reason)
+        self.assertEqual([], list(cm.exception.qa_result.test_results()))
+        self.assertFalse(budget.started)
+
+        # stopped part way: results so far
+        with self.assertRaises(WOUDCQaBudgetExceeded) as cm:
+            qa(file_s, checker=checker, budget=CheckCountBudget(5))
+        partial = cm.exception.qa_result.qa_results['file1']
+        self.assertTrue(0 < len(partial) < len(expected['file1']))
+        for test_id in partial:
+            self.assertIn(test_id, expected['file1'])
+
+    def test_budget_hard_limit(self):
+        """test interrupting work past the hard time limit"""
+
+        budget = QaBudget(0.1)
+        budget.start(hard_limit=True)
+        try:
+            with self.assertRaises(WOUDCQaBudgetExceeded):
+                time.sleep(5)
+        finally:
+            budget.stop()
+
+
+class QaBatchTest(unittest.TestCase):
+    """Test WOUDC Qa batch runs and result sinks"""
+
+    def setUp(self):
+        """setup test fixtures, etc."""
+
+        print(msg(self.id(), self.shortDescription()))
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """return to pristine state"""
+
+        shutil.rmtree(self.tmpdir)
+
+    def test_batch(self):
+        """test batch run over a directory"""
+
+        outcomes = dict((os.path.basename(file_path), status)
+                        for file_path, status, qa_result, message
+                        in run_batch([DATA_DIR], WOUDC_QA_RULES))
+        self.assertEqual(11, len(outcomes))
+        self.assertEqual(
+            'error', outcomes['19930208.dial.lotard.001.crestech.csv'])
+        self.assertEqual(
+            'failed', outcomes['20030215.brewer.mkiv.130.epa_uga-bad.csv'])
+        self.assertEqual(
+            'passed', outcomes['20030215.brewer.mkiv.130.epa_uga-good.csv'])
+
+    def test_sqlite_sink(self):
+        """test storing and querying results in SQLite"""
+
+        db_path = os.path.join(self.tmpdir, 'results.db')
+        with SQLiteResultSink(db_path, batch_size=4) as sink:
+            violations = dict(
+                (file_path, (status, sum(violation.count for violation in
+                                         qa_result.violations())))
+                for file_path, status, qa_result, message
+                in run_batch([DATA_DIR], WOUDC_QA_RULES, sink)
+                if qa_result is not None)
+            # re-running replaces earlier results
+            list(run_batch([DATA_DIR], WOUDC_QA_RULES, sink))
+
+        with SQLiteResultSink(db_path) as sink:
+            self.assertEqual(11, len(sink.query()))
+            results = sink.query(dataset='ozonesonde', station='lerwick',
+                                 date_from='2013-01-01',
+                                 date_to='2013-12-31', failed_test='42')
+            self.assertEqual(2, len(results))
+            self.assertEqual('043', results[0]['station'])
+            self.assertEqual(['Brewer'],
+                             [r['instrument'] for r in
+                              sink.query(failed_test='36')])
+            self.assertEqual(1, len(sink.query(status='error')))
+            # failed rows and status agree with the file's violations
+            for result in sink.query():
+                if result['file_path'] in violations:
+                    self.assertEqual(violations[result['file_path']], (
+                        result['status'], result['failed_rows']))
+                    self.assertEqual(result['status'] == 'failed',
+                                     result['failed_rows'] > 0)
+
+            file_path = results[0]['file_path']
+            ranges = sink.row_ranges(file_path, '42')
+            self.assertEqual(1, ranges[0]['row_start'])
+            self.assertEqual(sum(r['row_end'] - r['row_start'] + 1
+                                 for r in ranges), results[0]['rows'])
+            self.assertTrue(any(r['result'] == '0' for r in ranges))
+
+        # a file added twice in one transaction keeps its last results
+        with SQLiteResultSink(db_path) as sink:
+            sink.add(file_path, 'passed')
+            sink.add(file_path, 'error', message='second run')
+            sink.flush()
+            self.assertEqual(['error'], [r['status'] for r in sink.query()
+                                         if r['file_path'] == file_path])
+            self.assertEqual([], sink.row_ranges(file_path, '42'))
+
+    def test_batch_workers(self):
+        """test batch run in worker processes"""
+
+        expected = sorted((file_path, status, message)
+                          for file_path, status, qa_result, message
+                          in run_batch([DATA_DIR], WOUDC_QA_RULES))
+        history_path = os.path.join(self.tmpdir, 'throughput.json')
+        db_path = os.path.join(self.tmpdir, 'results.db')
+        with SQLiteResultSink(db_path) as sink:
+            results = sorted((file_path, status, message)
+                             for file_path, status, qa_result, message
+                             in run_batch([DATA_DIR], WOUDC_QA_RULES, sink,
+                                          workers=2,
+                                          history_path=history_path))
+            self.assertEqual(expected, results)
+            self.assertEqual(2, len(sink.query(station='lerwick',
+                                               failed_test='42')))
+
+        # files listed twice are checked once
+        self.assertEqual(find_files([DATA_DIR]),
+                         find_files([DATA_DIR, DATA_DIR]))
+        results = sorted((file_path, status, message)
+                         for file_path, status, qa_result, message
+                         in run_batch([DATA_DIR, DATA_DIR], WOUDC_QA_RULES,
+                                      workers=2))
+        self.assertEqual(expected, results)
+        with open(history_path) as ff:
+            self.assertIn('ozonesonde', json.load(ff))
+
+    def test_batch_worker_reload(self):
+        """test workers switch to the rule set of the parent process"""
+
+        rule_path = os.path.join(self.tmpdir, 'rules.csv')
+        shutil.copy(WOUDC_QA_RULES, rule_path)
+        checker = QualityChecker(rule_path)
+        # rule definitions changed after the parent compiled them
+        with open(rule_path, 'a') as ff:
+            ff.write('not a rule\n')
+        file_path = os.path.join(
+            DATA_DIR, 'totalozone',
+            '19870501.Dobson.Beck.092.DMI-sample1.csv')
+        inbox = multiprocessing.Queue()
+        receiver, outbox = multiprocessing.Pipe(False)
+        for message in [('reload', checker), ('check', file_path, None),
+                        None]:
+            inbox.put(message)
+        handler = signal.getsignal(signal.SIGINT)
+        try:
+            _work(0, QualityChecker(), inbox, outbox)
+        finally:
+            signal.signal(signal.SIGINT, handler)
+        worker, path, status, qa_result, message, timings, digest = \
+            receiver.recv()
+        self.assertEqual('passed', status)
+        self.assertEqual(checker.fingerprint, qa_result.fingerprint)
+
+    def test_batch_reload(self):
+        """test workers switching to a rule pack compiled mid-run"""
+
+        rule_path = os.path.join(self.tmpdir, 'rules.csv')
+        shutil.copy(WOUDC_QA_RULES, rule_path)
+        new_path = os.path.join(self.tmpdir, 'new.csv')
+        shutil.copy(WOUDC_QA_RULES, new_path)
+        with open(new_path, 'a') as ff:
+            ff.write('totalozone,99,1,,,,,,,,,,,DAILY,,ColumnO3,1,'
+                     'range,RC_1,0,1000,,0|100,\n')
+        results = []
+        for result in run_batch([DATA_DIR], rule_path, reload_interval=0.05,
+                                workers=2):
+            if not results:
+                # the pack of the new rule definitions is in place first
+                compile_rules(new_path, rule_path + '.pack')
+                os.rename(new_path, rule_path)
+                time.sleep(1)
+            results.append(result)
+        checker = QualityChecker(rule_path)
+        self.assertEqual(rule_path + '.pack', checker.rule_pack)
+        self.assertEqual(11, len(results))
+        self.assertEqual(['19930208.dial.lotard.001.crestech.csv'], [
+            os.path.basename(file_path) for file_path, status, qa_result,
+            message in results if status == 'error'])
+        self.assertEqual(checker.fingerprint, [
+            qa_result.fingerprint for file_path, status, qa_result, message
+            in results if qa_result is not None][-1])
+
+    def test_batch_lost_workers(self):
+        """test files of exited workers are checked by fresh ones"""
+
+        results = []
+        for result in run_batch([DATA_DIR], WOUDC_QA_RULES, workers=2):
+            if not results:
+                for process in multiprocessing.active_children():
+                    os.kill(process.pid, signal.SIGKILL)
+            results.append(result)
+        self.assertEqual(find_files([DATA_DIR]),
+                         sorted(result[0] for result in results))
+        lost = [message for file_path, status, qa_result, message in results
+                if message and message.startswith('Worker exited')]
+        self.assertTrue(len(lost) <= 2 * PREFETCH)
+        self.assertTrue(len(results) - len(lost) > 5)
+
+    def test_batch_archives(self):
+        """test batch run over compressed files and archive members"""
+
+        tar_path = os.path.join(self.tmpdir, 'data.tar.gz')
+        with closing(tarfile.open(tar_path, 'w:gz')) as tar:
+            tar.add(DATA_DIR, 'data')
+        zip_path = os.path.join(self.tmpdir, 'spectral.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for filename in os.listdir(os.path.join(DATA_DIR, 'spectral')):
+                zf.write(os.path.join(DATA_DIR, 'spectral', filename),
+                         'spectral/%s' % filename)
+        good = os.path.join(DATA_DIR, 'spectral',
+                            '20030215.brewer.mkiv.130.epa_uga-good.csv')
+        gz_dir = os.path.join(self.tmpdir, 'gz')
+        os.mkdir(gz_dir)
+        gz_path = os.path.join(gz_dir, 'good.csv.gz')
+        with closing(gzip.open(gz_path, 'wb')) as gz:
+            gz.write(read_file(good))
+
+        files = find_files([tar_path, zip_path, gz_dir])
+        self.assertEqual(14, len(files))
+        # members of the compressed archive: in archive order, on one
+        # worker
+        members = [member for member, size in archive.list_members(tar_path)]
+        self.assertEqual(members, [file_path for file_path in files
+                                   if file_path in members])
+        queues = plan([(file_path, 1000, 'totalozone') for file_path in files],
+                      2, ThroughputModel())
+        for queue in queues:
+            tasks = [task[1] for task in queue if task[1] in members]
+            self.assertIn(tasks, [[], members])
+            if tasks:
+                start = [task[1] for task in queue].index(members[0])
+                self.assertEqual(members, [
+                    task[1] for task in queue][start:start + len(members)])
+        member = '%s!data/spectral/%s' % (
+            tar_path, os.path.basename(good))
+        self.assertIn(member, files)
+        self.assertEqual(os.path.getsize(good), archive.file_size(member))
+        self.assertEqual(os.path.getsize(good), archive.file_size(gz_path))
+        self.assertEqual(read_file(good), archive.read_file(member))
+
+        outcomes = dict((file_path, status)
+                        for file_path, status, qa_result, message
+                        in run_batch([tar_path, zip_path, gz_dir],
+                                     WOUDC_QA_RULES, workers=2))
+        self.assertEqual(14, len(outcomes))
+        self.assertEqual('passed', outcomes[member])
+        self.assertEqual('passed', outcomes[gz_path])
+        self.assertEqual('failed', outcomes[
+            '%s!spectral/20030215.brewer.mkiv.130.epa_uga-bad.csv' %
+            zip_path])
+
+        self.assertEqual([], qa_extcsv(load(member)).violations())
+        with self.assertRaises(IOError):
+            archive.read_file('%s!data/missing.csv' % tar_path)
+
+    def test_batch_resume(self):
+        """test resuming a batch run from its progress journal"""
+
+        data_dir = os.path.join(self.tmpdir, 'data')
+        shutil.copytree(DATA_DIR, data_dir)
+        journal_path = os.path.join(self.tmpdir, 'progress.journal')
+        # content hashed where it is read, in workers too
+        for workers in [2, 0]:
+            with ProgressJournal(journal_path, batch_size=4) as journal:
+                self.assertEqual(11, len(list(run_batch(
+                    [data_dir], WOUDC_QA_RULES, journal=journal,
+                    workers=workers))))
+                for file_path, (content_hash, fingerprint, outcome) in \
+                        journal.completed.items():
+                    self.assertEqual(file_hash(file_path), content_hash)
+            os.remove(journal_path)
+        with ProgressJournal(journal_path, batch_size=4) as journal:
+            self.assertEqual(11, len(list(run_batch(
+                [data_dir], WOUDC_QA_RULES, journal=journal))))
+
+        # interrupted while appending
+        with open(journal_path, 'a') as ff:
+            ff.write('["%s", "ab' % data_dir)
+        changed = os.path.join(data_dir, 'spectral',
+                               '20030215.brewer.mkiv.130.epa_uga-good.csv')
+        with open(changed, 'a') as ff:
+            ff.write('\n')
+
+        with ProgressJournal(journal_path, resume=True) as journal:
+            self.assertEqual(11, len(journal.completed))
+            results = [(os.path.basename(file_path), status)
+                       for file_path, status, qa_result, message
+                       in run_batch([data_dir], WOUDC_QA_RULES,
+                                    journal=journal)]
+        # errors are retried, as are changed files
+        self.assertEqual(
+            [('19930208.dial.lotard.001.crestech.csv', 'error'),
+             ('20030215.brewer.mkiv.130.epa_uga-good.csv', 'passed')],
+            results)
+
+        # other rule definitions: all files are checked again
+        with ProgressJournal(journal_path, resume=True) as journal:
+            self.assertEqual(1, len(list(run_batch(
+                [data_dir], WOUDC_QA_RULES, journal=journal))))
+            self.assertEqual(11, len(list(run_batch(
+                [data_dir], journal=journal))))
+
+    def test_batch_shards(self):
+        """test sharded batch runs in separate processes, then merged"""
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        shards = [os.path.join(self.tmpdir, 'shard%s.db' % i)
+                  for i in range(1, 4)]
+        processes = [subprocess.Popen(
+            [sys.executable, WOUDC_QA_SCRIPT, 'batch', DATA_DIR, '--rules',
+             WOUDC_QA_RULES, '--db', shard, '--shard', '%s/3' % i],
+            stdout=subprocess.PIPE, env=env)
+            for i, shard in enumerate(shards, 1)]
+        outputs = [process.communicate()[0] for process in processes]
+        self.assertEqual([0, 0, 0], [p.returncode for p in processes])
+        # disjoint and complete
+        checked = [line.split(': ')[0] for output in outputs
+                   for line in output.splitlines()]
+        self.assertEqual(11, len(set(checked)))
+        self.assertEqual(11, len(checked))
+        for i, output in enumerate(outputs, 1):
+            for line in output.splitlines():
+                self.assertEqual(i, shard_of(line.split(': ')[0], 3))
+
+        merged = os.path.join(self.tmpdir, 'merged.db')
+        runs, totals, warnings = merge_results(merged, shards[:2])
+        self.assertEqual(['Missing shards of 3: 3'], warnings)
+        runs, totals, warnings = merge_results(merged, shards[2:])
+        self.assertEqual([], warnings)
+        self.assertEqual([1, 2, 3], [run['shard'] for run in runs])
+        self.assertEqual(11, sum(total['files'] for total in totals))
+        with SQLiteResultSink(merged) as sink:
+            self.assertEqual(11, len(sink.query()))
+            self.assertEqual(2, len(sink.query(station='lerwick',
+                                               failed_test='42')))
+            file_path = sink.query(failed_test='42')[0]['file_path']
+            self.assertTrue(sink.row_ranges(file_path, '42'))
+
+        # non-ASCII station names, with output to a pipe
+        output = subprocess.check_output(
+            [sys.executable, WOUDC_QA_SCRIPT, 'query', '--db', merged,
+             '--station', '\xc3\x85rhus'], env=env)
+        self.assertEqual(3, len(output.splitlines()))
+        for line in output.splitlines():
+            self.assertEqual('\xc3\x85rhus', line.split(',')[3])
+
+    def test_batch_budget(self):
+        """test files over budget are reported and their worker recycled"""
+
+        results = dict((os.path.basename(file_path), (status, qa_result))
+                       for file_path, status, qa_result, message
+                       in run_batch([DATA_DIR], WOUDC_QA_RULES, workers=1,
+                                    budget=QaBudget(0)))
+        self.assertEqual(11, len(results))
+        self.assertEqual(
+            'error', results['19930208.dial.lotard.001.crestech.csv'][0])
+        status, qa_result = \
+            results['20030215.brewer.mkiv.130.epa_uga-bad.csv']
+        self.assertEqual('exceeded', status)
+        self.assertEqual('spectral', qa_result.dataset)
+        self.assertEqual(10, [result[0] for result in results.values()]
+                         .count('exceeded'))
+
+    def test_read_ahead(self):
+        """test reading files ahead, in and out of order"""
+
+        file_paths = find_files([DATA_DIR])
+        missing = os.path.join(self.tmpdir, 'missing.csv')
+        stats = PipelineStats()
+        with ReadAhead(file_paths + [missing], depth=3, threads=2,
+                       stats=stats) as reader:
+            # not started by a reader: read by the caller
+            with open(file_paths[-1]) as ff:
+                self.assertEqual(ff.read(), reader.get(file_paths[-1]))
+            for file_path in file_paths[:-1]:
+                self.assertTrue(reader.depth <= 3)
+                with open(file_path) as ff:
+                    self.assertEqual(ff.read(), reader.get(file_path))
+            self.assertIsNone(reader.get(missing))
+        read = stats.report()[0]
+        self.assertEqual(12, read['files'])
+        self.assertTrue(read['depth_max'] <= 3)
+
+    def test_batch_pipeline(self):
+        """test batch runs reading ahead give the same results"""
+
+        expected = sorted((file_path, status, message)
+                          for file_path, status, qa_result, message
+                          in run_batch([DATA_DIR], WOUDC_QA_RULES,
+                                       read_ahead=0))
+        for workers in [0, 2]:
+            stats = PipelineStats()
+            results = sorted((file_path, status, message)
+                             for file_path, status, qa_result, message
+                             in run_batch([DATA_DIR], WOUDC_QA_RULES,
+                                          workers=workers, read_ahead=2,
+                                          stats=stats))
+            self.assertEqual(expected, results)
+            self.assertEqual([11, 11, 11], [stage['files'] for stage
+                                            in stats.report()])
+            self.assertIn(stats.bound, ['io', 'cpu'])
+
+    def test_batch_plan(self):
+        """test files are scheduled largest first, grouped by dataset"""
+
+        model = ThroughputModel()
+        files = [('s%s.csv' % i, 100000 + i, 'ozonesonde') for i in range(3)]
+        files += [('t%s.csv' % i, 1500, 'totalozone') for i in range(20)]
+        files.append(('x.csv', 10, 'spectral'))
+        queues = plan(files, 2, model)
+
+        self.assertEqual(24, sum(len(queue) for queue in queues))
+        self.assertEqual(['s2.csv', 's1.csv'],
+                         [queue[0][1] for queue in queues])
+        for queue in queues:
+            costs = [task[0] for task in queue]
+            self.assertEqual(sorted(costs, reverse=True), costs)
+        # the small datasets are not spread over workers
+        for dataset in ['totalozone', 'spectral']:
+            self.assertEqual(1, len([queue for queue in queues if any(
+                task[3] == dataset for task in queue)]))
+
+
+class QaServiceTest(unittest.TestCase):
+    """Test WOUDC Qa HTTP service"""
+
+    @classmethod
+    def setUpClass(cls):
+        """start service on a free port"""
+
+        cls.service = QaService(WOUDC_QA_RULES, workers=1, queue_size=1)
+        cls.server = QaHTTPServer(('localhost', 0), cls.service)
+        cls.url = 'http://localhost:%s' % cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """stop service"""
+
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.service.close()
+
+    def setUp(self):
+        """setup test fixtures, etc."""
+
+        print(msg(self.id(), self.shortDescription()))
+
+    def post(self, path, content):
+        """helper function to post content and return status and JSON"""
+
+        try:
+            response = urllib2.urlopen('%s%s' % (self.url, path), content)
+            return response.getcode(), json.load(response)
+        except urllib2.HTTPError as err:
+            return err.code, json.load(err)
+
+    def test_service_results(self):
+        """test full results over HTTP"""
+
+        file_s = read_file(
+            'data/ozonesonde/20130227.ECC.6A.6A28027.UKMO-sample1.csv')
+        status, response = self.post('/qa', file_s)
+        self.assertEqual(200, status)
+        self.assertEqual('100',
+                         response['results']['file1']['25P']['10']['result'],
+                         'range check in profile')
+
+    def test_service_summary(self):
+        """test summary over HTTP"""
+
+        file_s = read_file(
+            'data/totalozone/19870501.Dobson.Beck.092.DMI-sample1.csv')
+        status, response = self.post('/qa?summary=true', file_s)
+        self.assertEqual(200, status)
+        self.assertEqual('passed', response['status'])
+
+        file_s = read_file(
+            'data/lidar/19930208.dial.lotard.001.crestech.csv').replace(
+            'WOUDC,Lidar', 'WOUDC,UmkehrN14')
+        status, response = self.post('/qa?summary=true', file_s)
+        self.assertEqual(501, status)
+
+        status, response = self.post('/qa', 'not an extended CSV file')
+        self.assertEqual(400, status)
+
+    def test_service_bad_request(self):
+        """test requests whose results cannot be serialized"""
+
+        file_s = read_file(
+            'data/totalozone/19870501.Dobson.Beck.092.DMI-sample1.csv')
+        # more requests than slots: none may keep its slot
+        for i in range(3):
+            status, response = self.post('/qa?file_path=%C5', file_s)
+            self.assertEqual(400, status)
+            self.assertEqual('error', response['status'])
+        self.assertEqual(0, self.service.status()['in_flight'])
+        status, response = self.post('/qa?summary=true', file_s)
+        self.assertEqual(200, status)
+
+    def test_service_reload(self):
+        """test swapping rule sets in the service"""
+
+        file_s = read_file(
+            'data/totalozone/19870501.Dobson.Beck.092.DMI-sample2.csv')
+        old_fingerprint = self.service.fingerprint
+        new_checker = QualityChecker()
+        self.service.reload(new_checker)
+        try:
+            status, response = self.post('/qa?summary=true', file_s)
+            self.assertEqual(new_checker.fingerprint, response['rule_set'])
+            self.assertEqual('failed', response['status'])
+
+            # errors as qa gives them: by violation id
+            bad_s = re.sub(r'(-\d[02468],0,\d),[\d.]+,', r'\1,900,',
+                           file_s)
+            status, response = self.post('/qa?summary=true', bad_s)
+            with self.assertRaises(WOUDCQaValidationError) as cm:
+                qa(bad_s, summary=True, checker=new_checker)
+            self.assertTrue(len(cm.exception.errors) > 10)
+            self.assertEqual(cm.exception.errors, response['errors'])
+        finally:
+            self.service.reload(QualityChecker(WOUDC_QA_RULES))
+        status, response = self.post('/qa?summary=true', file_s)
+        self.assertEqual(old_fingerprint, response['rule_set'])
+        self.assertEqual('passed', response['status'])
+
+    def test_service_budget(self):
+        """test requests over budget and recycled workers"""
+
+        service = QaService(WOUDC_QA_RULES, workers=1, budget=QaBudget(0))
+        try:
+            file_s = read_file(
+                'data/totalozone/19870501.Dobson.Beck.092.DMI-sample1.csv')
+            for i in range(2):
+                status, body = service.check(file_s, summary=True)
+                self.assertEqual(422, status)
+                self.assertEqual('exceeded', json.loads(body)['status'])
+            self.assertEqual(2, service.status()['exceeded'])
+        finally:
+            service.close()
+
+    def test_service_timeout(self):
+        """test requests timed out still count against capacity"""
+
+        service = QaService(WOUDC_QA_RULES, workers=1, queue_size=0,
+                            timeout=0)
+        try:
+            file_s = read_file(
+                'data/ozonesonde/20130227.ECC.6A.6A28027.UKMO-sample1.csv')
+            with self.assertRaises(multiprocessing.TimeoutError):
+                service.check(file_s)
+            self.assertEqual(1, service.status()['in_flight'])
+            with self.assertRaises(WOUDCQaServiceBusyError):
+                service.check(file_s)
+
+            # freed once the worker is done with the request
+            for i in range(100):
+                if service.status()['in_flight'] == 0:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(0, service.status()['in_flight'])
+            self.assertEqual(1, service.status()['rejected'])
+        finally:
+            service.close()
+
+    def test_service_health(self):
+        """test service health"""
+
+        response = json.load(urllib2.urlopen('%s/health' % self.url))
+        self.assertEqual(1, response['workers'])
+        self.assertEqual(0, response['in_flight'])
+
 
 # main
 if __name__ == '__main__':
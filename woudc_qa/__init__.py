@@ -46,16 +46,28 @@
 
 import os
 import csv
+import hashlib
 import logging
+import signal
+import time
 from collections import OrderedDict
+from itertools import imap, izip
+from StringIO import StringIO
 import woudc_extcsv
-from woudc_qa.util import get_extcsv_value,\
-    summarize,\
-    get_table_ranges
-from woudc_qa.dataset_handlers import\
-    OzoneSondeHandler,\
-    TotalOzoneHandler,\
-    SpectralHandler
+from woudc_qa.util import FAIL,\
+    get_extcsv_value,\
+    find_violations,\
+    format_violations,\
+    get_rss,\
+    get_table_instances,\
+    get_table_ranges,\
+    is_precondition
+from woudc_qa.archive import read_file
+from woudc_qa.arrays import ARRAY_ONLY_FUNCTIONS, LOOKUP_FUNCTIONS,\
+    ProfileArrays, evaluate as evaluate_arrays
+from woudc_qa.mapped import is_mappable, load_mapped
+from woudc_qa.rulepack import read_rule_pack, write_rule_pack
+from woudc_qa.dataset_handlers import DATASET_HANDLERS
 
 __version__ = '0.3.0'
 
@@ -65,162 +77,603 @@ WOUDC_QA_RULES = os.path.join(__dirpath, 'woudc-qa-rules.csv')
 
 LOGGER = logging.getLogger(__name__)
 
+RULE_PACK_EXTENSION = '.pack'
+
+# rule definition tokens (columns after dataset)
+QA_RULE_TOKENS = [
+    'test_id', 'test_status', 'related_test_id', 'related_test_result',
+    'agency', 'platform', 'instrument_type', 'instrument_model',
+    'instrument_serial_number', 'instrument_latitude',
+    'instrument_longitude', 'datetime', 'table', 'table_index', 'element',
+    'profile', 'test_category', 'function', 'function_parameter_a',
+    'function_parameter_b', 'function_parameter_c', 'test_results',
+    'test_description'
+]
+
+# supported test functions by test category
+QA_FUNCTIONS = {
+    'presence': ['PR_1'],
+    'range': ['RC_1', 'RC_5', 'RC_6', 'RC_7', 'RC_8', 'RC_9', 'RC_10'],
+    'step': ['TS_0', 'TS_2', 'TS_3', 'TS_4', 'TS_5', 'TS_6', 'TS_7'],
+    'consistency': ['CC_1', 'CC_2', 'CC_3', 'CC_4', 'CC_5'],
+    'statistical': ['SC_1', 'SC_2'],
+    'timeseries': ['TC_1', 'TC_2'],
+    'scan': ['SN_1', 'SN_2']
+}
+
+# test outcomes by code, as written to shared result buffers
+OUTCOMES = (None, True, False, 'Error')
+
+# position of each result token in the result store
+RESULT_TOKENS = {
+    'result': 0,
+    'related_test_result': 1,
+    'precond_result': 2
+}
+
+# profile rows checked between two budget checks
+BUDGET_CHECK_ROWS = 1024
+
+# hard time limit, as a multiple of the time budget
+HARD_LIMIT_FACTOR = 2
+
+
+class QaRule(object):
+    """Compiled qa rule definition."""
+
+    def __init__(self, rule):
+        """
+        Pre-compute everything a rule needs at execution time, once
+
+        :param rule: rule definition as loaded from the rule definitions
+        """
+
+        # keep a normalized copy; the loaded definition is never mutated
+        self._definition = dict(rule)
+        table_index = rule['table_index']
+        if table_index == '':
+            table_index = 1
+        elif table_index != 'all':
+            table_index = int(table_index)
+        self._definition['table_index'] = table_index
+
+        self.test_id = rule['test_id']
+        self.status = rule['test_status'] == '1'
+        self.profile = rule['profile'] == '1'
+        self.table = rule['table']
+        self.table_index = table_index
+        self.element = rule['element']
+        self.category = rule['test_category']
+        self.function = rule['function']
+        self.param_a = _parse_parameter(rule['function_parameter_a'])
+        self.param_b = _parse_parameter(rule['function_parameter_b'])
+        self.param_c = _parse_parameter(rule['function_parameter_c'])
+        self.flag_map = _build_flag_map(rule['test_results'])
+        self.preconditions = _build_preconditions(rule)
+        # resolved against the rule set by QualityChecker
+        self.related = []
+        self._related_ids = [tid.strip() for tid in
+                             rule['related_test_id'].split(',')]
+        self._related_results = [res.strip() for res in
+                                 rule['related_test_result'].split(',')]
+
+    @property
+    def definition(self):
+        """
+        :returns: normalized rule definition (stored as test_def)
+        """
+
+        return self._definition
+
+    def resolve_related_tests(self, rules):
+        """
+        Resolve related test ids against the rule set
+
+        :param rules: dict of test_id to QaRule of the same dataset
+        """
+
+        self.related = []
+        if any([self._related_ids == [''], self._related_results == ['']]):
+            return
+        for i, rtid in enumerate(self._related_ids):
+            expected = None
+            if i < len(self._related_results):
+                expected = self._related_results[i]
+            related_rule = rules.get(rtid)
+            non_profile = related_rule is not None and \
+                related_rule.definition['profile'] == '0'
+            self.related.append((rtid, expected, non_profile))
 
-class QualityChecker(object):
-    """Quality assess WOUDC data."""
 
-    def __init__(self, extcsv, file_path, rule_def_path=None):
+class QaResult(object):
+    """Quality assessment results of a single file."""
+
+    def __init__(self, extcsv, file_path=None, fingerprint=None):
         """
-        Quality assess incoming WOUDC data and maintain results.
+        Initialize an empty result set for one file
 
         :param extcsv: woudc_extcsv Reader object
             containing WOUDC data to be qa'd
+        :param file_path: path to file (optional)
+        :param fingerprint: fingerprint of the rule set used (optional)
         """
-        # create function to read qa-rules-definition and load all this
-        self._file_path = file_path
-        self._rule_path = None
-        self._qa_rules = OrderedDict()
+
         self._extcsv = extcsv
-        self._dataset = None
+        self._fingerprint = fingerprint
+        self._file_path = file_path
+        if self._file_path is None:
+            self._file_path = 'file1'
         try:
-            self.dataset = \
-                get_extcsv_value(self.extcsv, 'CONTENT', 'Category')
-            self.dataset = self.dataset.lower()
+            self._dataset = \
+                get_extcsv_value(self.extcsv, 'CONTENT', 'Category').lower()
         except Exception as err:
             msg = 'Unable to get CONTENT.Category. Due to: %s' % str(err)
             LOGGER.error(msg)
             raise err
-        self._qa_flags = OrderedDict()
-        self._qa_functions = OrderedDict()
+        self._metadata = {}
+        # compact result store: test_id -> (QaRule, {row: [result,
+        # related_test_result, precond_result]}, rows in insertion order)
+        self._tests = {}
+        self._test_order = []
+        self._qa_results = None
+        self._outcomes = {}
+        self._arrays = None
+        self._budget = None
+        self._timeseries = None
+        self._tables = None
+
+    def __getstate__(self):
+        """
+        Pickle results without the parsed file, e.g. to return them from
+        a worker process; metadata already retrieved is kept
+        """
+
+        state = self.__dict__.copy()
+        state['_extcsv'] = None
+        state['_qa_results'] = None
+        state['_outcomes'] = {}
+        state['_arrays'] = None
+        state['_budget'] = None
+        state['_timeseries'] = None
+        state['_tables'] = None
+        # column-wise: far smaller than a list per row
+        tests = {}
+        for test_id, (rule, rows, row_order) in self._tests.iteritems():
+            first = row_order[0]
+            if row_order == range(first, first + len(row_order)):
+                rows_state = (first, len(row_order))
+            else:
+                rows_state = row_order
+            tests[test_id] = (rule, rows_state) + tuple(
+                zip(*[rows[row] for row in row_order]))
+        state['_tests'] = tests
+        return state
 
-        self._qa_results = OrderedDict()
-        if self.file_path is None:
-            self.file_path = 'file1'
-        self.qa_results[self.file_path] = {}
+    def __setstate__(self, state):
+        """
+        Restore pickled results
+        """
 
-        if rule_def_path is not None:
-            self._rule_path = rule_def_path
-        else:
-            self._rule_path = WOUDC_QA_RULES
+        tests = {}
+        for test_id, test in state['_tests'].iteritems():
+            rule, row_order = test[:2]
+            if isinstance(row_order, tuple):
+                row_order = range(row_order[0], row_order[0] + row_order[1])
+            rows = dict(izip(row_order, imap(list, izip(*test[2:]))))
+            tests[test_id] = (rule, rows, row_order)
+        state['_tests'] = tests
+        self.__dict__.update(state)
 
-        try:
-            self.execute()
-        except Exception as err:
-            msg = 'Unable to execute qa. Due to: %s' % str(err)
-            LOGGER.critical(msg)
-            raise err
+    @property
+    def extcsv(self):
+        """
+        :returns: extcsv
+        """
+
+        return self._extcsv
 
     @property
-    def qa_rules(self):
+    def file_path(self):
         """
-        :returns: extcsv qa rule definitions
+        :returns: file_path
         """
 
-        return self._qa_rules
+        return self._file_path
 
-    @qa_rules.setter
-    def qa_rules(self, qa_rules):
+    @property
+    def dataset(self):
         """
-        Set qa rules
+        :returns: dataset
         """
 
-        self._qa_rules = qa_rules
+        return self._dataset
 
     @property
-    def qa_flags(self):
+    def fingerprint(self):
         """
-        :returns: extcsv qa flag definitions
+        :returns: fingerprint of the rule set that produced the results
         """
 
-        return self._qa_flags
+        return self._fingerprint
 
-    @qa_flags.setter
-    def qa_falgs(self, qa_flags):
+    @property
+    def outcomes(self):
         """
-        Set qa flags
+        :returns: precomputed profile test outcome codes (see OUTCOMES)
+            by (test_id, table index), one per row
         """
 
-        self._qa_flags = qa_flags
+        return self._outcomes
+
+    @outcomes.setter
+    def outcomes(self, outcomes):
+        """
+        Set precomputed profile test outcome codes
+        """
+
+        self._outcomes = outcomes
 
     @property
-    def qa_functions(self):
+    def arrays(self):
         """
-        :returns: extcsv qa function definitions
+        :returns: ProfileArrays of the file: typed payload columns,
+            parsed on first use
         """
 
-        return self._qa_functions
+        if self._arrays is None:
+            self._arrays = ProfileArrays(self.extcsv)
+        return self._arrays
 
-    @qa_functions.setter
-    def qa_functions(self, qa_functions):
+    @property
+    def tables(self):
         """
-        Set qa functions
+        :returns: table instances of the file: dict of table to dict of
+            table index to section name, built on first use
         """
 
-        self._qa_functions = qa_functions
+        if self._tables is None:
+            self._tables = get_table_instances(self.extcsv)
+        return self._tables
 
     @property
-    def qa_results(self):
+    def budget(self):
+        """
+        :returns: QaBudget the checks run under (None: unlimited)
         """
-        :returns: extcsv qa results
+
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        """
+        Set the QaBudget the checks run under
+        """
+
+        self._budget = budget
+
+    @property
+    def timeseries(self):
+        """
+        :returns: TimeSeriesStore time series checks continue the series
+            of (None: within the file only)
+        """
+
+        return self._timeseries
+
+    @timeseries.setter
+    def timeseries(self, timeseries):
+        """
+        Set the TimeSeriesStore time series checks continue the series of
         """
 
+        self._timeseries = timeseries
+
+    @property
+    def qa_results(self):
+        """
+        :returns: extcsv qa results, as nested dicts of
+            file_path -> test_id -> row -> result details (built on
+            first access)
+        """
+
+        if self._qa_results is None:
+            tests = {}
+            for test_id in self._test_order:
+                rule, rows, row_order = self._tests[test_id]
+                test = OrderedDict()
+                for row in row_order:
+                    result, related_test_result, precond_result = rows[row]
+                    test[row] = {
+                        'result': result,
+                        'table': rule.table,
+                        'table_index': rule.table_index,
+                        'element': rule.element,
+                        'related_test_id': rule.definition['related_test_id'],
+                        'related_test_result': related_test_result,
+                        'precond_result': precond_result,
+                    }
+                    if 'test_def' not in test:
+                        test['test_def'] = rule.definition
+                tests[test_id] = test
+            self._qa_results = OrderedDict([(self.file_path, tests)])
+
         return self._qa_results
 
-    @qa_results.setter
-    def qa_results(self, qa_results):
+    def test_results(self):
         """
-        Set qa results
+        Iterate over results by test, straight from the result store
+
+        :returns: generator of (test_id, test_def, list of (row, result)
+            sorted by row)
         """
 
-        self._qa_results = qa_results
+        for test_id in self._test_order:
+            rule, rows, row_order = self._tests[test_id]
+            results = sorted((row, values[0])
+                             for row, values in rows.iteritems())
+            yield test_id, rule.definition, results
+
+    def violations(self):
+        """
+        Failed checks, with consecutive failed rows of a test collapsed
+        into one row range
+
+        :returns: list of Violation objects
+        """
+
+        violations = []
+        for test_id, test_def, results in self.test_results():
+            if not is_precondition(test_id):
+                violations.extend(
+                    find_violations(test_id, test_def, results))
+        return violations
+
+    def get_metadata(self, table, field):
+        """
+        helper method: retrieve (and remember) a metadata value
+
+        :param table: table to retrieve data from
+        :param field: field to retrieve data from
+        :returns: value
+        """
+
+        key = (table, field)
+        if key not in self._metadata:
+            self._metadata[key] = get_extcsv_value(self.extcsv, table, field)
+        return self._metadata[key]
+
+    def get_test_result(self, test_id, row):
+        """
+        helper method: retrieve test result
+
+        :param test_id: test_id result to be retrieved
+        :param row: row number of the element
+        :returns: test result or None if test is n/a
+        """
+
+        test = self._tests.get(test_id)
+        if test is None:
+            return None
+        values = test[1].get(row)
+        if values is None:
+            return None
+        return values[0]
+
+    def set_test_result(self, test_id, rule, test_tok, result, row=1):
+        """
+        helper method: set qa test result
+
+        :param test_id: test_id to set
+        :param rule: QaRule of the test
+        :param test_tok: result token to set
+        :param result: result value
+        :param row: row number for which this test result applies
+
+        Results of tests over all tables of a kind share their rows:
+        a row failed in any of the tables stays failed.
+        """
+
+        try:
+            position = RESULT_TOKENS[test_tok]
+            test = self._tests.get(test_id)
+            if test is None:
+                test = self._tests[test_id] = (rule, {}, [])
+                self._test_order.append(test_id)
+            values = test[1].get(row)
+            if values is None:
+                values = test[1][row] = [None, None, None]
+                test[2].append(row)
+            elif test_tok == 'result' and rule.table_index == 'all' and \
+                    values[position] == FAIL:
+                return
+            values[position] = result
+            self._qa_results = None
+        except Exception as err:
+            msg = 'Unable to set test result. Due to: %s' % str(err)
+            LOGGER.error(msg)
+            raise err
+
+
+class QaBudget(object):
+    """
+    Wall time and memory allowed to quality assess one file.  Checks
+    stop at the first budget check past either limit.
+    """
+
+    def __init__(self, seconds=None, memory=None):
+        """
+        Initialize budget
+
+        :param seconds: wall time allowed (default: unlimited)
+        :param memory: growth of resident memory allowed, in megabytes
+            (default: unlimited)
+        """
+
+        self._seconds = seconds
+        self._memory = memory
+        self._started = False
+        self._deadline = None
+        self._baseline = None
+        self._hard_limit = False
 
     @property
-    def extcsv(self):
+    def started(self):
         """
-        :returns: extcsv
+        :returns: `bool` of whether the budget is being spent on a file
         """
 
-        return self._extcsv
+        return self._started
 
-    @extcsv.setter
-    def extcsv(self, extcsv):
+    @property
+    def seconds(self):
         """
-        Set extcsv
+        :returns: wall time allowed (None: unlimited)
         """
 
-        self._extcsv = extcsv
+        return self._seconds
 
     @property
-    def dataset(self):
+    def memory(self):
         """
-        :returns: dataset
+        :returns: growth of resident memory allowed, in megabytes
+            (None: unlimited)
         """
 
-        return self._dataset
+        return self._memory
+
+    def start(self, hard_limit=False):
+        """
+        Start spending the budget on a file; QualityChecker.check and qa
+        start and stop budgets not started by their caller
+
+        :param hard_limit: also interrupt work past HARD_LIMIT_FACTOR
+            times the time budget, wherever it is (e.g. parsing), with
+            SIGALRM.  For worker processes: must be called from the main
+            thread, and stopped with stop()
+        """
 
-    @dataset.setter
-    def dataset(self, dataset):
+        self._started = True
+        if self._seconds is not None:
+            self._deadline = time.time() + self._seconds
+        if self._memory is not None:
+            self._baseline = get_rss()
+        if hard_limit and self._seconds is not None and \
+                hasattr(signal, 'setitimer'):
+            signal.signal(signal.SIGALRM, self._interrupt)
+            signal.setitimer(signal.ITIMER_REAL,
+                             self._seconds * HARD_LIMIT_FACTOR)
+            self._hard_limit = True
+
+    def stop(self):
+        """
+        Stop spending the budget (disarms the hard limit)
+        """
+
+        if self._hard_limit:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            self._hard_limit = False
+        self._started = False
+        self._deadline = None
+        self._baseline = None
+
+    def check(self):
         """
-        Set dataset
+        Check the budget
+
+        :raises: WOUDCQaBudgetExceeded when spent
+        """
+
+        if not self._started:
+            self.start()
+        if self._deadline is not None and time.time() > self._deadline:
+            msg = 'Time budget of %ss exceeded' % self._seconds
+            raise WOUDCQaBudgetExceeded(msg, 'time')
+        if self._baseline is not None:
+            growth = (get_rss() or self._baseline) - self._baseline
+            if growth > self._memory * 1048576:
+                msg = 'Memory budget of %sMB exceeded (%sMB)' % (
+                    self._memory, growth / 1048576)
+                raise WOUDCQaBudgetExceeded(msg, 'memory')
+
+    def _interrupt(self, signum, frame):
+        """
+        helper method: SIGALRM handler of the hard time limit
+        """
+
+        self._hard_limit = False
+        msg = 'Hard time limit of %ss exceeded' % (
+            self._seconds * HARD_LIMIT_FACTOR)
+        raise WOUDCQaBudgetExceeded(msg, 'time')
+
+
+class QualityChecker(object):
+    """Quality assess WOUDC data."""
+
+    def __init__(self, rule_def_path=None, rule_pack_path=None):
         """
+        Load and compile qa rule definitions once, so that the same
+        checker can quality assess any number of files.
 
-        self._dataset = dataset
+        A rule pack compiled from the rule definitions (see
+        compile_rules) is loaded instead when it is up to date.
+        Otherwise, rule definitions are validated before compiling.
+
+        :param rule_def_path: path to qa rule definitions (optional)
+        :param rule_pack_path: path to rule pack (optional, default:
+            rule definitions path + .pack)
+        """
+
+        self._rule_path = None
+        self._rule_pack = None
+        self._fingerprint = None
+        self._qa_rules = OrderedDict()
+        self._compiled_rules = OrderedDict()
+        # TimeSeriesStore of the series time series checks continue
+        # across files, updated with each file checked (optional)
+        self.timeseries = None
+
+        if rule_def_path is not None:
+            self._rule_path = rule_def_path
+        else:
+            self._rule_path = WOUDC_QA_RULES
+
+        if rule_pack_path is None:
+            rule_pack_path = self._rule_path + RULE_PACK_EXTENSION
+
+        try:
+            loaded = self.load_rule_pack(rule_pack_path)
+            if not loaded:
+                self.load_qa_definitions()
+        except Exception as err:
+            msg = 'Unable to load definitions. Due to: %s' % str(err)
+            LOGGER.critical(msg)
+            raise err
+
+        if not loaded:
+            errors, warnings = self.validate_qa_definitions()
+            for warning in warnings:
+                LOGGER.debug(warning)
+            if errors:
+                msg = 'Rule definitions failed validation.'
+                LOGGER.critical(msg)
+                raise WOUDCQaValidationError(msg, errors)
+            self.compile_qa_definitions()
 
     @property
-    def file_path(self):
+    def qa_rules(self):
         """
-        :returns: file_path
+        :returns: extcsv qa rule definitions
         """
 
-        return self._file_path
+        return self._qa_rules
 
-    @file_path.setter
-    def file_path(self, file_path):
+    @property
+    def compiled_rules(self):
         """
-        Set file_path
+        :returns: compiled qa rules (QaRule objects) by dataset
         """
 
-        self._file_path = file_path
+        return self._compiled_rules
 
     @property
     def rule_path(self):
@@ -230,189 +683,227 @@ class QualityChecker(object):
 
         return self._rule_path
 
-    @rule_path.setter
-    def rule_path(self, rule_path):
+    @property
+    def fingerprint(self):
         """
-        Set rule_path
+        :returns: fingerprint (SHA-256) of the loaded rule definitions
         """
 
-        self._rule_path = rule_path
+        return self._fingerprint
 
-    def execute(self):
+    @property
+    def rule_pack(self):
         """
-        orchestrate qa rules execution
+        :returns: path to the rule pack rules were loaded from, or None
+            if loaded from the rule definitions
+        """
+
+        return self._rule_pack
 
-        1) load up the rule definitions
-        2) check precond
-        3) check related tests
-        4) run qa tests
-        5) store qa results
+    def check(self, extcsv, file_path=None, pool=None, budget=None):
         """
-        # 1) load up the rule definitions
+        Quality assess one file
+
+        :param extcsv: woudc_extcsv Reader object
+            containing WOUDC data to be qa'd
+        :param file_path: path to file (optional)
+        :param pool: ColumnPool of this checker, to evaluate profile
+            checks of large files in worker processes (optional)
+        :param budget: QaBudget to stop checking the file at (optional)
+        :returns: QaResult object
+        :raises: WOUDCQaBudgetExceeded, with the results so far, when the
+            budget is spent
+        """
+
+        if budget is not None and not budget.started:
+            budget.start()
+            try:
+                return self.check(extcsv, file_path, pool, budget)
+            finally:
+                budget.stop()
+
+        result = QaResult(extcsv, file_path, self.fingerprint)
+        result.budget = budget
+        result.timeseries = self.timeseries
         try:
-            self.load_qa_definitions()
+            if pool is not None:
+                result.outcomes = pool.evaluate(result)
+            result.outcomes.update(evaluate_arrays(
+                result, self.compiled_rules.get(result.dataset, []),
+                result.outcomes))
+            self.execute(result)
+            if self.timeseries is not None:
+                self.timeseries.add_file(
+                    result, self.compiled_rules.get(result.dataset, []))
+        except WOUDCQaBudgetExceeded as err:
+            LOGGER.warning('Stopped qa of %s. Due to: %s' %
+                           (result.file_path, err))
+            err.qa_result = result
+            raise err
         except Exception as err:
-            msg = 'Unable to load definitions. Due to: %s' % str(err)
+            msg = 'Unable to execute qa. Due to: %s' % str(err)
             LOGGER.critical(msg)
             raise err
+
+        return result
+
+    def execute(self, qa_result):
+        """
+        orchestrate qa rules execution
+
+        1) check precond
+        2) check related tests
+        3) run qa tests
+        4) store qa results
+
+        :param qa_result: QaResult object to run qa against
+        """
+
         # get qa rules for this dataset
-        if self.dataset not in self.qa_rules.keys():
-            msg = 'No Qa rules defined for dataset: %s' % self.dataset
+        if qa_result.dataset not in self.compiled_rules:
+            msg = 'No Qa rules defined for dataset: %s' % qa_result.dataset
             LOGGER.error(msg)
             raise KeyError(msg)
-        else:
-            qa_rules = self.qa_rules[self.dataset]
-            for rule in qa_rules:
-                # check rule status
-                rule_status = rule['test_status']
-                if rule_status == '1':
-                    result = None
-                    continue_testing = False
-                    profile = False
-                    if rule['profile'] == '1':
-                        profile = True
-                    if rule['table_index'] == '':
-                        rule['table_index'] = 1
-                    if all([rule['table_index'] != '',
-                            rule['table_index'] != 'all'
-                            ]):
-                            rule['table_index'] = int(rule['table_index'])
-                    # setup flag map
-                    poss_results = rule['test_results'].split('|')
-                    flag_map = {
-                        True: None,
-                        False: None,
-                        'Error': 'Error'
-                    }
-                    if len(poss_results) == 2:
-                        flag_map = {
-                            True: poss_results[1],
-                            False: poss_results[0]
-                        }
-                    if len(poss_results) == 1:
-                        flag_map = {
-                            True: poss_results[0]
-                        }
-                    # 2) check pre-condidtions
+
+        budget = qa_result.budget
+        for rule in self.compiled_rules[qa_result.dataset]:
+            # check rule status
+            if not rule.status:
+                continue
+            if budget is not None:
+                budget.check()
+            result = None
+            continue_testing = False
+            # 1) check pre-condidtions
+            try:
+                result = self.check_preconditions(qa_result, rule)
+            except Exception as err:
+                msg = 'Unable to run test_id: %s.\
+                    Due to: preconditions unable to run.' % rule.test_id
+                LOGGER.error(msg)
+                # if test fails to run, store NR for the test
+                result = 'NR'
+            # store result
+            try:
+                qa_result.set_test_result(rule.test_id, rule,
+                                          'precond_result', result)
+            except Exception as err:
+                msg = 'Unable to set precondition test result.\
+                Due to: %s' % str(err)
+                LOGGER.error(msg)
+                continue
+            if any([result is None, result is True]):
+                continue_testing = True
+
+            # 2) check related test
+            if continue_testing:
+                result = None
+                continue_testing = False
+                # check if this rule is for profile field or not
+                # profile r tests needs to be run one per each row
+                row = 1
+                if not rule.profile:
                     try:
-                        result = self.check_preconditions(rule)
+                        result = self.check_related_test(qa_result, rule,
+                                                         row)
                     except Exception as err:
                         msg = 'Unable to run test_id: %s.\
-                            Due to: preconditions unable to run.'\
-                            % rule['test_id']
+                            Due to: related test unable to run.' % \
+                            rule.test_id
                         LOGGER.error(msg)
-                        # if test fails to run, store NR for the test
                         result = 'NR'
                     # store result
                     try:
-                        self._set_test_result(rule['test_id'], rule,
-                                              'precond_result', result)
+                        qa_result.set_test_result(rule.test_id, rule,
+                                                  'related_test_result',
+                                                  result)
                     except Exception as err:
-                        msg = 'Unable to set precondition test result.\
+                        msg = 'Unable to set related test result.\
                         Due to: %s' % str(err)
                         LOGGER.error(msg)
                         continue
                     if any([result is None, result is True]):
                         continue_testing = True
-
-                    # 2) check related test
-                    if continue_testing:
-                        result = None
-                        continue_testing = False
-                        # check if this rule is for profile field or not
-                        # profile r tests needs to be run one per each row
-                        row = 1
-                        if not profile:
-                            try:
-                                result = self.check_related_test(rule, row)
-                            except Exception as err:
-                                msg = 'Unable to run test_id: %s.\
-                                    Due to: related test unable to run.' % \
-                                    rule['test_id']
-                                LOGGER.error(msg)
-                                result = 'NR'
-                            # store result
-                            try:
-                                self._set_test_result(rule['test_id'], rule,
-                                                      'related_test_result',
-                                                      result)
-                            except Exception as err:
-                                msg = 'Unable to set related test result.\
-                                Due to: %s' % str(err)
-                                LOGGER.error(msg)
-                                continue
-                            if any([result is None, result is True]):
-                                continue_testing = True
-                        else:
-                            continue_testing = True
-
-                    # precond tests checked successfully
-                    # related tests checked successfully (non-profile)
-                    # check qa tests
-                    if continue_testing:
-                        result = None
-                        # figure some stuff out
-                        test_cate = rule['test_category']
-                        # handle test categories
-                        if test_cate == 'presence':
-                            self.do_presence_check(rule, profile, flag_map)
-                        elif test_cate == 'range':
-                            self.do_range_check(rule, profile, flag_map)
-                        elif test_cate == 'step':
-                            self.do_step_check(rule, profile, flag_map)
-
-    def do_step_check(self, rule, profile, flag_map):
+                else:
+                    continue_testing = True
+
+            # precond tests checked successfully
+            # related tests checked successfully (non-profile)
+            # 3) check qa tests
+            if continue_testing:
+                # handle test categories
+                if rule.category == 'presence':
+                    self.do_presence_check(qa_result, rule)
+                elif rule.category in ['range', 'statistical',
+                                       'timeseries', 'scan']:
+                    # statistical, time series and scan outcomes are
+                    # evaluated over whole columns beforehand, then
+                    # stored as range outcomes
+                    self.do_range_check(qa_result, rule)
+                elif rule.category == 'step':
+                    self.do_step_check(qa_result, rule)
+                elif rule.category == 'consistency':
+                    self.do_consistency_check(qa_result, rule)
+
+    def do_step_check(self, qa_result, rule):
         """
         do step check
         """
+
         result = None
-        # unpackge rule
-        table = rule['table']
-        table_index = rule['table_index']
-        field = rule['element']
-        function = rule['function']
-        param_a = rule['function_parameter_a']
+        budget = qa_result.budget
         # handle table index
-        a, b = get_table_ranges(self.extcsv, table, table_index)
+        a, b = get_table_ranges(qa_result.extcsv, rule.table,
+                                rule.table_index)
         for ti in range(a, b):
-            # get value from extcsv
-            try:
-                value = \
-                    get_extcsv_value(self.extcsv, table, field, ti,
-                                     payload=profile)
-            except KeyError:
-                msg = \
-                    'Unable to get value at Table: %s,\
-                    table index: %s,\
-                    field: %s'\
-                    % (table, ti, field)
-                LOGGER.info(msg)
-                continue
-            if profile:
+            # precomputed outcomes stand in for the values
+            outcomes = qa_result.outcomes.get((rule.test_id, ti))
+            if outcomes is not None:
+                value = outcomes
+            else:
+                # get value from extcsv
+                try:
+                    value = \
+                        get_extcsv_value(qa_result.extcsv, rule.table,
+                                         rule.element, ti,
+                                         payload=rule.profile)
+                except KeyError:
+                    msg = \
+                        'Unable to get value at Table: %s,\
+                        table index: %s,\
+                        field: %s'\
+                        % (rule.table, ti, rule.element)
+                    LOGGER.info(msg)
+                    continue
+            if rule.profile:
                 # get related tests
                 row = 0
                 val_len = len(value)
                 while row < val_len - 3:
+                    if budget is not None and not row % BUDGET_CHECK_ROWS:
+                        budget.check()
                     continue_testing = False
+                    this_row_result = None
+                    next_row_result = None
                     try:
                         # got to check row-1 and row
                         this_row_result =\
-                            self.check_related_test(rule, row)
+                            self.check_related_test(qa_result, rule, row)
                         next_row_result =\
-                            self.check_related_test(rule, row + 1)
+                            self.check_related_test(qa_result, rule, row + 1)
                     except Exception as err:
                         msg = 'Unable to run test_id: %s.\
                             Due to: related test unable to run.'\
-                            % rule['test_id']
+                            % rule.test_id
                         LOGGER.error(msg)
                         result = 'NR'
                     # store result
                     if all([this_row_result is True, next_row_result is True]):
                         result = True
                     try:
-                        self._set_test_result(rule['test_id'], rule,
-                                              'related_test_result', result,
-                                              row + 1)
+                        qa_result.set_test_result(rule.test_id, rule,
+                                                  'related_test_result',
+                                                  result, row + 1)
                     except Exception as err:
                         msg = 'Unable to set related test result.\
                         Due to: %s' % str(err)
@@ -423,100 +914,87 @@ class QualityChecker(object):
                         # if result:
                         continue_testing = True
                     if continue_testing:
-                        try:
-                            t_result = None
-                            # determine type of step check
-                            if function == 'TS_0':
-                                t_result =\
-                                    self._function_ts_0(value[row],
-                                                        value[row + 1],
-                                                        param_a)
-                            elif function == 'TS_2':
-                                t_result = self._function_ts_2(value[row],
-                                                               value[row + 1],
-                                                               param_a)
-                            else:
-                                msg = 'Unrecognized step check function: %s.\
-                                for test_id: %s' % (function, rule['test_id'])
-                                LOGGER.error(msg)
-                                t_result = 'Error'
-                            t_result = flag_map[t_result]
-                        except Exception as err:
-                            msg = 'Unable to do step check for test_id: %s. \
-                                Due to: %s' % (rule['test_id'], str(err))
-                            LOGGER.error(msg)
-                            t_result = 'Error'
+                        if outcomes is not None:
+                            outcome = OUTCOMES[outcomes[row]]
+                        else:
+                            outcome = self.step_outcome(rule, value[row],
+                                                        value[row + 1])
+                        t_result = self._flag_outcome(rule, outcome)
 
                         try:
-                            self._set_test_result(rule['test_id'],
-                                                  rule,
-                                                  'result',
-                                                  t_result,
-                                                  row + 1
-                                                  )
-                            if row == val_len - 2:
-                                self._set_test_result(rule['test_id'],
+                            qa_result.set_test_result(rule.test_id,
                                                       rule,
                                                       'result',
-                                                      t_result, row + 2
+                                                      t_result,
+                                                      row + 1
                                                       )
+                            if row == val_len - 2:
+                                qa_result.set_test_result(rule.test_id,
+                                                          rule,
+                                                          'result',
+                                                          t_result, row + 2
+                                                          )
                         except Exception as err:
                             msg = 'Unable to set test result for test id: %s \
-                            Due to: %s' % (rule['test_id'], str(err))
+                            Due to: %s' % (rule.test_id, str(err))
                             LOGGER.error(msg)
                             pass
 
                     row += 1
 
-    def do_range_check(self, rule, profile, flag_map):
+    def do_range_check(self, qa_result, rule):
         """
         do range check.
         """
+
         result = None
-        # unpackge rule
-        table = rule['table']
-        table_index = rule['table_index']
-        field = rule['element']
-        function = rule['function']
-        param_a = rule['function_parameter_a']
-        param_b = rule['function_parameter_b']
+        budget = qa_result.budget
         # handle table index
-        a, b = get_table_ranges(self.extcsv, table, table_index)
+        a, b = get_table_ranges(qa_result.extcsv, rule.table,
+                                rule.table_index)
         for ti in range(a, b):
-            # get value from extcsv
-            try:
-                value = \
-                    get_extcsv_value(self.extcsv, table, field, ti,
-                                     payload=profile)
-            except KeyError:
-                msg = \
-                    'Unable to get value at Table: %s,\
-                    table index: %s,\
-                    field: %s'\
-                % (table, ti, field)
-                LOGGER.info(msg)
-                continue
-            if profile:
+            # precomputed outcomes stand in for the values
+            outcomes = qa_result.outcomes.get((rule.test_id, ti))
+            if outcomes is not None:
+                value = outcomes
+            else:
+                # get value from extcsv
+                try:
+                    value = \
+                        get_extcsv_value(qa_result.extcsv, rule.table,
+                                         rule.element, ti,
+                                         payload=rule.profile)
+                except KeyError:
+                    msg = \
+                        'Unable to get value at Table: %s,\
+                        table index: %s,\
+                        field: %s'\
+                        % (rule.table, ti, rule.element)
+                    LOGGER.info(msg)
+                    continue
+            if rule.profile:
                 # get related tests
                 row = 1
                 for val in value:
+                    if budget is not None and not row % BUDGET_CHECK_ROWS:
+                        budget.check()
                     continue_testing = False
                     try:
-                        result = self.check_related_test(rule, row)
+                        result = self.check_related_test(qa_result, rule, row)
                     except Exception as err:
                         msg = 'Unable to run test_id: %s.\
                             Due to: related test unable to run.' %\
-                            rule['test_id']
+                            rule.test_id
                         LOGGER.error(msg)
                         result = 'NR'
                     # store result
                     try:
-                        self._set_test_result(rule['test_id'],
-                                              rule,
-                                              'related_test_result',
-                                              result,
-                                              row
-                                              )
+                        qa_result.set_test_result(rule.test_id,
+                                                  rule,
+                                                  'related_test_result',
+                                                  result,
+                                                  row
+                                                  )
                     except Exception as err:
                         msg = 'Unable to set related test result.\
                         Due to: %s' % str(err)
@@ -526,122 +1004,287 @@ class QualityChecker(object):
                     if any([result is None, result is True]):
                         continue_testing = True
                     if continue_testing:
+                        if outcomes is not None:
+                            outcome = OUTCOMES[outcomes[row - 1]]
+                            if outcome is None:
+                                # nothing to check the row against (e.g.
+                                # the first value of a time series)
+                                row += 1
+                                continue
+                            t_result = self._flag_outcome(rule, outcome)
+                        else:
+                            t_result = self._run_range_function(rule, val)
                         try:
-                            t_result = None
-                            # determine type of range check
-                            if function == 'RC_1':
-                                t_result = self._function_rc_1(param_a,
-                                                               param_b,
-                                                               val
-                                                               )
-                            elif function == 'RC_5':
-                                t_result = self._function_rc_5(param_a, val)
-                            elif function == 'RC_6':
-                                t_result = self._function_rc_6(param_a, val)
-                            else:
-                                msg = 'Unrecognized range check function: %s.\
-                                    for test_id: %s' %\
-                                    (function, rule['test_id'])
-                                LOGGER.error(msg)
-                                t_result = 'Error'
-                            t_result = flag_map[t_result]
-                        except Exception as err:
-                            msg = 'Unable to do range check for test_id: %s. \
-                                Due to: %s' % (rule['test_id'], str(err))
-                            LOGGER.error(msg)
-                            t_result = 'Error'
-                        try:
-                            self._set_test_result(rule['test_id'],
-                                                  rule,
-                                                  'result',
-                                                  t_result,
-                                                  row
-                                                  )
+                            qa_result.set_test_result(rule.test_id,
+                                                      rule,
+                                                      'result',
+                                                      t_result,
+                                                      row
+                                                      )
                         except Exception as err:
                             msg = 'Unable to set test result for test id: %s \
-                                Due to: %s' % (rule['test_id'], str(err))
+                                Due to: %s' % (rule.test_id, str(err))
                             LOGGER.error(msg)
                             continue
                     row += 1
             else:
+                t_result = self._run_range_function(rule, value)
                 try:
-                    t_result = None
-                    # determine type of range check
-                    if function == 'RC_1':
-                        t_result = self._function_rc_1(param_a, param_b, value)
-                    elif function == 'RC_5':
-                        t_result = self._function_rc_5(param_a, value)
-                    elif function == 'RC_6':
-                        t_result = self._function_rc_6(param_a, value)
-                    else:
-                        msg = 'Unrecognized range check function: %s.\
-                        for test_id: %s' % (function, rule['test_id'])
-                        LOGGER.error(msg)
-                        t_result = 'Error'
-                    t_result = flag_map[t_result]
-                except Exception as err:
-                    msg = 'Unable to do range check for test_id: %s.\
-                        Due to: %s' % (rule['test_id'], str(err))
-                    LOGGER.error(msg)
-                    t_result = 'Error'
-                    # continue
-                try:
-                    self._set_test_result(rule['test_id'], rule, 'result',
-                                          t_result, ti)
+                    qa_result.set_test_result(rule.test_id, rule, 'result',
+                                              t_result, ti)
                 except Exception as err:
                     msg = 'Unable to set test result for test id: %s \
-                    Due to: %s' % (rule['test_id'], str(err))
+                    Due to: %s' % (rule.test_id, str(err))
                     pass
                     LOGGER.error(msg)
 
-    def do_presence_check(self, rule, profile, flag_map):
+    def _run_range_function(self, rule, value):
+        """
+        helper method: evaluate a range check function against one value
+
+        :param rule: QaRule of the test
+        :param value: value under assessment
+        :returns: flagged test result
+        """
+
+        return self._flag_outcome(rule, self.range_outcome(rule, value))
+
+    def range_outcome(self, rule, value):
+        """
+        Evaluate a range check function against one value
+
+        :param rule: QaRule of the test
+        :param value: value under assessment
+        :returns: outcome (True, False or 'Error')
+        """
+
+        try:
+            # determine type of range check
+            if rule.function == 'RC_1':
+                return self._function_rc_1(rule.param_a, rule.param_b, value)
+            elif rule.function == 'RC_5':
+                return self._function_rc_5(rule.param_a, value)
+            elif rule.function == 'RC_6':
+                return self._function_rc_6(rule.param_a, value)
+            elif rule.function in ARRAY_ONLY_FUNCTIONS:
+                msg = 'Range check function %s runs over whole profile \
+                    columns only, for test_id: %s' % (
+                    rule.function, rule.test_id)
+                LOGGER.error(msg)
+                return 'Error'
+            elif rule.category in ['statistical', 'timeseries', 'scan']:
+                msg = '%s check function %s runs over whole \
+                    profile columns only, for test_id: %s' % (
+                    rule.category, rule.function, rule.test_id)
+                LOGGER.error(msg)
+                return 'Error'
+            msg = 'Unrecognized range check function: %s.\
+                for test_id: %s' % (rule.function, rule.test_id)
+            LOGGER.error(msg)
+        except Exception as err:
+            msg = 'Unable to do range check for test_id: %s. \
+                Due to: %s' % (rule.test_id, str(err))
+            LOGGER.error(msg)
+
+        return 'Error'
+
+    def step_outcome(self, rule, value, next_value):
+        """
+        Evaluate a step check function against two consecutive values
+
+        :param rule: QaRule of the test
+        :param value: value under assessment
+        :param next_value: value of the next row
+        :returns: outcome (True, False or 'Error')
+        """
+
+        try:
+            # determine type of step check
+            if rule.function == 'TS_0':
+                return self._function_ts_0(value, next_value, rule.param_a)
+            elif rule.function == 'TS_2':
+                return self._function_ts_2(value, next_value, rule.param_a)
+            elif rule.function == 'TS_3':
+                return self._function_ts_3(value, next_value)
+            elif rule.function == 'TS_4':
+                return self._function_ts_3(next_value, value)
+            elif rule.function == 'TS_5':
+                return self._function_ts_5(value, next_value)
+            elif rule.function == 'TS_6':
+                return self._function_ts_5(next_value, value)
+            elif rule.function in ARRAY_ONLY_FUNCTIONS:
+                msg = 'Step check function %s runs over whole profile \
+                    columns only, for test_id: %s' % (
+                    rule.function, rule.test_id)
+                LOGGER.error(msg)
+                return 'Error'
+            msg = 'Unrecognized step check function: %s.\
+                for test_id: %s' % (rule.function, rule.test_id)
+            LOGGER.error(msg)
+        except Exception as err:
+            msg = 'Unable to do step check for test_id: %s. \
+                Due to: %s' % (rule.test_id, str(err))
+            LOGGER.error(msg)
+
+        return 'Error'
+
+    def do_consistency_check(self, qa_result, rule):
+        """
+        do consistency check: a value against an aggregate of a profile
+        column of the same table index
+        """
+
+        # handle table index
+        a, b = get_table_ranges(qa_result.extcsv, rule.table,
+                                rule.table_index)
+        for ti in range(a, b):
+            try:
+                value = get_extcsv_value(qa_result.extcsv, rule.table,
+                                         rule.element, ti)
+            except KeyError:
+                msg = 'Unable to get value at Table: %s, table index: %s, \
+                    field: %s' % (rule.table, ti, rule.element)
+                LOGGER.info(msg)
+                continue
+            t_result = self._flag_outcome(
+                rule, self.consistency_outcome(qa_result, rule, value, ti))
+            try:
+                qa_result.set_test_result(rule.test_id, rule, 'result',
+                                          t_result, ti)
+            except Exception as err:
+                msg = 'Unable to set test result for test id: %s \
+                Due to: %s' % (rule.test_id, str(err))
+                LOGGER.error(msg)
+
+    def consistency_outcome(self, qa_result, rule, value, table_index):
+        """
+        Evaluate a consistency check function against one value
+
+        :param qa_result: QaResult object
+        :param rule: QaRule of the test
+        :param value: value under assessment
+        :param table_index: table index of the value, and of the column
+            it is checked against
+        :returns: outcome (True, False or 'Error')
+        """
+
+        try:
+            table, field = _split_reference(rule.table, rule.param_c)
+            if rule.function in ['CC_4', 'CC_5']:
+                # against a single value of the same table instance (e.g.
+                # derived by the handler)
+                section = qa_result.tables.get(table, {}).get(table_index)
+                reference = None
+                if section is not None:
+                    reference = qa_result.extcsv.sections[section].get(field)
+                if reference is None:
+                    msg = 'Unable to find %s.%s for test_id: %s' % (
+                        table, field, rule.test_id)
+                    LOGGER.error(msg)
+                    return 'Error'
+                if rule.function == 'CC_4':
+                    return self._function_cc(value, float(reference),
+                                             rule.param_a, relative=True)
+                return self._function_cc(value, float(reference),
+                                         rule.param_a, relative=True,
+                                         b=rule.param_b)
+            column = qa_result.arrays.column(table, table_index, field)
+            if column is None:
+                msg = 'Unable to find table %s %s for test_id: %s' % (
+                    table, table_index, rule.test_id)
+                LOGGER.error(msg)
+                return 'Error'
+            values, valid = column
+            # determine type of consistency check
+            if rule.function == 'CC_1':
+                reference = len(values)
+            elif rule.function in ['CC_2', 'CC_3'] and valid.any():
+                if rule.function == 'CC_2':
+                    reference = values[valid].min()
+                else:
+                    reference = values[valid].max()
+            elif rule.function in ['CC_2', 'CC_3']:
+                msg = 'No values of %s.%s for test_id: %s' % (
+                    table, field, rule.test_id)
+                LOGGER.error(msg)
+                return 'Error'
+            else:
+                msg = 'Unrecognized consistency check function: %s.\
+                    for test_id: %s' % (rule.function, rule.test_id)
+                LOGGER.error(msg)
+                return 'Error'
+            return self._function_cc(value, reference, rule.param_a)
+        except Exception as err:
+            msg = 'Unable to do consistency check for test_id: %s. \
+                Due to: %s' % (rule.test_id, str(err))
+            LOGGER.error(msg)
+
+        return 'Error'
+
+    def _flag_outcome(self, rule, outcome):
+        """
+        helper method: map a test outcome to its flag
+
+        :param rule: QaRule of the test
+        :param outcome: outcome (True, False or 'Error')
+        :returns: flagged test result
+        """
+
+        try:
+            return rule.flag_map[outcome]
+        except Exception as err:
+            msg = 'Unable to do %s check for test_id: %s. \
+                Due to: %s' % (rule.category, rule.test_id, str(err))
+            LOGGER.error(msg)
+            return 'Error'
+
+    def do_presence_check(self, qa_result, rule):
         """
         do presence check.
         """
 
         result = None
-        # unpackge rule
-        table = rule['table']
-        table_index = rule['table_index']
-        field = rule['element']
-        function = rule['function']
+        budget = qa_result.budget
         # handle table index
-        a, b = get_table_ranges(self.extcsv, table, table_index)
+        a, b = get_table_ranges(qa_result.extcsv, rule.table,
+                                rule.table_index)
         for ti in range(a, b):
             # get value from extcsv
             try:
                 value = \
-                    get_extcsv_value(self.extcsv, table, field, ti,
-                                     payload=profile)
+                    get_extcsv_value(qa_result.extcsv, rule.table,
+                                     rule.element, ti, payload=rule.profile)
             except KeyError:
                 msg = \
                     'Unable to get value at Table: %s,\
                     table index: %s,\
                     field: %s'\
-                    % (table, ti, field)
+                    % (rule.table, ti, rule.element)
                 LOGGER.info(msg)
                 continue
-            if profile:
+            if rule.profile:
                 # get related tests
                 row = 1
                 for val in value:
+                    if budget is not None and not row % BUDGET_CHECK_ROWS:
+                        budget.check()
                     continue_testing = False
                     try:
-                        result = self.check_related_test(rule, row)
+                        result = self.check_related_test(qa_result, rule, row)
                     except Exception as err:
                         msg = 'Unable to run test_id: %s.\
                             Due to: related test unable to run.' %\
-                            rule['test_id']
+                            rule.test_id
                         LOGGER.error(msg)
                         result = 'NR'
                     # store result
                     try:
-                        self._set_test_result(rule['test_id'],
-                                              rule,
-                                              'related_test_result',
-                                              result,
-                                              row
-                                              )
+                        qa_result.set_test_result(rule.test_id,
+                                                  rule,
+                                                  'related_test_result',
+                                                  result,
+                                                  row
+                                                  )
                     except Exception as err:
                         msg = 'Unable to set related test result.\
                         Due to: %s' % str(err)
@@ -651,302 +1294,247 @@ class QualityChecker(object):
                     if any([result is None, result is True]):
                         continue_testing = True
                     if continue_testing:
+                        t_result = self._run_presence_function(rule, val)
                         try:
-                            t_result = None
-                            if function == 'PR_1':
-                                t_result = self._function_pc_1(val)
-                            else:
-                                msg = 'Unrecognized presence check function: %s\
-                                in test_id: %s' % (function, rule['test_id'])
-                                LOGGER.error(msg)
-                                t_result = 'Error'
-                            t_result = flag_map[t_result]
-                        except Exception as err:
-                            msg = 'Unable to do presence check for test_id: %s. \
-                                Due to: %s' % (rule['test_id'], str(err))
-                            LOGGER.error(msg)
-                            t_result = 'Error'
-                        try:
-                            self._set_test_result(rule['test_id'],
-                                                  rule,
-                                                  'result',
-                                                  t_result,
-                                                  row
-                                                  )
+                            qa_result.set_test_result(rule.test_id,
+                                                      rule,
+                                                      'result',
+                                                      t_result,
+                                                      row
+                                                      )
                         except Exception as err:
                             msg = 'Unable to set test result for test id: %s \
-                            Due to: %s' % (rule['test_id'], str(err))
+                            Due to: %s' % (rule.test_id, str(err))
                             LOGGER.error(msg)
                             pass
                     row += 1
             else:
+                t_result = self._run_presence_function(rule, value)
                 try:
-                    t_result = None
-                    if function == 'PR_1':
-                        t_result = self._function_pc_1(value)
-                    else:
-                        msg = 'Unrecognized presence check function: %s\
-                        in test_id: %s' % (function, rule['test_id'])
-                        LOGGER.error(msg)
-                        t_result = 'Error'
-                    t_result = flag_map[t_result]
-                except Exception as err:
-                    msg = 'Unable to do presence check for test_id: %s. \
-                        Due to: %s' % (rule['test_id'], str(err))
-                    LOGGER.error(msg)
-                    t_result = 'Error'
-                try:
-                    self._set_test_result(rule['test_id'], rule, 'result',
-                                          t_result, ti)
+                    qa_result.set_test_result(rule.test_id, rule, 'result',
+                                              t_result, ti)
                 except Exception as err:
                     msg = 'Unable to set test result for test id: %s \
-                    Due to: %s' % (rule['test_id'], str(err))
+                    Due to: %s' % (rule.test_id, str(err))
                     LOGGER.error(msg)
                     pass
 
+    def _run_presence_function(self, rule, value):
+        """
+        helper method: evaluate a presence check function against one value
+
+        :param rule: QaRule of the test
+        :param value: value under assessment
+        :returns: flagged test result
+        """
+
+        try:
+            t_result = None
+            if rule.function == 'PR_1':
+                t_result = self._function_pc_1(value)
+            else:
+                msg = 'Unrecognized presence check function: %s\
+                in test_id: %s' % (rule.function, rule.test_id)
+                LOGGER.error(msg)
+                t_result = 'Error'
+            t_result = rule.flag_map[t_result]
+        except Exception as err:
+            msg = 'Unable to do presence check for test_id: %s. \
+                Due to: %s' % (rule.test_id, str(err))
+            LOGGER.error(msg)
+            t_result = 'Error'
+
+        return t_result
+
     def load_qa_definitions(self):
         """
         Load qa rules, functions and flag definitions
         """
+
         # load qa rules
         with open(self.rule_path, 'rb') as qa_def_csv:
-            rows = csv.reader(qa_def_csv)
-            header = []
-            i = 0
-            for row in rows:
-                dataset = None
-                rule = {}
-                j = 0
-                for val in row:
-                    if i == 0:
-                        header.append(val)
+            content = qa_def_csv.read()
+        self._fingerprint = hashlib.sha256(content).hexdigest()
+
+        rows = csv.reader(StringIO(content))
+        header = []
+        i = 0
+        for row in rows:
+            dataset = None
+            rule = {}
+            j = 0
+            for val in row:
+                if i == 0:
+                    header.append(val)
+                else:
+                    if j == 0:  # dataset
+                        dataset = val
+                        if dataset not in self.qa_rules.keys():
+                            self.qa_rules[dataset] = []
                     else:
-                        if j == 0:  # dataset
-                            dataset = val
-                            if dataset not in self.qa_rules.keys():
-                                self.qa_rules[dataset] = []
-                        else:
-                            rule_tok = header[j]
-                            if rule_tok not in rule.keys():
-                                rule[rule_tok] = val
-                    j += 1
-                if len(rule) != 0:
-                    self.qa_rules[dataset].append(rule)
+                        rule_tok = header[j]
+                        if rule_tok not in rule.keys():
+                            rule[rule_tok] = val
+                j += 1
+            if len(rule) != 0:
+                self.qa_rules[dataset].append(rule)
+
+            i += 1
+
+    def load_rule_pack(self, rule_pack_path):
+        """
+        Load compiled qa rules from a rule pack, if up to date with the
+        rule definitions
+
+        :param rule_pack_path: path to rule pack
+        :returns: boolean of whether the rule pack was loaded
+        """
+
+        with open(self.rule_path, 'rb') as qa_def_csv:
+            fingerprint = hashlib.sha256(qa_def_csv.read()).hexdigest()
+
+        rules = read_rule_pack(rule_pack_path, fingerprint, QaRule)
+        if rules is None:
+            return False
+
+        self._qa_rules, self._compiled_rules = rules
+        self._fingerprint = fingerprint
+        self._rule_pack = rule_pack_path
+        return True
+
+    def save_rule_pack(self, rule_pack_path=None):
+        """
+        Save compiled qa rules to a rule pack
+
+        :param rule_pack_path: path to rule pack (optional, default:
+            rule definitions path + .pack)
+        :returns: path to rule pack
+        """
+
+        if rule_pack_path is None:
+            rule_pack_path = self.rule_path + RULE_PACK_EXTENSION
+        write_rule_pack(rule_pack_path, self.fingerprint, self.qa_rules,
+                        self.compiled_rules)
+        return rule_pack_path
+
+    def validate_qa_definitions(self):
+        """
+        Validate loaded qa rule definitions
+
+        :returns: tuple of lists of errors (rules that cannot be
+            compiled or resolved) and warnings (rules that will not run
+            as defined)
+        """
+
+        errors = []
+        warnings = []
+        for dataset, rules in self.qa_rules.iteritems():
+            test_ids = set(rule.get('test_id') for rule in rules)
+            seen = set()
+            for i, rule in enumerate(rules):
+                prefix = '%s rule %s (test_id %s)' % (
+                    dataset, i + 1, rule.get('test_id'))
+                missing = [token for token in QA_RULE_TOKENS
+                           if rule.get(token) is None]
+                if missing:
+                    errors.append('%s: missing %s' % (prefix,
+                                                      ', '.join(missing)))
+                    continue
+                rule_errors, rule_warnings = \
+                    _validate_rule(rule, test_ids, seen)
+                errors.extend(['%s: %s' % (prefix, error)
+                               for error in rule_errors])
+                warnings.extend(['%s: %s' % (prefix, warning)
+                                 for warning in rule_warnings])
+                seen.add(rule['test_id'])
+
+        return errors, warnings
+
+    def compile_qa_definitions(self):
+        """
+        Compile loaded qa rule definitions into QaRule objects
+        """
 
-                i += 1
+        for dataset, rules in self.qa_rules.iteritems():
+            compiled = [QaRule(rule) for rule in rules]
+            index = {}
+            for rule in compiled:
+                index.setdefault(rule.test_id, rule)
+            for rule in compiled:
+                rule.resolve_related_tests(index)
+            self.compiled_rules[dataset] = compiled
 
-    def check_related_test(self, rule, row):
+    def check_related_test(self, qa_result, rule, row):
         """
         check related test
 
-        :param rule: rule tokens
+        :param qa_result: QaResult object
+        :param rule: QaRule of the test
+        :param row: row number of the element
         :returns: boolean (pass/fail) or None (unable to check)
         """
 
         result = None
-        if all(['related_test_id' not in rule.keys(),
-                'related_test_status' not in rule.keys()]):
-            return result
-        else:
-            # retrieve related test result
-            r_test_id = rule['related_test_id'].split(',')
-            r_test_result = rule['related_test_result'].split(',')
-            if any([r_test_id == [''],
-                    r_test_result == [''],
-                    len(r_test_id) == 0,
-                    len(r_test_result) == 0]):
-                return result
-            try:
-                result = None
-                for rtid in r_test_id:
-                    if self._get_rule(rtid.strip(), 'profile') == '0':
-                        row = 1
-                    result = self._get_test_result(rtid, row)
-                    rtr = r_test_result[r_test_id.index(rtid)].strip()
-                    if result == (rtr):
-                        result = True
-                    else:
-                        return False
-            except Exception as err:
-                LOGGER.error(str(err))
-                raise err
+        for rtid, expected, non_profile in rule.related:
+            if expected is None:
+                msg = 'No related test result defined for related test: %s'\
+                    % rtid
+                LOGGER.error(msg)
+                raise ValueError(msg)
+            if non_profile:
+                result = qa_result.get_test_result(rtid, 1)
+            else:
+                result = qa_result.get_test_result(rtid, row)
+            if result == expected:
+                result = True
+            else:
+                return False
 
         return result
 
-    def check_preconditions(self, rule):
+    def check_preconditions(self, qa_result, rule):
         """
         check preconditions
         if all precond are met, return True else False
 
-        :param rule: rule package
+        :param qa_result: QaResult object
+        :param rule: QaRule of the test
         :returns: boolean or None (unable to check)
         """
-        # store precondition results
-        result = {
-            'agency': None,
-            'platform': None,
-            'instrument_type': None,
-            'instrument_model': None,
-            'instrument_serial': None,
-            'instrument_lat': None,
-            'instrument_lon': None
-        }
-        # agency
-        if 'agency' not in rule.keys():
-            result.pop('agency')
-        else:
-            agency = rule['agency']
-            if agency == '':
-                result.pop('agency')
-            else:
-                try:
-                    agency_f = \
-                        get_extcsv_value(self.extcsv, 'DATA_GENERATION',
-                                         'Agency')
-                except Exception as err:
-                    msg = str(err)
-                    LOGGER.error(msg)
-                    result['agency'] = None
-                if agency == agency_f:
-                    result['agency'] = True
-                else:
-                    result['agency'] = False
-        # platform
-        if 'platform' not in rule.keys():
-            result.pop('platform')
-        else:
-            platform = rule['platform']
-            if platform == '':
-                result.pop('platform')
-            else:
-                try:
-                    p_type_f = \
-                        get_extcsv_value(self.extcsv, 'PLATFORM', 'Type')
-                    p_id_f = get_extcsv_value(self.extcsv, 'PLATFORM', 'ID')
-                    p_f = '%s%s' % (p_type_f, p_id_f)
-                    p_f = p_f.lower()
-                except Exception as err:
-                    msg = str(err)
-                    LOGGER.error(msg)
-                    result['platform'] = None
-                if platform.lower() == p_f:
-                    result['platform'] = True
-                else:
-                    result['platform'] = False
-        # instrument type
-        if 'instrument_type' not in rule.keys():
-            result.pop('instrument_type')
-        else:
-            instrument_type = rule['instrument_type']
-            if instrument_type == '':
-                result.pop('instrument_type')
-            else:
-                try:
-                    i_type_f = \
-                        get_extcsv_value(self.extcsv, 'INSTRUMENT', 'Name')
-                except Exception as err:
-                    msg = str(err)
-                    LOGGER.error(msg)
-                    result['instrument_type'] = None
-                if instrument_type.lower() == i_type_f.lower():
-                    result['instrument_type'] = True
-                else:
-                    result['instrument_type'] = False
-        # instrument model
-        if 'instrument_model' not in rule.keys():
-            result.pop('instrument_model')
-        else:
-            instrument_model = rule['instrument_model']
-            if instrument_model == '':
-                result.pop('instrument_model')
-            else:
-                try:
-                    i_model_f = \
-                        get_extcsv_value(self.extcsv, 'INSTRUMENT', 'Model')
-                except Exception as err:
-                    msg = str(err)
-                    LOGGER.error(msg)
-                    result['instrument_model'] = None
-                if instrument_model.lower() == i_model_f.lower():
-                    result['instrument_model'] = True
-                else:
-                    result['instrument_model'] = False
-        # instrument serial number
-        if 'instrument_serial_number' not in rule.keys():
-            result.pop('instrument_serial')
-        else:
-            instrument_serial_number = rule['instrument_serial_number']
-            if instrument_serial_number == '':
-                result.pop('instrument_serial')
-            else:
-                try:
-                    i_num_f = \
-                        get_extcsv_value(self.extcsv, 'INSTRUMENT', 'Number')
-                except Exception as err:
-                    msg = str(err)
-                    LOGGER.error(msg)
-                    result['instrument_serial'] = None
-                if instrument_serial_number.lower() == i_num_f.lower():
-                    result['instrument_serial'] = True
-                else:
-                    result['instrument_serial'] = False
-        # instrument latitude
-        if 'instrument_latitude' not in rule.keys():
-            result['instrument_lat'] = None
-            result.pop('instrument_lat')
-        else:
-            instrument_latitude = rule['instrument_latitude']
-            if instrument_latitude == '':
-                    result.pop('instrument_lat')
-            else:
-                try:
-                    lat_f = \
-                        get_extcsv_value(self.extcsv, 'LOCATION', 'Latitude')
-                except Exception as err:
-                    msg = str(err)
-                    LOGGER.error(msg)
-                    result['instrument_lat'] = None
-                if ',' in instrument_latitude:
-                    a, b = instrument_latitude.split(',')
-                    r = self._function_rc_1(a, b, lat_f)
-                    if r:
-                        result['instrument_lat'] = True
-                    else:
-                        result['instrument_lat'] = False
-                else:
-                    if instrument_latitude == lat_f:
-                        result['instrument_lat'] = True
-                    else:
-                        result['instrument_lat'] = False
-        # instrument longitude
-        if 'instrument_longitude' not in rule.keys():
-            result.pop('instrument_lon')
-        else:
-            instrument_longitude = rule['instrument_longitude']
-            if instrument_longitude == '':
-                    result.pop('instrument_lon')
-            else:
-                try:
-                    lon_f = \
-                        get_extcsv_value(self.extcsv, 'LOCATION', 'Longitude')
-                except Exception as err:
-                    msg = str(err)
-                    LOGGER.error(msg)
-                    result['instrument_lon'] = None
-                if ',' in instrument_longitude:
-                    a, b = instrument_longitude.split(',')
-                    r = self._function_rc_1(a, b, lon_f)
-                    if r:
-                        result['instrument_lon'] = True
+
+        v = []
+        for name, expected in rule.preconditions:
+            if name == 'agency':
+                agency_f = qa_result.get_metadata('DATA_GENERATION', 'Agency')
+                v.append(expected == agency_f)
+            elif name == 'platform':
+                p_type_f = qa_result.get_metadata('PLATFORM', 'Type')
+                p_id_f = qa_result.get_metadata('PLATFORM', 'ID')
+                p_f = ('%s%s' % (p_type_f, p_id_f)).lower()
+                v.append(expected == p_f)
+            elif name == 'instrument_type':
+                i_type_f = qa_result.get_metadata('INSTRUMENT', 'Name')
+                v.append(expected == i_type_f.lower())
+            elif name == 'instrument_model':
+                i_model_f = qa_result.get_metadata('INSTRUMENT', 'Model')
+                v.append(expected == i_model_f.lower())
+            elif name == 'instrument_serial_number':
+                i_num_f = qa_result.get_metadata('INSTRUMENT', 'Number')
+                v.append(expected == i_num_f.lower())
+            elif name in ['instrument_latitude', 'instrument_longitude']:
+                field = 'Latitude'
+                if name == 'instrument_longitude':
+                    field = 'Longitude'
+                coord_f = qa_result.get_metadata('LOCATION', field)
+                if isinstance(expected, list):
+                    a, b = expected
+                    if self._function_rc_1(a, b, coord_f):
+                        v.append(True)
                     else:
-                        result['instrument_lon'] = False
+                        v.append(False)
                 else:
-                    if instrument_longitude == lon_f:
-                        result['instrument_lon'] = True
-                    else:
-                        result['instrument_lon'] = False
+                    v.append(expected == coord_f)
 
-        v = result.values()
         if len(v) == 0:
             return None
         elif False in v:
@@ -956,74 +1544,6 @@ class QualityChecker(object):
         else:
             return True
 
-    def _get_test_result(self, test_id, row):
-        """
-        helper method: retrieve test result
-
-        :param test_id: test_id result to be retrieved
-        :param row: row number of the element
-        :returns: test result or None if test is n/a
-        """
-        result = None
-        try:
-            if test_id in self.qa_results[self.file_path].keys():
-                if row in self.qa_results[self.file_path][test_id].keys():
-                    result = \
-                        self.qa_results[self.file_path][test_id][row]['result']
-            else:
-                return None
-        except Exception as err:
-            msg = 'Unable to get related test result for test_id: %s,\
-                row: %s. Due to: %s' % (test_id, row, str(err))
-            LOGGER.error(msg)
-            raise err
-
-        return result
-
-    def _set_test_result(self, test_id, rule, test_tok, result, row=1):
-        """
-        helper method: set qa test result
-
-        :param test_id: test_id to set
-        :param row: row number for which this test result applies
-        """
-        try:
-            if test_id not in self.qa_results[self.file_path].keys():
-                self.qa_results[self.file_path][test_id] = OrderedDict()
-                if row not in self.qa_results[self.file_path][test_id].keys():
-                    self.qa_results[self.file_path][test_id][row] = {
-                        'result': None,
-                        'table': rule['table'],
-                        'table_index': rule['table_index'],
-                        'element': rule['element'],
-                        'related_test_id': rule['related_test_id'],
-                        'related_test_result': None,
-                        'precond_result': None,
-                    }
-                    self.qa_results[self.file_path][test_id]['test_def'] = rule
-                    self.qa_results[self.file_path][test_id][row][test_tok] = \
-                        result
-                else:
-                    self.qa_results[self.file_path][test_id][row][test_tok] = \
-                        result
-            else:
-                if row not in self.qa_results[self.file_path][test_id].keys():
-                    self.qa_results[self.file_path][test_id][row] = {
-                        'result': None,
-                        'table': rule['table'],
-                        'table_index': rule['table_index'],
-                        'element': rule['element'],
-                        'related_test_id': rule['related_test_id'],
-                        'related_test_result': None,
-                        'precond_result': None,
-                    }
-                self.qa_results[self.file_path][test_id][row][test_tok] = \
-                    result
-        except Exception as err:
-            msg = 'Unable to set test result. Due to: %s' % str(err)
-            LOGGER.error(msg)
-            raise err
-
     def test_definition_validation(self):
         """
         validate test definition provided in xlsx
@@ -1094,7 +1614,7 @@ class QualityChecker(object):
 
         try:
             a_f = float(a)
-            b_f = float(a)
+            b_f = float(b)
             x_f = float(x)
         except Exception as err:
             msg = str(err)
@@ -1120,18 +1640,245 @@ class QualityChecker(object):
 
         return abs(a_f - b_f) <= x_f
 
-    def _get_rule(self, test_id, rule_tok=None):
+    def _function_ts_3(self, a, b):
         """
-        helper method:
-        returns rule package at test_id
+        evaluable
+        a < b
         """
 
-        for rule in self.qa_rules[self.dataset]:
-            if rule['test_id'] == test_id:
-                if rule_tok is not None:
-                    return rule[rule_tok]
-                else:
-                    return rule
+        try:
+            a_f = float(a)
+            b_f = float(b)
+        except Exception as err:
+            msg = str(err)
+            LOGGER.error(msg)
+            return 'Error'
+
+        return a_f < b_f
+
+    def _function_ts_5(self, a, b):
+        """
+        evaluable
+        a <= b
+        """
+
+        try:
+            a_f = float(a)
+            b_f = float(b)
+        except Exception as err:
+            msg = str(err)
+            LOGGER.error(msg)
+            return 'Error'
+
+        return a_f <= b_f
+
+    def _function_cc(self, x, reference, a, relative=False, b=0):
+        """
+        evaluable
+        | x - reference | <= a
+        or, relative (b: absolute tolerance added, e.g. for references
+        near 0):
+        | x - reference | <= a * | reference | + b
+        """
+
+        try:
+            x_f = float(x)
+            a_f = float(a)
+            b_f = float(b)
+        except Exception as err:
+            msg = str(err)
+            LOGGER.error(msg)
+            return 'Error'
+
+        if relative:
+            a_f *= abs(reference)
+        return bool(abs(x_f - reference) <= a_f + b_f)
+
+
+def _validate_rule(rule, test_ids, seen):
+    """
+    helper function: validate one rule definition
+
+    :param rule: rule definition
+    :param test_ids: set of test ids of the dataset
+    :param seen: set of test ids of the dataset validated so far
+    :returns: tuple of lists of errors and warnings
+    """
+
+    errors = []
+    warnings = []
+    if rule['test_id'] == '':
+        errors.append('empty test_id')
+    elif rule['test_id'] in seen:
+        errors.append('duplicate test_id')
+    for token in ['table', 'element']:
+        if rule[token] == '':
+            errors.append('empty %s' % token)
+    if rule['table_index'] not in ['', 'all']:
+        try:
+            int(rule['table_index'])
+        except ValueError:
+            errors.append('invalid table_index %s' % rule['table_index'])
+    if rule['test_status'] not in ['0', '1']:
+        warnings.append('test_status %s is not 0 or 1 (test disabled)' %
+                        rule['test_status'])
+    if rule['profile'] not in ['0', '1']:
+        warnings.append('profile %s is not 0 or 1 (treated as 0)' %
+                        rule['profile'])
+
+    category = rule['test_category']
+    if category not in QA_FUNCTIONS:
+        warnings.append('unknown test_category %s (test never runs)' %
+                        category)
+    elif rule['function'] not in QA_FUNCTIONS[category]:
+        warnings.append('unknown %s function %s' % (category,
+                                                    rule['function']))
+    elif category in ['range', 'step', 'consistency']:
+        tokens = ['function_parameter_a']
+        if rule['function'] in ['RC_1', 'CC_5']:
+            tokens.append('function_parameter_b')
+        elif rule['function'] in ['TS_3', 'TS_4', 'TS_5', 'TS_6']:
+            tokens = []
+        for token in tokens:
+            if not isinstance(_parse_parameter(rule[token]), float):
+                errors.append('%s is not a number' % token)
+        if category == 'consistency' or \
+                rule['function'] in ARRAY_ONLY_FUNCTIONS:
+            if rule['function_parameter_c'] == '':
+                errors.append('empty function_parameter_c (column or '
+                              'reference data)')
+        if rule['function'] in ARRAY_ONLY_FUNCTIONS and \
+                rule['profile'] != '1':
+            warnings.append('%s runs on profiles only (test never runs)' %
+                            rule['function'])
+        if rule['function'] in LOOKUP_FUNCTIONS and \
+                rule['function_parameter_c'] != '' and \
+                not os.path.exists(rule['function_parameter_c']):
+            warnings.append('reference data %s not found' %
+                            rule['function_parameter_c'])
+    elif category == 'statistical':
+        for token in ['function_parameter_a', 'function_parameter_b']:
+            if not isinstance(_parse_parameter(rule[token]), float):
+                errors.append('%s is not a number' % token)
+        if rule['function_parameter_c'] != '' and \
+                not isinstance(_parse_parameter(rule['function_parameter_c']),
+                               float):
+            errors.append('function_parameter_c is not a number')
+        if rule['profile'] != '1':
+            warnings.append('%s runs on profiles only (test never runs)' %
+                            rule['function'])
+    elif category == 'timeseries':
+        for token in ['function_parameter_a', 'function_parameter_b']:
+            if not isinstance(_parse_parameter(rule[token]), float):
+                errors.append('%s is not a number' % token)
+        if rule['profile'] != '1':
+            warnings.append('%s runs on profiles only (test never runs)' %
+                            rule['function'])
+    elif category == 'scan':
+        if not isinstance(_parse_parameter(rule['function_parameter_a']),
+                          float):
+            errors.append('function_parameter_a is not a number')
+        if rule['function_parameter_b'] != '' and \
+                not isinstance(_parse_parameter(rule['function_parameter_b']),
+                               float):
+            errors.append('function_parameter_b is not a number')
+        if rule['profile'] != '1':
+            warnings.append('%s runs on profiles only (test never runs)' %
+                            rule['function'])
+
+    related_ids = [tid.strip() for tid in rule['related_test_id'].split(',')]
+    related_results = rule['related_test_result'].split(',')
+    if related_ids != ['']:
+        for rtid in related_ids:
+            if rtid not in test_ids:
+                errors.append('unknown related test %s' % rtid)
+        if len(related_results) != len(related_ids):
+            errors.append('related_test_id and related_test_result '
+                          'lengths differ')
+
+    return errors, warnings
+
+
+def _split_reference(table, reference):
+    """
+    helper function: split a column reference of a rule
+
+    :param table: table of the rule
+    :param reference: column as TABLE.Field, or Field of the same table
+    :returns: tuple of table and field
+    """
+
+    if '.' in reference:
+        return tuple(reference.split('.', 1))
+    return table, reference
+
+
+def _parse_parameter(value):
+    """
+    helper function: parse a rule function parameter once
+
+    :param value: parameter as found in the rule definitions
+    :returns: float, or the value as-is if it cannot be parsed
+    """
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _build_flag_map(test_results):
+    """
+    helper function: build test result flag map
+
+    :param test_results: test_results token of a rule (e.g. '0|100')
+    :returns: dict of test outcome to flag
+    """
+
+    poss_results = test_results.split('|')
+    flag_map = {
+        True: None,
+        False: None,
+        'Error': 'Error'
+    }
+    if len(poss_results) == 2:
+        flag_map = {
+            True: poss_results[1],
+            False: poss_results[0]
+        }
+    if len(poss_results) == 1:
+        flag_map = {
+            True: poss_results[0]
+        }
+
+    return flag_map
+
+
+def _build_preconditions(rule):
+    """
+    helper function: build list of (precondition, expected value) pairs
+    to check, skipping preconditions not defined by the rule
+
+    :param rule: rule definition
+    :returns: list of (precondition, expected value)
+    """
+
+    preconditions = []
+    for name in ['agency', 'platform', 'instrument_type', 'instrument_model',
+                 'instrument_serial_number', 'instrument_latitude',
+                 'instrument_longitude']:
+        expected = rule.get(name, '')
+        if expected == '':
+            continue
+        if name in ['platform', 'instrument_type', 'instrument_model',
+                    'instrument_serial_number']:
+            expected = expected.lower()
+        elif name in ['instrument_latitude', 'instrument_longitude']:
+            if ',' in expected:
+                expected = expected.split(',')
+        preconditions.append((name, expected))
+
+    return preconditions
 
 
 class WOUDCQaExecutionError(Exception):
@@ -1144,6 +1891,17 @@ class WOUDCQaNotImplementedError(Exception):
     pass
 
 
+class WOUDCQaBudgetExceeded(Exception):
+    """Qa of a file stopped at its time or memory budget"""
+
+    def __init__(self, message, reason, qa_result=None):
+        """provide an error message, the budget spent (time or memory)
+        and the results so far"""
+        super(WOUDCQaBudgetExceeded, self).__init__(message)
+        self.reason = reason
+        self.qa_result = qa_result
+
+
 class WOUDCQaValidationError(Exception):
     """File failed one or more defined Qa checks"""
 
@@ -1154,16 +1912,32 @@ class WOUDCQaValidationError(Exception):
 
 
 def qa(file_content, file_path=None, rule_path=None, summary=False,
-       validate_metadata=False):
+       validate_metadata=False, checker=None, pool=None, budget=None):
     """
     Parse incoming file content, invoke dataset handlers,
     and invoke quality checker
 
     :param file_content: file as string
     :param file_path: path to file (optional)
+    :param rule_path: path to qa rule definitions (optional)
+    :param summary: summarize failed checks (optional)
+    :param validate_metadata: validate file metadata (optional)
+    :param checker: QualityChecker to reuse across calls (optional).
+        When provided, rule_path is ignored
+    :param pool: ColumnPool to evaluate profile checks in worker
+        processes (optional). When provided, its checker is used
+    :param budget: QaBudget of the file, from parsing on unless already
+        started (optional). WOUDCQaBudgetExceeded is raised when it is
+        spent
     """
 
-    success = 'File passed all defined WOUDC quality assessment checks.'
+    if budget is not None and not budget.started:
+        budget.start()
+        try:
+            return qa(file_content, file_path, rule_path, summary,
+                      validate_metadata, checker, pool, budget)
+        finally:
+            budget.stop()
 
     # parse incoming file content
     try:
@@ -1173,6 +1947,56 @@ def qa(file_content, file_path=None, rule_path=None, summary=False,
         LOGGER.error(msg)
         raise err
 
+    return _qa_parsed(ecsv, file_path, rule_path, summary, validate_metadata,
+                      checker, pool, budget)
+
+
+def qa_file(file_path, rule_path=None, summary=False,
+            validate_metadata=False, checker=None, pool=None, budget=None):
+    """
+    As qa, loading the file with load: large files are memory-mapped
+    instead of read into memory whole
+
+    :param file_path: path to file, or archive!member
+    :param rule_path: path to qa rule definitions (optional)
+    :param summary: summarize failed checks (optional)
+    :param validate_metadata: validate file metadata (optional)
+    :param checker: QualityChecker to reuse across calls (optional).
+        When provided, rule_path is ignored
+    :param pool: ColumnPool to evaluate profile checks in worker
+        processes (optional). When provided, its checker is used
+    :param budget: QaBudget of the file, from loading on unless already
+        started (optional)
+    """
+
+    if budget is not None and not budget.started:
+        budget.start()
+        try:
+            return qa_file(file_path, rule_path, summary, validate_metadata,
+                           checker, pool, budget)
+        finally:
+            budget.stop()
+
+    try:
+        ecsv = load(file_path)
+    except Exception as err:
+        msg = 'Unable to parse file. Due to: %s' % str(err)
+        LOGGER.error(msg)
+        raise err
+
+    return _qa_parsed(ecsv, file_path, rule_path, summary, validate_metadata,
+                      checker, pool, budget)
+
+
+def _qa_parsed(ecsv, file_path, rule_path, summary, validate_metadata,
+               checker, pool, budget):
+    """
+    helper function: validate and quality assess a parsed file, for qa
+    and qa_file
+    """
+
+    success = 'File passed all defined WOUDC quality assessment checks.'
+
     if validate_metadata:
         try:
             validation_dict = ecsv.metadata_validator()
@@ -1192,6 +2016,34 @@ def qa(file_content, file_path=None, rule_path=None, summary=False,
                 '\n'.join(validation_dict['warnings'])
             success = success + msg
 
+    qa_result = qa_extcsv(ecsv, file_path, rule_path, checker, pool, budget)
+    if not summary:
+        return qa_result.qa_results
+    else:
+        errors = format_violations(qa_result.violations())
+        if len(errors) != 0:
+            msg = 'File failed WOUDC quality assessment checks.'
+            raise WOUDCQaValidationError(msg, errors)
+
+    return success
+
+
+def qa_extcsv(ecsv, file_path=None, rule_path=None, checker=None,
+              pool=None, budget=None):
+    """
+    Invoke dataset handlers and quality checker on a parsed file
+
+    :param ecsv: woudc_extcsv Reader object
+    :param file_path: path to file (optional)
+    :param rule_path: path to qa rule definitions (optional)
+    :param checker: QualityChecker to reuse across calls (optional).
+        When provided, rule_path is ignored
+    :param pool: ColumnPool to evaluate profile checks in worker
+        processes (optional). When provided, its checker is used
+    :param budget: QaBudget to stop checking the file at (optional)
+    :returns: QaResult object
+    """
+
     # figue out dataset
     dataset = get_extcsv_value(
         ecsv,
@@ -1202,47 +2054,64 @@ def qa(file_content, file_path=None, rule_path=None, summary=False,
     # invoke dataset handler
     dataset_handler = None
     try:
-        if dataset.lower() == 'ozonesonde':
-            dataset_handler = OzoneSondeHandler(ecsv)
-        if dataset.lower() == 'totalozone':
-            dataset_handler = TotalOzoneHandler(ecsv)
-        if dataset.lower() == 'spectral':
-            dataset_handler = SpectralHandler(ecsv)
+        if dataset.lower() in DATASET_HANDLERS:
+            dataset_handler = DATASET_HANDLERS[dataset.lower()](ecsv)
     except Exception as err:
         msg = 'No handler found for dataset: %s. Cannot continue.' %\
             dataset.lower()
         LOGGER.critical(msg)
         raise err
-    # invoke quality checker
-    try:
-        qa_checker = QualityChecker(
-            dataset_handler.extcsv,
-            file_path,
-            rule_path
-        )
-    except AttributeError as err:
+    if dataset_handler is None:
         msg = 'No Qa and/or dataset handler defined for dataset: %s' % dataset
         LOGGER.critical(msg)
         raise WOUDCQaNotImplementedError(msg)
+    # invoke quality checker
+    try:
+        if pool is not None:
+            checker = pool.checker
+        elif checker is None:
+            checker = QualityChecker(rule_path)
+        qa_result = checker.check(dataset_handler.extcsv, file_path, pool,
+                                  budget)
+    except WOUDCQaBudgetExceeded:
+        raise
     except Exception as err:
         msg = 'Unable to run Qa. Due to: %s' % str(err)
         LOGGER.critical(msg)
         raise WOUDCQaExecutionError(msg)
-    if not summary:
-        return qa_checker.qa_results
-    else:
-        errors = summarize(qa_checker.qa_results)
-        if len(errors) != 0:
-            errors = list(set(errors))
-            msg = 'File failed WOUDC quality assessment checks.'
-            raise WOUDCQaValidationError(msg, errors)
 
-    return success
+    return qa_result
+
+
+def compile_rules(rule_path=None, rule_pack_path=None):
+    """
+    Validate qa rule definitions and compile them into a rule pack
+
+    Raises WOUDCQaValidationError if rule definitions are invalid.
+
+    :param rule_path: path to qa rule definitions (optional)
+    :param rule_pack_path: path to rule pack (optional, default:
+        rule definitions path + .pack)
+    :returns: path to rule pack
+    """
+
+    checker = QualityChecker(rule_path, rule_pack_path)
+    errors, warnings = checker.validate_qa_definitions()
+    for warning in warnings:
+        LOGGER.warning(warning)
+
+    return checker.save_rule_pack(rule_pack_path)
 
 
 def load(filename):
-    """stub to woudc_extcsv.load"""
-    return woudc_extcsv.load(filename)
+    """
+    stub to woudc_extcsv.loads, memory-mapping large files (see
+    woudc_qa.mapped) and reading compressed files and archive members
+    (archive!member) in memory
+    """
+    if is_mappable(filename):
+        return load_mapped(filename)
+    return woudc_extcsv.loads(read_file(filename))
 
 
 def loads(content):
@@ -0,0 +1,296 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Compressed and archived input files
+#
+# Files are identified by their path, or by archive!member for members
+# of zip and tar archives (e.g. 043.tar.gz!2013/20130227.ECC.csv), and
+# read in memory without extracting them to disk. Single gzip and bzip2
+# files are decompressed on the fly.
+
+import bz2
+import gzip
+import logging
+import os
+import struct
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+from StringIO import StringIO
+
+LOGGER = logging.getLogger(__name__)
+
+# separates archive path and member name in file identifiers
+MEMBER_SEPARATOR = '!'
+
+# archive types by file name suffix
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tbz')
+
+# compressed tar archives: reading a member before the last one read
+# decompresses the archive again from its start
+COMPRESSED_TAR_SUFFIXES = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tbz')
+
+# compressed single files by file name suffix
+COMPRESSED_SUFFIXES = {
+    '.gz': gzip.open,
+    '.bz2': bz2.BZ2File
+}
+
+# archives kept open for reading members, least recently used closed
+MAX_OPEN_ARCHIVES = 4
+
+_ARCHIVES = OrderedDict()
+_ARCHIVES_LOCK = [threading.Lock()]
+_ARCHIVES_PID = [os.getpid()]
+
+
+def is_archive(path):
+    """
+    Check whether a path names a zip or tar archive
+
+    :param path: file path
+    :returns: `bool` of whether path is an archive, by its suffix
+    """
+
+    return path.lower().endswith(ZIP_SUFFIXES + TAR_SUFFIXES)
+
+
+def split_file_id(file_id):
+    """
+    Split a file identifier into archive path and member name
+
+    :param file_id: file path or archive!member identifier
+    :returns: tuple of path and member name (None for files)
+    """
+
+    start = 0
+    while True:
+        index = file_id.find(MEMBER_SEPARATOR, start)
+        if index == -1:
+            return file_id, None
+        path = file_id[:index]
+        if is_archive(path) and os.path.isfile(path):
+            return path, file_id[index + 1:]
+        start = index + 1
+
+
+def list_members(path, extension='.csv'):
+    """
+    List the files of an archive
+
+    :param path: path to zip or tar archive
+    :param extension: extension of members to list (None: all files)
+    :returns: list of (file identifier, uncompressed size) tuples
+    """
+
+    members = []
+    if path.lower().endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    members.append((info.filename, info.file_size))
+    else:
+        archive = tarfile.open(path)
+        try:
+            for info in archive.getmembers():
+                if info.isfile():
+                    members.append((info.name, info.size))
+        finally:
+            archive.close()
+    return [('%s%s%s' % (path, MEMBER_SEPARATOR, name), size)
+            for name, size in members
+            if extension is None or name.lower().endswith(extension)]
+
+
+def is_compressed_member(file_id):
+    """
+    Check whether a file identifier names a member of a compressed tar
+    archive, whose members are best read in archive order
+
+    :param file_id: file path or archive!member identifier
+    :returns: `bool` of whether file_id is a compressed tar member
+    """
+
+    path, member = split_file_id(file_id)
+    return member is not None and \
+        path.lower().endswith(COMPRESSED_TAR_SUFFIXES)
+
+
+def is_data_file(path, extension='.csv'):
+    """
+    Check whether a file is a data file, possibly compressed
+
+    :param path: file path
+    :param extension: extension of data files
+    :returns: `bool` of whether path ends with extension, optionally
+        followed by a compression suffix
+    """
+
+    name = path.lower()
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return name.endswith(extension)
+
+
+def open_file(file_id):
+    """
+    Open a file, compressed file or archive member for reading
+
+    :param file_id: file path or archive!member identifier
+    :returns: file-like object
+    """
+
+    path, member = split_file_id(file_id)
+    if member is not None:
+        return StringIO(_read_member(path, member))
+    for suffix, opener in COMPRESSED_SUFFIXES.iteritems():
+        if path.lower().endswith(suffix):
+            return opener(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_file(file_id, size=-1):
+    """
+    Read a file, compressed file or archive member
+
+    :param file_id: file path or archive!member identifier
+    :param size: number of bytes to read (default: all)
+    :returns: content (decompressed)
+    """
+
+    ff = open_file(file_id)
+    try:
+        return ff.read(size)
+    finally:
+        ff.close()
+
+
+def file_size(file_id):
+    """
+    Get the (uncompressed, where known) size of a file
+
+    :param file_id: file path or archive!member identifier
+    :returns: size (bytes)
+    """
+
+    path, member = split_file_id(file_id)
+    if member is not None:
+        archive, lock = _open_archive(path)
+        with lock:
+            try:
+                if isinstance(archive, zipfile.ZipFile):
+                    return archive.getinfo(member).file_size
+                return archive.getmember(member).size
+            except KeyError as err:
+                raise OSError('Unable to find %s%s%s. Due to: %s' %
+                              (path, MEMBER_SEPARATOR, member, err))
+    if path.lower().endswith('.gz'):
+        # size modulo 2^32, from the gzip trailer
+        try:
+            with open(path, 'rb') as ff:
+                ff.seek(-4, os.SEEK_END)
+                return struct.unpack('<I', ff.read(4))[0]
+        except IOError as err:
+            raise OSError(str(err))
+    return os.path.getsize(path)
+
+
+def _read_member(path, member):
+    """
+    helper function: read a member of an open archive
+    """
+
+    archive, lock = _open_archive(path)
+    with lock:
+        try:
+            if isinstance(archive, zipfile.ZipFile):
+                return archive.read(member)
+            ff = archive.extractfile(member)
+        except (KeyError, tarfile.TarError, zipfile.BadZipfile) as err:
+            raise IOError('Unable to read %s%s%s. Due to: %s' %
+                          (path, MEMBER_SEPARATOR, member, err))
+        if ff is None:
+            raise IOError('Unable to read %s%s%s. Due to: not a file' %
+                          (path, MEMBER_SEPARATOR, member))
+        return ff.read()
+
+
+def _open_archive(path):
+    """
+    helper function: open an archive, or reuse it if already open
+
+    :returns: tuple of archive (ZipFile or TarFile) and its lock
+    """
+
+    if _ARCHIVES_PID[0] != os.getpid():
+        # forked: the file offsets are shared with the parent, and its
+        # locks may have been held by threads not running here
+        _ARCHIVES_LOCK[0] = threading.Lock()
+        _ARCHIVES.clear()
+        _ARCHIVES_PID[0] = os.getpid()
+    with _ARCHIVES_LOCK[0]:
+        if path in _ARCHIVES:
+            entry = _ARCHIVES.pop(path)
+        else:
+            try:
+                if path.lower().endswith(ZIP_SUFFIXES):
+                    archive = zipfile.ZipFile(path)
+                else:
+                    archive = tarfile.open(path)
+            except (tarfile.TarError, zipfile.BadZipfile) as err:
+                raise IOError('Unable to open archive %s. Due to: %s' %
+                              (path, err))
+            entry = (archive, threading.Lock())
+            while len(_ARCHIVES) >= MAX_OPEN_ARCHIVES:
+                archive, lock = _ARCHIVES.popitem(last=False)[1]
+                with lock:
+                    archive.close()
+        _ARCHIVES[path] = entry
+        return entry
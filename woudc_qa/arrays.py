@@ -0,0 +1,733 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Typed profile columns and vectorized profile checks
+#
+# Profile columns are parsed once per file into float arrays, with a
+# mask of which values are numbers. Range and step check functions are
+# evaluated over whole columns into outcome codes, which stand in for
+# the values in QualityChecker's per-row loops (as ColumnPool outcomes
+# do), so rows are never parsed one float() call at a time. Checks over
+# many instances of a table (e.g. the GLOBAL scans of a spectral file)
+# run once over the instances stacked into a 2-D array (instance x row).
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from woudc_qa.timeseries import file_series, series_key
+from woudc_qa.util import get_extcsv_columns, get_table_ranges
+
+LOGGER = logging.getLogger(__name__)
+
+# outcome codes: positions of None, True, False and 'Error' in
+# woudc_qa.OUTCOMES
+CODE_NONE = 0
+CODE_TRUE = 1
+CODE_FALSE = 2
+CODE_ERROR = 3
+
+# vectorized functions by test category
+ARRAY_FUNCTIONS = {
+    'range': ['RC_1', 'RC_5', 'RC_6', 'RC_7', 'RC_8', 'RC_9', 'RC_10'],
+    'step': ['TS_0', 'TS_2', 'TS_3', 'TS_4', 'TS_5', 'TS_6', 'TS_7'],
+    'statistical': ['SC_1', 'SC_2'],
+    'timeseries': ['TC_1', 'TC_2'],
+    'scan': ['SN_1', 'SN_2']
+}
+
+# functions evaluated value by value, and so over all table instances
+# of a rule stacked at once
+STACKED_FUNCTIONS = ['RC_1', 'RC_5', 'RC_6']
+
+# functions that read a second column (function_parameter_c) of the
+# same table, and so are only evaluated vectorized
+COLUMN_FUNCTIONS = ['RC_7', 'RC_8', 'TS_7']
+
+# functions that read reference data from a file (function_parameter_c),
+# and so are only evaluated vectorized
+LOOKUP_FUNCTIONS = ['RC_9', 'RC_10']
+
+# functions only evaluated vectorized
+ARRAY_ONLY_FUNCTIONS = COLUMN_FUNCTIONS + LOOKUP_FUNCTIONS
+
+# median absolute deviation to standard deviation, for normally
+# distributed values
+MAD_SCALE = 1.4826
+
+# values of the rolling windows evaluated at once, bounding the memory
+# of the window copies rolling medians need
+WINDOW_CHUNK = 65536
+
+
+class ProfileArrays(object):
+    """Typed payload columns of one file, parsed on first use."""
+
+    def __init__(self, extcsv):
+        """
+        Initialize an empty column cache
+
+        :param extcsv: woudc_extcsv Reader object
+        """
+
+        self._extcsv = extcsv
+        # (table, table index) -> field -> (values, valid), or None if
+        # the table is not found
+        self._tables = {}
+
+    def prefetch(self, table, table_index, fields):
+        """
+        Parse columns of a table instance in one pass
+
+        :param table: table name
+        :param table_index: table index
+        :param fields: list of fields
+        """
+
+        columns = self._tables.setdefault((table, table_index), {})
+        if columns is None:
+            return
+        missing = [field for field in OrderedDict.fromkeys(fields)
+                   if field not in columns]
+        if not missing:
+            return
+        values = get_extcsv_columns(self._extcsv, table, missing,
+                                    table_index)
+        if values is None:
+            self._tables[(table, table_index)] = None
+            return
+        for field, column in values.iteritems():
+            columns[field] = parse_column(column)
+
+    def column(self, table, table_index, field):
+        """
+        Get a typed column
+
+        :param table: table name
+        :param table_index: table index
+        :param field: field
+        :returns: tuple of float64 array (0 where not a number) and
+            boolean array of which values are numbers, or None if the
+            table is not found
+        """
+
+        self.prefetch(table, table_index, [field])
+        columns = self._tables[(table, table_index)]
+        if columns is None:
+            return None
+        return columns[field]
+
+    def stack(self, table, table_indexes, field):
+        """
+        Get a typed column of many table instances, stacked
+
+        :param table: table name
+        :param table_indexes: list of table indexes
+        :param field: field
+        :returns: tuple of 2-D float64 array of values (instance x row,
+            0 past the end of shorter columns), 2-D boolean array of
+            which values are numbers (False past the end), list of the
+            table indexes found and list of their column lengths
+        """
+
+        stacked = []
+        found = []
+        for ti in table_indexes:
+            column = self.column(table, ti, field)
+            if column is not None:
+                stacked.append(column)
+                found.append(ti)
+        lengths = [len(values) for values, _ in stacked]
+        values = np.zeros((len(stacked), max(lengths or [0])))
+        valid = np.zeros(values.shape, dtype=bool)
+        for i, (column, length) in enumerate(zip(stacked, lengths)):
+            values[i, :length] = column[0]
+            valid[i, :length] = column[1]
+        return values, valid, found, lengths
+
+
+def parse_column(values):
+    """
+    Parse column values into a typed array
+
+    :param values: list of values as found in the file
+    :returns: tuple of float64 array (0 where not a number) and boolean
+        array of which values are numbers
+    """
+
+    try:
+        floats = np.array(values, dtype=np.float64)
+        return floats, np.ones(len(floats), dtype=bool)
+    except (TypeError, ValueError):
+        pass
+
+    # some values are not numbers: parse one by one
+    floats = np.zeros(len(values))
+    valid = np.zeros(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            floats[i] = float(value)
+            valid[i] = True
+        except (TypeError, ValueError):
+            pass
+    return floats, valid
+
+
+def level_coordinates(levels, log):
+    """
+    Get profile levels as interpolated over
+
+    :param levels: float64 array of levels
+    :param log: whether levels are interpolated in log(level) (pressure)
+    :returns: float64 array of coordinates (NaN for levels <= 0 in log)
+    """
+
+    if log:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.log(np.where(levels > 0, levels, np.nan))
+    return levels
+
+
+def evaluate(qa_result, rules, skip=()):
+    """
+    Evaluate profile range, step, statistical and time series checks
+    over whole columns
+
+    :param qa_result: QaResult object
+    :param rules: compiled rules of the dataset
+    :param skip: (test_id, table index) keys already evaluated
+    :returns: dict of outcome codes (see woudc_qa.OUTCOMES), one per
+        row, by (test_id, table index)
+    """
+
+    tasks = []
+    stacks = []
+    fields = OrderedDict()
+    for rule in rules:
+        if not rule.status or not rule.profile or \
+                rule.function not in ARRAY_FUNCTIONS.get(rule.category, []):
+            continue
+        a, b = get_table_ranges(qa_result.extcsv, rule.table,
+                                rule.table_index)
+        indexes = [ti for ti in range(a, b) if (rule.test_id, ti) not in skip]
+        for ti in indexes:
+            needed = fields.setdefault((rule.table, ti), [])
+            needed.append(rule.element)
+            if rule.function in COLUMN_FUNCTIONS:
+                needed.append(rule.param_c)
+        if rule.category == 'scan' or \
+                (rule.function in STACKED_FUNCTIONS and len(indexes) > 1):
+            stacks.append((rule, indexes))
+        else:
+            tasks.extend((rule, ti) for ti in indexes)
+
+    arrays = qa_result.arrays
+    for (table, ti), needed in fields.iteritems():
+        arrays.prefetch(table, ti, needed)
+
+    outcomes = {}
+    for rule, indexes in stacks:
+        values, valid, indexes, lengths = arrays.stack(rule.table, indexes,
+                                                       rule.element)
+        if rule.category == 'scan':
+            codes = scan_codes(rule, values, valid)
+        else:
+            codes = range_codes(rule, values, valid)
+        if codes is None:
+            continue
+        for i, (ti, length) in enumerate(zip(indexes, lengths)):
+            outcomes[(rule.test_id, ti)] = bytearray(
+                codes[i, :length].tobytes())
+
+    for rule, ti in tasks:
+        column = arrays.column(rule.table, ti, rule.element)
+        if column is None:
+            continue
+        values, valid = column
+        if rule.category == 'range':
+            reference = None
+            if rule.function in COLUMN_FUNCTIONS:
+                reference = arrays.column(rule.table, ti, rule.param_c)
+            elif rule.function in LOOKUP_FUNCTIONS:
+                reference = lookup_reference(
+                    qa_result.extcsv, arrays, rule, ti)
+            codes = range_codes(rule, values, valid, reference)
+        elif rule.category == 'statistical':
+            codes = statistical_codes(rule, values, valid)
+        elif rule.category == 'timeseries':
+            codes = _series_codes(qa_result, rule, ti)
+        else:
+            reference = None
+            if rule.function in COLUMN_FUNCTIONS:
+                reference = arrays.column(rule.table, ti, rule.param_c)
+            codes = step_codes(rule, values, valid, reference)
+        if codes is not None:
+            outcomes[(rule.test_id, ti)] = bytearray(codes.tobytes())
+
+    return outcomes
+
+
+def range_codes(rule, values, valid, reference=None):
+    """
+    Evaluate a range check function over a column
+
+    :param rule: QaRule of the test
+    :param values: float64 array of values
+    :param valid: boolean array of which values are numbers
+    :param reference: (values, valid) of the column named by
+        function_parameter_c, for functions reading one, or the
+        reference data by row, NaN where unknown, for functions reading
+        reference data: (means, standard deviations) for RC_9, reference
+        values for RC_10
+    :returns: uint8 array of outcome codes, or None if the function
+        cannot be evaluated vectorized (e.g. parameters not numbers)
+    """
+
+    a, b = rule.param_a, rule.param_b
+    if not isinstance(a, float):
+        return None
+    if rule.function == 'RC_1':
+        if not isinstance(b, float):
+            return None
+        passed = (a <= values) & (values <= b)
+    elif rule.function == 'RC_5':
+        passed = a <= values
+    elif rule.function == 'RC_6':
+        passed = a >= values
+    elif rule.function in COLUMN_FUNCTIONS:
+        if reference is None or len(reference[0]) != len(values):
+            return _codes(np.zeros(len(values), dtype=bool),
+                          np.zeros(len(values), dtype=bool))
+        if rule.function == 'RC_7':
+            passed = values <= a * np.abs(reference[0])
+        else:
+            passed = np.abs(values - reference[0]) <= a
+        valid = valid & reference[1]
+    elif rule.function == 'RC_9':
+        if reference is None or len(reference[0]) != len(values):
+            return _codes(np.zeros(len(values), dtype=bool),
+                          np.zeros(len(values), dtype=bool))
+        means, deviations = reference
+        known = np.isfinite(means) & np.isfinite(deviations)
+        with np.errstate(invalid='ignore'):
+            passed = np.abs(values - means) <= a * deviations
+        valid = valid & known
+    elif rule.function == 'RC_10':
+        if reference is None or len(reference) != len(values):
+            return _codes(np.zeros(len(values), dtype=bool),
+                          np.zeros(len(values), dtype=bool))
+        with np.errstate(invalid='ignore'):
+            passed = np.abs(values - reference) <= a * np.abs(reference)
+        valid = valid & np.isfinite(reference)
+    else:
+        return None
+
+    return _codes(passed, valid)
+
+
+def step_codes(rule, values, valid, reference=None):
+    """
+    Evaluate a step check function over a column: row i against row
+    i + 1 (the last row has no outcome)
+
+    :param rule: QaRule of the test
+    :param values: float64 array of values
+    :param valid: boolean array of which values are numbers
+    :param reference: (values, valid) of the column named by
+        function_parameter_c, for functions reading one
+    :returns: uint8 array of outcome codes, or None if the function
+        cannot be evaluated vectorized (e.g. parameters not numbers)
+    """
+
+    a = rule.param_a
+    this, following = values[:-1], values[1:]
+    both = valid[:-1] & valid[1:]
+    if rule.function == 'TS_0':
+        if not isinstance(a, float):
+            return None
+        passed, checked = np.abs(this - following) == a, both
+    elif rule.function == 'TS_2':
+        if not isinstance(a, float):
+            return None
+        passed, checked = np.abs(this - following) <= a, both
+    elif rule.function == 'TS_3':
+        passed, checked = this < following, both
+    elif rule.function == 'TS_4':
+        passed, checked = this > following, both
+    elif rule.function == 'TS_5':
+        passed, checked = this <= following, both
+    elif rule.function == 'TS_6':
+        passed, checked = this >= following, both
+    elif rule.function == 'TS_7':
+        if not isinstance(a, float):
+            return None
+        if reference is None or len(reference[0]) != len(values):
+            passed = checked = np.zeros(len(both), dtype=bool)
+        else:
+            # gradient per unit of the reference column
+            steps = reference[0][1:] - reference[0][:-1]
+            checked = both & reference[1][:-1] & reference[1][1:] & \
+                (steps != 0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                passed = np.abs((following - this) / steps) <= a
+    else:
+        return None
+
+    codes = np.zeros(len(values), dtype=np.uint8)
+    if len(values):
+        codes[:-1] = _codes(passed, checked)
+    return codes
+
+
+def statistical_codes(rule, values, valid, start=0, stop=None):
+    """
+    Evaluate a statistical check function over a column: each value
+    against the values of the rolling window (function_parameter_a rows)
+    centred on it, truncated windows being shifted inside the column
+
+    SC_1: abs(x - median) <= b * max(1.4826 * MAD, c)
+    SC_2: abs(x - mean) <= b * max(standard deviation, c)
+
+    :param rule: QaRule of the test
+    :param values: float64 array of values
+    :param valid: boolean array of which values are numbers
+    :param start: first row evaluated (0-based)
+    :param stop: row after the last row evaluated (default: all rows);
+        only the windows of rows start to stop are computed
+    :returns: uint8 array of outcome codes of rows start to stop, or
+        None if the function cannot be evaluated vectorized (e.g.
+        parameters not numbers)
+    """
+
+    a, b, c = rule.param_a, rule.param_b, rule.param_c
+    if not isinstance(a, float) or not isinstance(b, float) or \
+            rule.function not in ['SC_1', 'SC_2']:
+        return None
+    floor = c if isinstance(c, float) else 0.0
+    if stop is None:
+        stop = len(values)
+
+    # statistics of the values only: rows that are not numbers are
+    # skipped by the windows
+    checked = np.flatnonzero(valid)
+    window = min(int(a), len(checked))
+    if window < 3:
+        LOGGER.error('Unable to evaluate %s for test_id: %s: less than '
+                     '3 values in the window', rule.function, rule.test_id)
+        return _codes(np.zeros(stop - start, dtype=bool),
+                      np.zeros(stop - start, dtype=bool))
+
+    # sample positions of the rows evaluated, and the windows they need
+    first, last = np.searchsorted(checked, [start, stop])
+    starts = _window_starts(len(checked), window)[first:last]
+    passed = np.zeros(stop - start, dtype=bool)
+    if len(starts):
+        sample = values[checked[starts[0]:starts[-1] + window]]
+        if rule.function == 'SC_1':
+            centre, spread = rolling_median(sample, window)
+            spread *= MAD_SCALE
+        else:
+            centre, spread = rolling_mean(sample, window)
+        starts = starts - starts[0]
+        passed[checked[first:last] - start] = \
+            np.abs(values[checked[first:last]] - centre[starts]) <= \
+            b * np.maximum(spread[starts], floor)
+    return _codes(passed, valid[start:stop])
+
+
+def timeseries_codes(rule, days, values, valid, history):
+    """
+    Evaluate a time series check function over a column: each value
+    against the earlier values of its series, those of earlier files
+    (history) included
+
+    TC_1: abs(x - previous value) <= a, if the previous value is at most
+        b days earlier
+    TC_2: abs(x - mean of the values of the previous b days) <= a
+
+    Rows with no earlier value to check against have no outcome.
+
+    :param rule: QaRule of the test
+    :param days: int64 array of day numbers
+    :param values: float64 array of values
+    :param valid: boolean array of which rows have both a date and a
+        number
+    :param history: tuple of day numbers and values of earlier files,
+        sorted by day
+    :returns: uint8 array of outcome codes, or None if the function
+        cannot be evaluated vectorized (e.g. parameters not numbers)
+    """
+
+    a, b = rule.param_a, rule.param_b
+    if not isinstance(a, float) or not isinstance(b, float) or \
+            rule.function not in ['TC_1', 'TC_2']:
+        return None
+
+    # the series in date order, earlier files first on the same day
+    rows = np.flatnonzero(valid)
+    series_days = np.concatenate([history[0], days[rows]])
+    series_values = np.concatenate([history[1], values[rows]])
+    order = np.argsort(series_days, kind='mergesort')
+    series_days, series_values = series_days[order], series_values[order]
+    # position of each checked row in the series
+    positions = np.empty(len(order), dtype=np.int64)
+    positions[order] = np.arange(len(order))
+    positions = positions[len(history[0]):]
+    row_days, row_values = days[rows], values[rows]
+
+    if rule.function == 'TC_1':
+        previous = np.maximum(positions - 1, 0)
+        checked = (positions > 0) & \
+            (row_days - series_days[previous] <= b)
+        passed = np.abs(row_values - series_values[previous]) <= a
+    else:
+        sums = np.concatenate([[0.0], np.cumsum(series_values)])
+        starts = np.searchsorted(series_days, row_days - b, side='left')
+        counts = positions - starts
+        checked = counts > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (sums[positions] - sums[starts]) / counts
+            passed = np.abs(row_values - means) <= a
+
+    codes = np.full(len(values), CODE_ERROR, dtype=np.uint8)
+    codes[rows] = np.where(checked, np.where(passed, CODE_TRUE, CODE_FALSE),
+                           CODE_NONE)
+    return codes
+
+
+def scan_codes(rule, values, valid):
+    """
+    Evaluate a scan check function over the instances of a table
+    stacked (e.g. the GLOBAL scans of a spectral file)
+
+    SN_1: abs(x - g) <= a, g being the median of the instances at the
+        same row (e.g. the wavelength grid of the day)
+    SN_2: abs(ln x - (ln x[-1] + ln x[+1]) / 2) <= a, x and its
+        neighbours on the row before and after being above b (smoothness
+        of a spectrum); other rows have no outcome
+
+    :param rule: QaRule of the test
+    :param values: 2-D float64 array of values (instance x row)
+    :param valid: 2-D boolean array of which values are numbers
+    :returns: 2-D uint8 array of outcome codes, or None if the function
+        cannot be evaluated vectorized (e.g. parameters not numbers)
+    """
+
+    a, b = rule.param_a, rule.param_b
+    if not isinstance(a, float):
+        return None
+    if rule.function == 'SN_1':
+        grid, known = stacked_median(values, valid)
+        passed = np.abs(values - grid) <= a
+        return _codes(passed, valid & known)
+    elif rule.function == 'SN_2':
+        floor = b if isinstance(b, float) else 0.0
+        positive = valid & (values > floor)
+        logs = np.log(np.where(positive, values, 1.0))
+        passed = np.abs(logs[:, 1:-1] -
+                        (logs[:, :-2] + logs[:, 2:]) / 2) <= a
+        checked = positive[:, 1:-1] & positive[:, :-2] & positive[:, 2:]
+        codes = np.full(values.shape, CODE_NONE, dtype=np.uint8)
+        codes[:, 1:-1] = np.where(
+            checked, np.where(passed, CODE_TRUE, CODE_FALSE), CODE_NONE)
+        codes[~valid] = CODE_ERROR
+        return codes
+    return None
+
+
+def stacked_median(values, valid):
+    """
+    Median of stacked columns at each row, over the values that are
+    numbers
+
+    :param values: 2-D float64 array of values (instance x row)
+    :param valid: 2-D boolean array of which values are numbers
+    :returns: tuple of float64 array of medians, one per row, and
+        boolean array of which rows have a value
+    """
+
+    # values that are not numbers sort last
+    ordered = np.sort(np.where(valid, values, np.inf), axis=0)
+    counts = valid.sum(axis=0)
+    known = counts > 0
+    low = np.maximum((counts - 1) // 2, 0)
+    high = np.maximum(counts // 2, 0)
+    rows = np.arange(values.shape[1])
+    with np.errstate(invalid='ignore'):
+        medians = (ordered[low, rows] + ordered[high, rows]) / 2
+    return np.where(known, medians, 0.0), known
+
+
+def rolling_median(values, window):
+    """
+    Median and median absolute deviation of each window of a column
+
+    Each window is selected in place (np.partition), a chunk of windows
+    at a time: linear in the window size per window.  Chunks hold
+    WINDOW_CHUNK values whatever the window size.
+
+    :param values: contiguous float64 array of values
+    :param window: window size
+    :returns: tuple of arrays of medians and of median absolute
+        deviations, one per window start (len(values) - window + 1)
+    """
+
+    count = len(values) - window + 1
+    windows = np.lib.stride_tricks.as_strided(
+        values, shape=(count, window), strides=values.strides * 2)
+    medians = np.empty(count)
+    deviations = np.empty(count)
+    rows = max(1, WINDOW_CHUNK // window)
+    for start in range(0, count, rows):
+        chunk = windows[start:start + rows]
+        median = np.median(chunk, axis=1)
+        medians[start:start + len(chunk)] = median
+        deviations[start:start + len(chunk)] = \
+            np.median(np.abs(chunk - median[:, np.newaxis]), axis=1)
+    return medians, deviations
+
+
+def rolling_mean(values, window):
+    """
+    Mean and standard deviation of each window of a column, from
+    cumulative sums (linear in the column length)
+
+    :param values: float64 array of values
+    :param window: window size
+    :returns: tuple of arrays of means and of standard deviations, one
+        per window start (len(values) - window + 1)
+    """
+
+    # centred first: cumulative sums of squares lose less precision
+    offset = values.mean()
+    centred = values - offset
+    sums = np.concatenate([[0.0], np.cumsum(centred)])
+    squares = np.concatenate([[0.0], np.cumsum(centred * centred)])
+    means = (sums[window:] - sums[:-window]) / window
+    variances = (squares[window:] - squares[:-window]) / window - \
+        means * means
+    return means + offset, np.sqrt(np.maximum(variances, 0))
+
+
+def lookup_reference(extcsv, arrays, rule, table_index):
+    """
+    Get the reference data of a profile for a lookup function
+
+    :param extcsv: woudc_extcsv Reader object
+    :param arrays: ProfileArrays of the file
+    :param rule: QaRule of the test
+    :param table_index: table index of the profile
+    :returns: reference data by row (see range_codes), or None if
+        unavailable
+    """
+
+    # imported on first use: reference data modules read files through
+    # woudc_qa, which imports this module
+    from woudc_qa.climatology import climatology_reference
+    from woudc_qa.reference import profile_reference
+
+    try:
+        if rule.function == 'RC_9':
+            return climatology_reference(extcsv, arrays, rule, table_index)
+        return profile_reference(extcsv, arrays, rule, table_index)
+    except Exception as err:
+        msg = 'Unable to get reference data %s for test_id: %s. \
+            Due to: %s' % (rule.param_c, rule.test_id, str(err))
+        LOGGER.error(msg)
+        return None
+
+
+def _series_codes(qa_result, rule, table_index):
+    """
+    helper function: evaluate a time series check over a column and the
+    series it continues
+
+    :param qa_result: QaResult object
+    :param rule: QaRule of the test
+    :param table_index: table index
+    :returns: uint8 array of outcome codes, or None if the column or
+        its dates are not found
+    """
+
+    series = file_series(qa_result, rule, table_index)
+    if series is None:
+        return None
+    days, values, valid = series
+    history = np.zeros(0, dtype=np.int64), np.zeros(0)
+    store = qa_result.timeseries
+    if store is not None:
+        key = series_key(qa_result.extcsv, rule, table_index)
+        if key is not None:
+            history = store.history(key, days[valid])
+    return timeseries_codes(rule, days, values, valid, history)
+
+
+def _window_starts(length, window):
+    """
+    helper function: start of the window of each row
+
+    :param length: number of rows
+    :param window: window size
+    :returns: array of window starts, windows centred on their row and
+        shifted inside the column at its ends
+    """
+
+    return np.clip(np.arange(length) - window // 2, 0, length - window)
+
+
+def _codes(passed, valid):
+    """
+    helper function: outcome codes of a check
+
+    :param passed: boolean array of which rows passed
+    :param valid: boolean array of which rows could be checked
+    :returns: uint8 array of outcome codes
+    """
+
+    codes = np.where(passed, CODE_TRUE, CODE_FALSE).astype(np.uint8)
+    codes[~valid] = CODE_ERROR
+    return codes
@@ -0,0 +1,856 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+# Batch Qa of many files
+#
+# With worker processes, files are scheduled by estimated cost (file
+# size over the observed throughput of their dataset). Files of a
+# dataset are kept together on a worker, each worker takes its largest
+# files first, and an idle worker steals the smallest remaining file of
+# the busiest worker, so that no worker idles while a large file is
+# still queued elsewhere. A worker that spent the budget of a file is
+# replaced by a fresh process once done with the files queued to it.
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import time
+from datetime import datetime
+from collections import deque, OrderedDict
+from Queue import Empty
+
+from woudc_qa.archive import file_size, is_archive, is_compressed_member,\
+    is_data_file, list_members, read_file, split_file_id
+from woudc_qa import loads, qa_extcsv, QualityChecker,\
+    WOUDCQaBudgetExceeded
+from woudc_qa.journal import file_hash, hash_content
+from woudc_qa.mapped import is_mappable, load_mapped
+from woudc_qa.pipeline import READ_AHEAD, ReadAhead
+from woudc_qa.sink import METADATA
+from woudc_qa.watcher import RuleSetWatcher
+
+LOGGER = logging.getLogger(__name__)
+
+# throughput (bytes per second) by dataset until measured
+DEFAULT_THROUGHPUT = {
+    'ozonesonde': 300000.0,
+    'spectral': 10000000.0,
+    'totalozone': 5000000.0
+}
+
+# throughput of datasets not measured yet
+UNKNOWN_THROUGHPUT = 1000000.0
+
+# weight of the latest measurement in the throughput average
+THROUGHPUT_WEIGHT = 0.2
+
+# tasks queued ahead per worker process
+PREFETCH = 2
+
+
+def find_files(paths, extension='.csv'):
+    """
+    Expand files, directories (recursively) and archives into a sorted
+    list of files, each listed once.  Archive members are listed in
+    archive order.
+
+    :param paths: list of file, directory and/or archive paths
+    :param extension: file extension of files found in directories
+        and archives (optionally gzip or bzip2 compressed in directories)
+    :returns: list of file paths and archive!member identifiers
+    """
+
+    files = []
+    # sort keys of archive members: archive path and archive order
+    keys = {}
+    for path in paths:
+        archives = []
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                for filename in filenames:
+                    file_path = os.path.join(root, filename)
+                    if is_data_file(filename, extension):
+                        files.append(file_path)
+                    elif is_archive(filename):
+                        archives.append(file_path)
+        elif is_archive(path) and os.path.isfile(path):
+            archives.append(path)
+        else:
+            files.append(path)
+        for archive_path in archives:
+            members = _archive_members(archive_path, extension)
+            for index, member in enumerate(members):
+                keys[member] = (archive_path, index)
+            files.extend(members)
+
+    return sorted(set(files), key=lambda file_path: keys.get(
+        file_path, (file_path, -1)))
+
+
+def _archive_members(path, extension):
+    """
+    helper function: list the data files of an archive
+    """
+
+    try:
+        return [file_id for file_id, size in list_members(path, extension)]
+    except Exception as err:
+        LOGGER.warning('Unable to list archive %s. Due to: %s', path, err)
+        return [path]
+
+
+def shard_of(file_path, count):
+    """
+    Assign a file to a shard by a stable hash of its file name, so that
+    every node of a run assigns it alike wherever the archive is mounted
+
+    :param file_path: path to file
+    :param count: number of shards
+    :returns: shard number (1 to count)
+    """
+
+    digest = hashlib.md5(os.path.basename(file_path)).hexdigest()
+    return int(digest[:8], 16) % count + 1
+
+
+def parse_shard(value):
+    """
+    Parse a shard specification
+
+    :param value: shard as i/N (e.g. 2/4), with 1 <= i <= N
+    :returns: tuple of (shard number, number of shards)
+    """
+
+    try:
+        number, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard %s: expected i/N' % value)
+    if not 1 <= number <= count:
+        raise ValueError('Invalid shard %s: expected 1 <= i <= N' % value)
+    return number, count
+
+
+def peek_dataset(file_path, size=8192):
+    """
+    Read CONTENT.Category from the head of a file, without parsing it
+
+    :param file_path: path to file
+    :param size: bytes to read
+    :returns: dataset (lowercase), or None if not found
+    """
+
+    try:
+        lines = read_file(file_path, size).splitlines()
+    except IOError as err:
+        LOGGER.warning('Unable to read %s. Due to: %s', file_path, err)
+        return None
+
+    lines = [line.strip() for line in lines
+             if line.strip() and not line.startswith('*')]
+    for i, line in enumerate(lines[:-2]):
+        if line.startswith('#CONTENT'):
+            header = lines[i + 1].split(',')
+            values = lines[i + 2].split(',')
+            if 'Category' in header and \
+                    header.index('Category') < len(values):
+                return values[header.index('Category')].strip().lower()
+    return None
+
+
+class ThroughputModel(object):
+    """Observed Qa throughput by dataset, to estimate the cost of files."""
+
+    def __init__(self, history_path=None):
+        """
+        Load throughput history
+
+        :param history_path: path to JSON throughput history (optional)
+        """
+
+        self._history_path = history_path
+        self._throughput = dict(DEFAULT_THROUGHPUT)
+        if history_path is not None and os.path.exists(history_path):
+            try:
+                with open(history_path) as ff:
+                    self._throughput.update(json.load(ff))
+            except (IOError, ValueError) as err:
+                msg = 'Unable to load throughput history %s. Due to: %s' % (
+                    history_path, err)
+                LOGGER.warning(msg)
+
+    @property
+    def throughput(self):
+        """
+        :returns: dict of dataset to throughput (bytes per second)
+        """
+
+        return self._throughput
+
+    def estimate(self, size, dataset):
+        """
+        Estimate the time to quality assess a file
+
+        :param size: file size (bytes)
+        :param dataset: dataset (lowercase)
+        :returns: estimated seconds
+        """
+
+        return size / self._throughput.get(dataset, UNKNOWN_THROUGHPUT)
+
+    def update(self, dataset, size, seconds):
+        """
+        Record the time taken to quality assess a file
+
+        :param dataset: dataset (lowercase)
+        :param size: file size (bytes)
+        :param seconds: seconds taken
+        """
+
+        if dataset is None or seconds <= 0:
+            return
+        observed = size / seconds
+        if dataset in self._throughput:
+            observed = (THROUGHPUT_WEIGHT * observed +
+                        (1 - THROUGHPUT_WEIGHT) * self._throughput[dataset])
+        self._throughput[dataset] = observed
+
+    def save(self):
+        """
+        Write throughput history
+        """
+
+        if self._history_path is None:
+            return
+        try:
+            with open(self._history_path, 'w') as ff:
+                json.dump(self._throughput, ff, indent=1, sort_keys=True)
+        except IOError as err:
+            msg = 'Unable to save throughput history %s. Due to: %s' % (
+                self._history_path, err)
+            LOGGER.warning(msg)
+
+
+def plan(files, workers, model):
+    """
+    Assign files to workers by estimated cost
+
+    Datasets and files are assigned largest first. Files of a dataset
+    stay on one worker until the next file would take it past its share
+    of the total cost while another worker has room for it; they then
+    continue on the least loaded worker.
+
+    :param files: list of (file_path, size, dataset) tuples
+    :param workers: number of workers
+    :param model: ThroughputModel object
+    Members of a compressed tar archive are one unit of work: they go
+    to one worker, in the order given (archive order, see find_files),
+    so that the archive is decompressed in one pass.
+
+    :returns: list of deques of (cost, file_path, size, dataset) per
+        worker, largest first; a file listed twice is planned once
+    """
+
+    groups = OrderedDict()
+    archives = OrderedDict()
+    planned = set()
+    for file_path, size, dataset in files:
+        # results of workers are matched to tasks by file path
+        if file_path in planned:
+            continue
+        planned.add(file_path)
+        task = (model.estimate(size, dataset), file_path, size, dataset)
+        if is_compressed_member(file_path):
+            archive_path = split_file_id(file_path)[0]
+            archives.setdefault(archive_path, []).append(task)
+        else:
+            groups.setdefault(dataset, []).append([task])
+    # a unit of work is a file, or the members of a compressed archive
+    for tasks in archives.values():
+        groups[tasks[0][1]] = [tasks]
+    total = sum(task[0] for units in groups.values() for unit in units
+                for task in unit)
+    share = total / workers
+
+    queues = [[] for _ in range(workers)]
+    loads = [0.0] * workers
+    for units in sorted(groups.values(), key=lambda units: (
+            -sum(_cost(unit) for unit in units), units[0][0][1])):
+        current = None
+        for unit in sorted(units, key=lambda unit: (-_cost(unit),
+                                                    unit[0][1])):
+            cost = _cost(unit)
+            least = loads.index(min(loads))
+            if current is None or (loads[current] + cost > share and
+                                   loads[current] > loads[least] + cost):
+                current = least
+            queues[current].append(unit)
+            loads[current] += cost
+
+    return [deque(task for unit in sorted(queue, key=lambda unit: (
+        -_cost(unit), unit[0][1])) for task in unit) for queue in queues]
+
+
+def _cost(unit):
+    """
+    helper function: estimated cost of a unit of work (list of tasks)
+    """
+
+    return sum(task[0] for task in unit)
+
+
+def check_file(checker, file_path, budget=None, hard_limit=False,
+               content=None, timings=None, digests=None):
+    """
+    Quality assess one file, never raising
+
+    :param checker: QualityChecker object
+    :param file_path: path to file
+    :param budget: QaBudget of the file, from reading on (optional)
+    :param hard_limit: enforce the hard time limit of the budget (for
+        worker processes, see QaBudget.start)
+    :param content: file content, if already read (optional).  If not
+        given, large files are memory-mapped (see woudc_qa.mapped)
+    :param timings: dict to set the seconds spent reading (read, if
+        content is not given and the file is not mapped), parsing (parse,
+        including reads of a mapped file) and checking (check) in
+        (optional)
+    :param digests: dict to set the content hash of the file in, by
+        file path, hashed while the content is at hand (optional)
+    :returns: tuple of status (passed, failed, exceeded or error),
+        QaResult object (None on error; results so far when exceeded)
+        and message
+    """
+
+    if timings is None:
+        timings = {}
+    if budget is not None:
+        budget.start(hard_limit)
+    try:
+        if content is None and is_mappable(file_path):
+            start = time.time()
+            ecsv = load_mapped(file_path)
+            if digests is not None:
+                # hashed from the pages just mapped
+                digests[file_path] = file_hash(file_path)
+        else:
+            if content is None:
+                start = time.time()
+                content = read_file(file_path)
+                timings['read'] = time.time() - start
+            if digests is not None:
+                digests[file_path] = hash_content(content)
+            start = time.time()
+            ecsv = loads(content)
+        timings['parse'] = time.time() - start
+        start = time.time()
+        qa_result = qa_extcsv(ecsv, file_path, checker=checker,
+                              budget=budget)
+        timings['check'] = time.time() - start
+    except WOUDCQaBudgetExceeded as err:
+        LOGGER.warning('Budget exceeded by %s. Due to: %s' %
+                       (file_path, err))
+        return 'exceeded', err.qa_result, str(err)
+    except Exception as err:
+        msg = 'Unable to quality assess %s. Due to: %s' % (file_path, err)
+        LOGGER.error(msg)
+        return 'error', None, str(err)
+    finally:
+        if budget is not None:
+            budget.stop()
+
+    violations = qa_result.violations()
+    if violations:
+        return 'failed', qa_result, '%s violation(s)' % len(violations)
+    return 'passed', qa_result, None
+
+
+def run_batch(paths, rule_path=None, sink=None, reload_interval=None,
+              workers=0, history_path=None, journal=None, shard=None,
+              budget=None, read_ahead=READ_AHEAD, stats=None,
+              timeseries=None):
+    """
+    Quality assess many files with one compiled rule set
+
+    :param paths: list of file and/or directory paths
+    :param rule_path: path to qa rule definitions (optional)
+    :param sink: result sink (e.g. SQLiteResultSink) to write to (optional)
+    :param reload_interval: seconds between checks of the rule
+        definitions for changes (default: no hot reload)
+    :param workers: number of worker processes (default: check files
+        in-process, in path order)
+    :param history_path: path to JSON throughput history used to
+        schedule worker processes, updated after the run (optional)
+    :param journal: ProgressJournal object to record completed files in;
+        files it holds as completed with the same content and rule set
+        are skipped (optional)
+    :param shard: tuple of (shard number, number of shards): only check
+        the files of this shard (see shard_of) (optional)
+    :param budget: QaBudget of each file (optional)
+    :param read_ahead: number of files read ahead of checking, in
+        threads; 0 reads each file when it is checked
+    :param stats: PipelineStats to record per-stage busy and stall
+        time and queue depths in (optional)
+    :param timeseries: TimeSeriesStore time series checks continue the
+        series of, updated with each file and saved after the run; files
+        are checked in path order (in-process only) (optional)
+    :returns: generator of (file_path, status, QaResult, message) tuples,
+        in completion order with worker processes
+    """
+
+    # rebound by the watcher; each file uses the rule set current
+    # at the time it starts
+    checkers = [QualityChecker(rule_path)]
+    if timeseries is not None:
+        if workers:
+            LOGGER.warning('Time series store not used: files are checked '
+                           'in worker processes, out of date order')
+            timeseries = None
+        checkers[0].timeseries = timeseries
+
+    def swap(checker):
+        checker.timeseries = timeseries
+        checkers[0] = checker
+
+    watcher = None
+    if reload_interval:
+        watcher = RuleSetWatcher(checkers[0], swap, reload_interval)
+        watcher.start()
+
+    started = datetime.utcnow()
+    file_paths = find_files(paths)
+    if shard is not None:
+        file_paths = [file_path for file_path in file_paths
+                      if shard_of(file_path, shard[1]) == shard[0]]
+    shard_files = len(file_paths)
+    if journal is not None and journal.completed:
+        fingerprint = checkers[0].fingerprint
+        remaining = [file_path for file_path in file_paths
+                     if not journal.is_done(file_path, fingerprint)]
+        LOGGER.info('Resuming: skipping %s completed files',
+                    len(file_paths) - len(remaining))
+        file_paths = remaining
+
+    if workers:
+        results = _run_workers(file_paths, checkers, workers,
+                               ThroughputModel(history_path), budget,
+                               read_ahead, stats, journal is not None)
+    else:
+        results = _run_in_process(file_paths, checkers, budget, read_ahead,
+                                  stats, journal is not None)
+
+    checked = 0
+    complete = False
+    try:
+        for file_path, status, qa_result, message, digest in results:
+            checked += 1
+            if sink is not None:
+                sink.add(file_path, status, qa_result, message)
+            if journal is not None:
+                if digest is None:
+                    # not read (e.g. the worker exited)
+                    digest = file_hash(file_path)
+                journal.record(file_path, digest,
+                               getattr(qa_result, 'fingerprint',
+                                       checkers[0].fingerprint), status)
+                if journal.due:
+                    # results are stored before they are journaled
+                    if sink is not None:
+                        sink.flush()
+                    journal.flush()
+            yield file_path, status, qa_result, message
+        complete = True
+    finally:
+        if watcher is not None:
+            watcher.stop()
+            watcher.join()
+        if sink is not None:
+            sink.add_run({
+                'shard': shard[0] if shard is not None else 1,
+                'shard_count': shard[1] if shard is not None else 1,
+                'rule_set': checkers[0].fingerprint,
+                'paths': json.dumps(paths),
+                'host': socket.gethostname(),
+                'started': started.isoformat(),
+                'finished': datetime.utcnow().isoformat(),
+                'files': shard_files,
+                'checked': checked,
+                'complete': int(complete)
+            })
+            sink.flush()
+        if journal is not None:
+            journal.flush()
+        if timeseries is not None:
+            timeseries.save()
+
+
+def _run_in_process(file_paths, checkers, budget=None, read_ahead=0,
+                    stats=None, hashed=False):
+    """
+    helper function: quality assess files in path order, in-process
+
+    :param file_paths: list of file paths
+    :param checkers: list holding the current QualityChecker
+    :param budget: QaBudget of each file (optional)
+    :param read_ahead: number of files read ahead (large files are
+        memory-mapped, and members of compressed archives read in
+        archive order, instead)
+    :param stats: PipelineStats (optional)
+    :param hashed: whether to hash the content of each file
+    :returns: generator of (file_path, status, QaResult, message,
+        content hash) tuples, the content hash None if not hashed
+    """
+
+    direct = _read_directly(file_paths)
+    reader = None
+    if read_ahead:
+        reader = ReadAhead([file_path for file_path in file_paths
+                            if file_path not in direct],
+                           read_ahead, stats=stats)
+    try:
+        for file_path in file_paths:
+            content = None
+            stall = 0.0
+            if reader is not None and file_path not in direct:
+                start = time.time()
+                content = reader.get(file_path)
+                stall = time.time() - start
+            timings = {}
+            digests = {} if hashed else None
+            result = check_file(checkers[0], file_path, budget,
+                                content=content, timings=timings,
+                                digests=digests)
+            if stats is not None:
+                _add_stats(stats, timings, stall,
+                           reader.depth if reader is not None else 0)
+            yield (file_path,) + result + ((digests or {}).get(file_path),)
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+def _add_stats(stats, timings, stall, depth, in_flight_depth=None):
+    """
+    helper function: record the stages of one file
+
+    :param stats: PipelineStats object
+    :param timings: dict of seconds by stage (see check_file), and
+        seconds the worker process idled before the file (idle)
+    :param stall: seconds waited for the file to be read ahead
+    :param depth: number of files read ahead at the time
+    :param in_flight_depth: number of files sent to worker processes at
+        the time (optional)
+    """
+
+    if 'read' in timings:
+        # read when checked: parsing waited on it
+        stats.add('read', timings['read'])
+        stall += timings['read']
+    stats.add('parse', timings.get('parse', 0.0), stall, depth)
+    stats.add('check', timings.get('check', 0.0), timings.get('idle', 0.0),
+              in_flight_depth)
+
+
+def _read_directly(file_paths):
+    """
+    helper function: files read by the process checking them rather than
+    read ahead, large files being memory-mapped and members of
+    compressed archives read in archive order
+
+    :returns: set of file paths
+    """
+
+    return set(file_path for file_path in file_paths
+               if is_mappable(file_path) or is_compressed_member(file_path))
+
+
+def _dispatch_order(queues):
+    """
+    helper function: files in the order worker processes are expected
+    to start them, from the estimated costs of their queues
+    """
+
+    starts = []
+    for queue in queues:
+        clock = 0.0
+        for task in queue:
+            starts.append((clock, task[1]))
+            clock += task[0]
+    return [start[1] for start in sorted(starts)]
+
+
+def _run_workers(file_paths, checkers, workers, model, budget=None,
+                 read_ahead=0, stats=None, hashed=False):
+    """
+    helper function: quality assess files in worker processes
+
+    :param file_paths: list of file paths
+    :param checkers: list holding the current QualityChecker
+    :param workers: number of worker processes
+    :param model: ThroughputModel object
+    :param budget: QaBudget of each file (optional)
+    :param read_ahead: number of files read ahead, in the expected
+        order of dispatch
+    :param stats: PipelineStats (optional)
+    :param hashed: whether worker processes hash the content of each
+        file
+    :returns: generator of (file_path, status, QaResult, message,
+        content hash) tuples, the content hash None if not hashed
+    """
+
+    files = []
+    for file_path in file_paths:
+        try:
+            size = file_size(file_path)
+        except OSError:
+            size = 0
+        files.append((file_path, size, peek_dataset(file_path)))
+    queues = plan(files, workers, model)
+    direct = _read_directly(file_paths)
+    streamed = set(filter(is_compressed_member, file_paths))
+
+    inboxes = [None] * workers
+    processes = [None] * workers
+    retired = []
+    # one result pipe per worker process, so that a process exiting
+    # while sending leaves no lock held for the others
+    receivers = []
+
+    def start(worker):
+        inboxes[worker] = multiprocessing.Queue()
+        receiver, sender = multiprocessing.Pipe(False)
+        processes[worker] = multiprocessing.Process(
+            target=_work,
+            args=(worker, checkers[0], inboxes[worker], sender, budget,
+                  hashed))
+        processes[worker].daemon = True
+        processes[worker].start()
+        sender.close()
+        receivers.append(receiver)
+
+    for worker in range(workers):
+        start(worker)
+
+    # read ahead once forked, so that no reading thread holds a lock
+    # the worker processes inherit
+    reader = None
+    if read_ahead:
+        reader = ReadAhead([file_path for file_path in _dispatch_order(queues)
+                            if file_path not in direct],
+                           read_ahead, stats=stats)
+
+    in_flight = [[] for _ in range(workers)]
+    # process each task was sent to (recycling replaces a worker's)
+    owners = {}
+    # (seconds waited for the read, read-ahead depth, tasks in flight)
+    # at dispatch
+    waits = {}
+    fingerprint = checkers[0].fingerprint
+
+    def send(worker):
+        # own largest file first, else steal the smallest file of the
+        # worker with the most work left; members of compressed
+        # archives stay with their worker, to be read in one pass
+        if queues[worker]:
+            task = queues[worker].popleft()
+        else:
+            victims = [i for i in range(workers) if queues[i] and
+                       queues[i][-1][1] not in streamed]
+            if not victims:
+                return
+            victim = max(victims, key=lambda i: (
+                sum(task[0] for task in queues[i]), -i))
+            task = queues[victim].pop()
+        content = None
+        stall = 0.0
+        if reader is not None and task[1] not in direct:
+            start = time.time()
+            content = reader.get(task[1])
+            stall = time.time() - start
+        in_flight[worker].append(task)
+        owners[task[1]] = processes[worker]
+        waits[task[1]] = (stall, reader.depth if reader is not None else 0,
+                          sum(len(tasks) for tasks in in_flight))
+        inboxes[worker].put(('check', task[1], content))
+
+    try:
+        for worker in range(workers):
+            for _ in range(PREFETCH):
+                send(worker)
+
+        while any(in_flight):
+            if checkers[0].fingerprint != fingerprint:
+                fingerprint = checkers[0].fingerprint
+                for inbox in inboxes:
+                    inbox.put(('reload', checkers[0]))
+            try:
+                worker, file_path, status, qa_result, message, timings, \
+                    digest = _receive(receivers, 1)
+            except Empty:
+                lost = [[task for task in in_flight[worker]
+                         if not owners[task[1]].is_alive()]
+                        for worker in range(workers)]
+                # results of exited workers may have arrived since
+                if any(lost) and any(receiver.poll()
+                                     for receiver in receivers):
+                    continue
+                for worker in range(workers):
+                    if not lost[worker]:
+                        continue
+                    # lost with the worker
+                    for task in lost[worker]:
+                        msg = 'Worker exited while checking %s' % task[1]
+                        LOGGER.error(msg)
+                        in_flight[worker].remove(task)
+                        del owners[task[1]], waits[task[1]]
+                        yield task[1], 'error', None, msg, None
+                    # a fresh worker takes over the exited one's queue
+                    if not processes[worker].is_alive():
+                        retired.append(processes[worker])
+                        start(worker)
+                    for _ in range(PREFETCH - len(in_flight[worker])):
+                        send(worker)
+                continue
+            task = [task for task in in_flight[worker]
+                    if task[1] == file_path][0]
+            in_flight[worker].remove(task)
+            del owners[file_path]
+            stall, depth, in_flight_depth = waits.pop(file_path)
+            if stats is not None:
+                _add_stats(stats, timings, stall, depth, in_flight_depth)
+            if status == 'exceeded':
+                # recycle: the worker exits once done with the files
+                # already queued to it; new files go to a fresh one
+                inboxes[worker].put(None)
+                retired.append(processes[worker])
+                start(worker)
+            elif status != 'error':
+                model.update(task[3], task[2],
+                             timings['parse'] + timings['check'])
+            send(worker)
+            yield file_path, status, qa_result, message, digest
+    finally:
+        if reader is not None:
+            reader.close()
+        for inbox, process in zip(inboxes, processes):
+            if process.is_alive():
+                inbox.put(None)
+        for process in processes + retired:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        for receiver in receivers:
+            receiver.close()
+        model.save()
+
+
+def _receive(receivers, timeout):
+    """
+    helper function: receive the next result of any worker process
+
+    :param receivers: list of result pipe ends, one per worker process;
+        those of exited processes are closed and removed
+    :param timeout: seconds to wait for a result
+    :returns: result tuple sent by _work
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        for receiver in list(receivers):
+            if not receiver.poll():
+                continue
+            try:
+                return receiver.recv()
+            except EOFError:
+                # the worker process has exited
+                receiver.close()
+                receivers.remove(receiver)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Empty
+        if os.name == 'posix':
+            select.select(receivers, [], [], remaining)
+        else:  # pipes are not selectable on Windows
+            time.sleep(min(remaining, 0.01))
+
+
+def _work(worker, checker, inbox, outbox, budget=None, hashed=False):
+    """
+    helper function: worker process loop, sending results to the outbox
+    pipe end, with the content hash of each file if hashed
+    """
+
+    # leave interrupt handling to the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        start = time.time()
+        message = inbox.get()
+        idle = time.time() - start
+        if message is None:
+            break
+        if message[0] == 'reload':
+            # the rule set the parent process validated, rather than
+            # reading rule definitions that may have changed since
+            checker = message[1]
+            continue
+        action, file_path, content = message
+        timings = {'idle': idle}
+        digests = {} if hashed else None
+        status, qa_result, message = check_file(
+            checker, file_path, budget, True, content, timings, digests)
+        if qa_result is not None:
+            # retrieved while the parsed file is at hand; it is not
+            # sent back to the parent process
+            for table, field in METADATA:
+                try:
+                    qa_result.get_metadata(table, field)
+                except Exception:
+                    pass
+        outbox.send((worker, file_path, status, qa_result, message,
+                     timings, (digests or {}).get(file_path)))
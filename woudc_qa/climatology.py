@@ -0,0 +1,380 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Climatology grids
+#
+# A climatology grid holds the mean and standard deviation of a profile
+# column by latitude band, month and level (pressure or altitude), built
+# from historical files. Grids are stored in a compact binary file (a
+# header, the grid definition and the float32 grid) and memory-mapped
+# when first used; range function RC_9 checks each profile row against
+# the statistics of its latitude band and month, interpolated to the
+# level of the row.
+
+import logging
+import marshal
+import os
+import struct
+import threading
+
+import numpy as np
+
+from woudc_qa import load
+from woudc_qa.arrays import level_coordinates, parse_column
+from woudc_qa.batch import find_files
+from woudc_qa.dataset_handlers import DATASET_HANDLERS
+from woudc_qa.util import get_extcsv_columns, get_extcsv_value,\
+    get_table_count
+
+LOGGER = logging.getLogger(__name__)
+
+CLIMATOLOGY_MAGIC = 'WOUDCCL\x00'
+
+# bump whenever the layout changes
+CLIMATOLOGY_VERSION = 1
+
+# magic, climatology version, grid definition length
+HEADER = struct.Struct('<8sHI')
+
+# statistics by cell: mean, standard deviation, number of values
+STATISTICS = 3
+
+# open climatologies by path, with the modification time they were read at
+_CLIMATOLOGIES = {}
+_CLIMATOLOGIES_LOCK = threading.Lock()
+
+
+class Climatology(object):
+    """Memory-mapped climatology grid."""
+
+    def __init__(self, path):
+        """
+        Map a climatology grid file
+
+        :param path: path to climatology grid
+        """
+
+        with open(path, 'rb') as ff:
+            magic, version, length = HEADER.unpack(ff.read(HEADER.size))
+            if magic != CLIMATOLOGY_MAGIC or \
+                    version != CLIMATOLOGY_VERSION:
+                msg = 'Unsupported climatology grid: %s' % path
+                LOGGER.error(msg)
+                raise ValueError(msg)
+            definition = marshal.loads(ff.read(length))
+
+        self.path = path
+        self.table = definition['table']
+        self.element = definition['element']
+        self.level = definition['level']
+        self.log = definition['log']
+        self.levels = definition['levels']
+        self.latitude_step = definition['latitude_step']
+        bands = _band_count(self.latitude_step)
+        self._grid = np.memmap(path, dtype='<f4', mode='r',
+                               offset=_data_offset(length),
+                               shape=(bands, 12, len(self.levels),
+                                      STATISTICS))
+        # levels as interpolated: ascending coordinates
+        coordinates = level_coordinates(np.array(self.levels), self.log)
+        self._order = np.argsort(coordinates)
+        self._coordinates = coordinates[self._order]
+
+    def band(self, latitude):
+        """
+        Get the latitude band of a latitude
+
+        :param latitude: latitude (degrees)
+        :returns: latitude band index
+        """
+
+        return _band(latitude, self.latitude_step)
+
+    def statistics(self, latitude, month, levels, valid):
+        """
+        Interpolate the statistics of a latitude band and month to the
+        levels of a profile
+
+        :param latitude: latitude of the profile (degrees)
+        :param month: month of the profile (1 to 12)
+        :param levels: float64 array of levels of the profile rows
+        :param valid: boolean array of which levels are numbers
+        :returns: tuple of float64 arrays of means and standard
+            deviations, NaN for rows out of the grid or in cells
+            without enough values
+        """
+
+        cells = self._grid[self.band(latitude), month - 1]
+        means = cells[self._order, 0].astype(np.float64)
+        deviations = cells[self._order, 1].astype(np.float64)
+        coordinates = self._coordinates
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x = level_coordinates(levels, self.log)
+            inside = valid & (x >= coordinates[0]) & \
+                (x <= coordinates[-1])
+            upper = np.clip(np.searchsorted(coordinates, x), 1,
+                            len(coordinates) - 1)
+            lower = upper - 1
+            weights = (x - coordinates[lower]) / \
+                (coordinates[upper] - coordinates[lower])
+            mean = means[lower] + weights * (means[upper] - means[lower])
+            deviation = deviations[lower] + \
+                weights * (deviations[upper] - deviations[lower])
+        mean[~inside] = np.nan
+        deviation[~inside] = np.nan
+        return mean, deviation
+
+
+def open_climatology(path):
+    """
+    Get a climatology grid, mapped once per path (and again when the file
+    changes)
+
+    :param path: path to climatology grid
+    :returns: Climatology object
+    """
+
+    mtime = os.path.getmtime(path)
+    with _CLIMATOLOGIES_LOCK:
+        entry = _CLIMATOLOGIES.get(path)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, Climatology(path))
+            _CLIMATOLOGIES[path] = entry
+    return entry[1]
+
+
+def climatology_reference(extcsv, arrays, rule, table_index):
+    """
+    Get the climatology statistics of each row of a profile
+
+    :param extcsv: woudc_extcsv Reader object (handled)
+    :param arrays: ProfileArrays of the file
+    :param rule: QaRule of the test (function_parameter_c: path to
+        climatology grid)
+    :param table_index: table index of the profile
+    :returns: tuple of float64 arrays of means and standard deviations
+        by row (see Climatology.statistics), or None if the file has no
+        location, date or levels
+    """
+
+    climatology = open_climatology(rule.param_c)
+    latitude, month = _position(extcsv)
+    if latitude is None:
+        return None
+    column = arrays.column(rule.table, table_index, climatology.level)
+    if column is None:
+        return None
+    return climatology.statistics(latitude, month, *column)
+
+
+def build_climatology(paths, output, table, element, level, levels,
+                      latitude_step=10, min_count=10, log=None):
+    """
+    Build a climatology grid from historical files
+
+    :param paths: list of file, directory and/or archive paths
+    :param output: path to climatology grid
+    :param table: profile table (e.g. PROFILE)
+    :param element: profile column (e.g. derived:VMR)
+    :param level: column of the levels (e.g. Pressure)
+    :param levels: list of grid levels
+    :param latitude_step: latitude band width (degrees)
+    :param min_count: fewest values of a cell with statistics
+    :param log: interpolate in log(level) (default: level is Pressure)
+    :returns: number of files the grid was built from
+    """
+
+    if len(levels) < 2:
+        msg = 'Unable to build climatology: at least two levels needed'
+        LOGGER.error(msg)
+        raise ValueError(msg)
+    if log is None:
+        log = level == 'Pressure'
+    coordinates = level_coordinates(np.array(levels, dtype=np.float64), log)
+    order = np.argsort(coordinates)
+    midpoints = (coordinates[order][:-1] + coordinates[order][1:]) / 2
+    first, last = coordinates[order][0], coordinates[order][-1]
+
+    bands = _band_count(latitude_step)
+    shape = (bands, 12, len(levels))
+    counts = np.zeros(shape)
+    sums = np.zeros(shape)
+    squares = np.zeros(shape)
+    files = 0
+    for file_id in find_files(paths):
+        try:
+            extcsv = load(file_id)
+            dataset = get_extcsv_value(extcsv, 'CONTENT', 'Category')
+            if dataset is not None and \
+                    dataset.lower() in DATASET_HANDLERS:
+                extcsv = DATASET_HANDLERS[dataset.lower()](extcsv).extcsv
+            latitude, month = _position(extcsv)
+        except Exception as err:
+            msg = 'Unable to read %s. Due to: %s' % (file_id, err)
+            LOGGER.warning(msg)
+            continue
+        if latitude is None:
+            continue
+        cell = (_band(latitude, latitude_step), month - 1)
+        used = False
+        for ti in range(1, get_table_count(extcsv, table) + 1):
+            columns = get_extcsv_columns(extcsv, table, [element, level],
+                                         ti)
+            if columns is None or not columns[element] or \
+                    len(columns[element]) != len(columns[level]):
+                continue
+            values, valid = parse_column(columns[element])
+            heights, h_valid = parse_column(columns[level])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                x = level_coordinates(heights, log)
+                rows = valid & h_valid & (x >= first) & (x <= last)
+            # nearest grid level of each row
+            nearest = order[np.searchsorted(midpoints, x[rows])]
+            values = values[rows]
+            counts[cell] += np.bincount(nearest, minlength=len(levels))
+            sums[cell] += np.bincount(nearest, values, len(levels))
+            squares[cell] += np.bincount(nearest, values * values,
+                                         len(levels))
+            used = used or rows.any()
+        files += used
+
+    grid = np.empty(shape + (STATISTICS,), dtype='<f4')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        deviations = np.sqrt(np.maximum(squares / counts - means * means,
+                                        0))
+    known = counts >= max(min_count, 1)
+    grid[..., 0] = np.where(known, means, np.nan)
+    grid[..., 1] = np.where(known, deviations, np.nan)
+    grid[..., 2] = counts
+
+    definition = marshal.dumps({
+        'table': table,
+        'element': element,
+        'level': level,
+        'log': log,
+        'levels': [float(value) for value in levels],
+        'latitude_step': latitude_step
+    })
+    header = HEADER.pack(CLIMATOLOGY_MAGIC, CLIMATOLOGY_VERSION,
+                         len(definition))
+
+    # write aside and rename, so readers never see a partial grid
+    tmp_path = '%s.%s.tmp' % (output, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as ff:
+            ff.write(header)
+            ff.write(definition)
+            ff.write('\x00' * (_data_offset(len(definition)) -
+                               HEADER.size - len(definition)))
+            ff.write(grid.tobytes())
+        os.rename(tmp_path, output)
+    except Exception as err:
+        msg = 'Unable to write climatology %s. Due to: %s' % (output, err)
+        LOGGER.error(msg)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise err
+
+    return files
+
+
+def _position(extcsv):
+    """
+    helper function: latitude and month of a file
+
+    :param extcsv: woudc_extcsv Reader object
+    :returns: tuple of latitude (degrees) and month (1 to 12), or
+        (None, None) if either is missing or invalid
+    """
+
+    try:
+        latitude = float(get_extcsv_value(extcsv, 'LOCATION', 'Latitude'))
+        month = int(get_extcsv_value(extcsv, 'TIMESTAMP', 'Date')
+                    .split('-')[1])
+    except (AttributeError, IndexError, TypeError, ValueError):
+        LOGGER.warning('No LOCATION.Latitude or TIMESTAMP.Date')
+        return None, None
+    if not -90 <= latitude <= 90 or not 1 <= month <= 12:
+        LOGGER.warning('Invalid latitude %s or month %s', latitude, month)
+        return None, None
+    return latitude, month
+
+
+def _band_count(latitude_step):
+    """
+    helper function: number of latitude bands
+
+    :param latitude_step: latitude band width (degrees)
+    :returns: number of latitude bands from -90 to 90
+    """
+
+    return int(np.ceil(180.0 / latitude_step))
+
+
+def _band(latitude, latitude_step):
+    """
+    helper function: latitude band of a latitude
+
+    :param latitude: latitude (degrees)
+    :param latitude_step: latitude band width (degrees)
+    :returns: latitude band index
+    """
+
+    return min(int((latitude + 90) // latitude_step),
+               _band_count(latitude_step) - 1)
+
+
+def _data_offset(length):
+    """
+    helper function: offset of the grid, aligned to 8 bytes
+
+    :param length: length of the grid definition
+    :returns: offset of the grid in the file
+    """
+
+    return (HEADER.size + length + 7) // 8 * 8
@@ -0,0 +1,460 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Shared column buffers
+#
+# Numeric payload columns of a file are written once to a memory-mapped
+# file (in /dev/shm where available). Worker processes, forked with the
+# compiled rule set, map the same file, evaluate profile range, step and
+# statistical checks with the vectorized functions of woudc_qa.arrays
+# over the mapped columns and write outcome codes into result buffers in
+# the same file, so neither the parsed file nor the results are pickled
+# between processes. Reference data of lookup functions (e.g. RC_9) is
+# computed once and written alongside the columns.
+#
+# Long columns are split into row chunks evaluated concurrently. A step
+# check compares each row with the next, so a step check chunk reads
+# one row past its end (a halo row); a statistical check chunk reads the
+# rolling windows of its rows, which reach past its ends. Each chunk
+# writes only its own rows of the result buffer, so merged results are
+# identical to a sequential run regardless of completion order.
+
+import logging
+import mmap
+import os
+import signal
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from woudc_qa.arrays import ARRAY_FUNCTIONS, COLUMN_FUNCTIONS,\
+    LOOKUP_FUNCTIONS, lookup_reference, range_codes, statistical_codes,\
+    step_codes
+from woudc_qa.util import get_table_ranges
+
+LOGGER = logging.getLogger(__name__)
+
+# files with fewer profile values are checked in-process
+MIN_ROWS = 1000
+
+# rows per task
+CHUNK_ROWS = 2000
+
+# test categories evaluated in worker processes
+CATEGORIES = ['range', 'step', 'statistical']
+
+SHM_DIR = '/dev/shm'
+
+# per-worker QualityChecker, set by _init_worker
+_CHECKER = None
+
+
+class ColumnBuffers(object):
+    """Numeric columns and result buffers in a shared memory-mapped file."""
+
+    def __init__(self, columns, result_sizes, directory=None):
+        """
+        Allocate shared buffers and fill in columns
+
+        :param columns: list of columns, each a tuple of float64 array of
+            values and boolean array of which values are numbers
+        :param result_sizes: list of result buffer lengths
+        :param directory: directory of the backing file (optional,
+            default: /dev/shm if available)
+        """
+
+        if directory is None and os.path.isdir(SHM_DIR):
+            directory = SHM_DIR
+
+        # per column: float64 values, then one validity byte per value
+        self._columns = []
+        offset = 0
+        for values, _ in columns:
+            count = len(values)
+            self._columns.append((offset, offset + 8 * count, count))
+            offset += 9 * count + (-count % 8)
+        self._results = []
+        for count in result_sizes:
+            self._results.append((offset, count))
+            offset += count
+        self._size = max(offset, 1)
+
+        fd, self._path = tempfile.mkstemp(prefix='woudc-qa-', dir=directory)
+        try:
+            os.ftruncate(fd, self._size)
+            self._buf = mmap.mmap(fd, self._size)
+        except Exception as err:
+            msg = 'Unable to allocate column buffers. Due to: %s' % err
+            LOGGER.error(msg)
+            os.remove(self._path)
+            raise err
+        finally:
+            os.close(fd)
+
+        for (values, valid), column in zip(columns, self._columns):
+            _write_column(self._buf, column, values, valid)
+
+    @property
+    def path(self):
+        """
+        :returns: path of the backing file, for workers to attach to
+        """
+
+        return self._path
+
+    @property
+    def columns(self):
+        """
+        :returns: list of (values offset, validity offset, count)
+        """
+
+        return self._columns
+
+    @property
+    def results(self):
+        """
+        :returns: list of (offset, count) of result buffers
+        """
+
+        return self._results
+
+    def result(self, i):
+        """
+        Read a result buffer
+
+        :param i: index of result buffer
+        :returns: bytearray of outcome codes
+        """
+
+        offset, count = self._results[i]
+        return bytearray(self._buf[offset:offset + count])
+
+    def close(self):
+        """
+        Unmap and remove the backing file
+        """
+
+        self._buf.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+class ColumnPool(object):
+    """Worker processes evaluating profile checks of large files."""
+
+    def __init__(self, checker, processes=None, min_rows=MIN_ROWS,
+                 chunk_rows=CHUNK_ROWS):
+        """
+        Start worker processes holding the compiled rule set
+
+        :param checker: QualityChecker object
+        :param processes: number of worker processes (default: number
+            of CPUs)
+        :param min_rows: minimum number of profile values of a file to
+            evaluate in worker processes
+        :param chunk_rows: maximum number of rows per task
+        """
+
+        self._checker = checker
+        self._min_rows = min_rows
+        self._chunk_rows = chunk_rows
+        self._pool = Pool(processes, _init_worker, (checker,))
+
+    @property
+    def checker(self):
+        """
+        :returns: QualityChecker of the worker processes
+        """
+
+        return self._checker
+
+    def evaluate(self, qa_result):
+        """
+        Evaluate profile range, step and statistical checks of a file in
+        the worker processes, one task per row chunk of a rule and table
+        instance
+
+        :param qa_result: QaResult object
+        :returns: dict of outcome codes (see OUTCOMES) by (test_id,
+            table index), empty if the file is too small to split.
+            Checks that cannot be evaluated vectorized (e.g. parameters
+            not numbers) are left out
+        """
+
+        if qa_result.fingerprint != self.checker.fingerprint:
+            raise ValueError('Qa result and pool rule sets differ')
+
+        rules = self.checker.compiled_rules.get(qa_result.dataset, [])
+        tasks, columns = _plan(qa_result, rules)
+        if sum(len(values) for values, _ in columns.values()) < \
+                self._min_rows:
+            return {}
+        tasks = _add_references(qa_result, rules, tasks, columns)
+
+        keys = list(columns.keys())
+        buffers = ColumnBuffers([columns[key] for key in keys],
+                                [len(columns[task[3][0]][0])
+                                 for task in tasks])
+        try:
+            chunks = []
+            owners = []
+            for i, (index, _, _, task_keys) in enumerate(tasks):
+                task_columns = [buffers.columns[keys.index(key)]
+                                for key in task_keys]
+                for start in xrange(0, task_columns[0][2],
+                                    self._chunk_rows):
+                    chunks.append((buffers.path, qa_result.dataset, index,
+                                   task_columns, buffers.results[i], start,
+                                   start + self._chunk_rows))
+                    owners.append(i)
+            evaluated = [True] * len(tasks)
+            for i, done in zip(owners, self._pool.map(_evaluate, chunks)):
+                evaluated[i] = evaluated[i] and done
+            outcomes = {}
+            for i, (_, test_id, ti, _) in enumerate(tasks):
+                if evaluated[i]:
+                    outcomes[(test_id, ti)] = buffers.result(i)
+        finally:
+            buffers.close()
+
+        return outcomes
+
+    def close(self):
+        """
+        Stop worker processes
+        """
+
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _plan(qa_result, rules):
+    """
+    helper function: find profile range, step and statistical checks and
+    parse the columns they evaluate, one pass per table instance
+
+    :param qa_result: QaResult object
+    :param rules: compiled rules of the dataset
+    :returns: tuple of list of (rule index, test_id, table index, column
+        keys) tasks, the column checked first, and dict of column key to
+        (values, valid)
+    """
+
+    tasks = []
+    fields = OrderedDict()
+    for index, rule in enumerate(rules):
+        if not rule.status or not rule.profile or \
+                rule.category not in CATEGORIES or \
+                rule.function not in ARRAY_FUNCTIONS[rule.category]:
+            continue
+        a, b = get_table_ranges(qa_result.extcsv, rule.table,
+                                rule.table_index)
+        for ti in range(a, b):
+            needed = fields.setdefault((rule.table, ti), [])
+            keys = [(rule.table, ti, rule.element)]
+            needed.append(rule.element)
+            if rule.function in COLUMN_FUNCTIONS:
+                keys.append((rule.table, ti, rule.param_c))
+                needed.append(rule.param_c)
+            tasks.append((index, rule.test_id, ti, keys))
+
+    arrays = qa_result.arrays
+    columns = {}
+    for (table, ti), needed in fields.iteritems():
+        arrays.prefetch(table, ti, needed)
+        for field in needed:
+            column = arrays.column(table, ti, field)
+            if column is not None:
+                columns[(table, ti, field)] = column
+
+    return [(index, test_id, ti, [key for key in task_keys if key in columns])
+            for index, test_id, ti, task_keys in tasks
+            if task_keys[0] in columns], columns
+
+
+def _add_references(qa_result, rules, tasks, columns):
+    """
+    helper function: add the reference data of lookup functions to the
+    columns, for workers to check against
+
+    :param qa_result: QaResult object
+    :param rules: compiled rules of the dataset
+    :param tasks: list of tasks (see _plan)
+    :param columns: dict of column key to (values, valid), updated
+    :returns: list of tasks, with the column keys of their reference data
+    """
+
+    added = []
+    for index, test_id, ti, keys in tasks:
+        rule = rules[index]
+        if rule.function in LOOKUP_FUNCTIONS:
+            reference = lookup_reference(qa_result.extcsv, qa_result.arrays,
+                                         rule, ti)
+            if reference is not None:
+                if not isinstance(reference, tuple):
+                    reference = (reference,)
+                for i, values in enumerate(reference):
+                    key = ('reference', test_id, ti, i)
+                    columns[key] = (values, np.ones(len(values), dtype=bool))
+                    keys = keys + [key]
+        added.append((index, test_id, ti, keys))
+    return added
+
+
+def _write_column(buf, column, values, valid):
+    """
+    helper function: write column values
+
+    :param buf: memory-mapped buffers
+    :param column: (values offset, validity offset, count)
+    :param values: float64 array of values
+    :param valid: boolean array of which values are numbers
+    """
+
+    offset, valid_offset, count = column
+    buf[offset:offset + 8 * count] = values.astype('<f8').tobytes()
+    buf[valid_offset:valid_offset + count] = valid.astype(np.uint8).tobytes()
+
+
+def _map_column(buf, column):
+    """
+    helper function: map column values without copying
+
+    :param buf: memory-mapped buffers
+    :param column: (values offset, validity offset, count)
+    :returns: tuple of float64 array of values and boolean array of
+        which values are numbers
+    """
+
+    offset, valid_offset, count = column
+    return (np.frombuffer(buf, '<f8', count, offset),
+            np.frombuffer(buf, np.bool_, count, valid_offset))
+
+
+def _init_worker(checker):
+    """
+    helper function: keep the compiled rule set in the worker
+    """
+
+    global _CHECKER
+    # leave interrupt handling to the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _CHECKER = checker
+
+
+def _evaluate(task):
+    """
+    helper function: evaluate one row chunk of a profile check in a
+    worker process, writing outcome codes to its rows of the result
+    buffer
+
+    :returns: whether the check could be evaluated vectorized
+    """
+
+    path, dataset, index, columns, result, start, stop = task
+    rule = _CHECKER.compiled_rules[dataset][index]
+    offset, count = result
+    stop = min(stop, count)
+    with open(path, 'r+b') as ff:
+        buf = mmap.mmap(ff.fileno(), 0)
+    try:
+        codes = _chunk_codes(rule, buf, columns, start, stop)
+        if codes is None:
+            return False
+        buf[offset + start:offset + stop] = codes.tobytes()
+        return True
+    finally:
+        buf.close()
+
+
+def _chunk_codes(rule, buf, columns, start, stop):
+    """
+    helper function: outcome codes of one row chunk of a profile check
+
+    :param rule: QaRule of the test
+    :param buf: memory-mapped buffers
+    :param columns: list of (values offset, validity offset, count) of
+        the column checked and of its reference data
+    :param start: first row (0-based)
+    :param stop: row after the last row
+    :returns: uint8 array of outcome codes, or None if the check cannot
+        be evaluated vectorized
+    """
+
+    values, valid = _map_column(buf, columns[0])
+    if rule.category == 'statistical':
+        return statistical_codes(rule, values, valid, start, stop)
+
+    # one halo row: the last row of a step check chunk is compared with
+    # the first row of the next chunk; the last row of the column has
+    # no next row
+    end = stop + 1 if rule.category == 'step' else stop
+    references = [(ref_values[start:end], ref_valid[start:end])
+                  for ref_values, ref_valid in
+                  [_map_column(buf, column) for column in columns[1:]
+                   if column[2] == len(values)]]
+    reference = None
+    if rule.function in COLUMN_FUNCTIONS and references:
+        reference = references[0]
+    elif rule.function == 'RC_9' and len(references) == 2:
+        reference = references[0][0], references[1][0]
+    elif rule.function == 'RC_10' and references:
+        reference = references[0][0]
+    if rule.category == 'range':
+        return range_codes(rule, values[start:end], valid[start:end],
+                           reference)
+    codes = step_codes(rule, values[start:end], valid[start:end], reference)
+    if codes is None:
+        return None
+    return codes[:stop - start]
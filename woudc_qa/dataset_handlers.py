@@ -46,10 +46,42 @@
 # Dataset handlers
 
 import logging
-from woudc_qa.util import get_extcsv_value, set_extcsv_value
+import numpy as np
+from woudc_qa.arrays import parse_column, ProfileArrays
+from woudc_qa.util import get_extcsv_columns, get_extcsv_value,\
+    get_table_instances, set_extcsv_value
 
 LOGGER = logging.getLogger(__name__)
 
+# Dobson units per mPa of ozone partial pressure over one unit of
+# ln(pressure): the ozone column of a layer is this times the partial
+# pressure integrated over ln(pressure)
+DU_PER_MPA = 7.8898
+
+# dry air gas constant over standard gravity (m/K), and 0 C in K, for the
+# hypsometric equation
+RD_OVER_G0 = 287.05 / 9.80665
+ZERO_CELSIUS = 273.15
+
+# ACGIH/ICNIRP actinic hazard action spectrum: (wavelength (nm), weight),
+# interpolated in log(weight)
+ACGIH_SPECTRUM = (
+    (270, 1.0), (275, 0.96), (280, 0.88), (285, 0.77), (290, 0.64),
+    (295, 0.54), (297, 0.46), (300, 0.30), (303, 0.12), (305, 0.06),
+    (308, 0.026), (310, 0.015), (313, 0.006), (315, 0.003), (316, 0.0024),
+    (317, 0.0020), (318, 0.0016), (319, 0.0012), (320, 0.0010)
+)
+
+# upper wavelength (nm) of the ACGIH integral of spectral files
+ACGIH_LIMIT = 320
+
+# upper wavelength (nm) of the CIE erythemal action spectrum
+CIE_LIMIT = 400
+
+# spectral irradiance integrals in GLOBAL_SUMMARY are in mW/m2, spectra
+# in W/m2/nm
+SUMMARY_SCALE = 1000.0
+
 
 class OzoneSondeHandler(object):
     """Handles OzoneSonde files."""
@@ -88,7 +120,30 @@ class OzoneSondeHandler(object):
         # self.pump_flow_rate_uc()
         # self.response_time_uc()
         # self.pump_temperature_uc()
-        self.derive_volume_mixing_ratio()
+        # PROFILE columns are read once for all derivations
+        columns = self.get_profile_columns()
+        self.derive_volume_mixing_ratio(columns)
+        self.derive_integrated_ozone(columns)
+        self.derive_hydrostatic_height(columns)
+
+    def get_profile_columns(self):
+        """
+        get the PROFILE columns the derivations use, in one pass
+
+        :returns: dict of field to list of values, or None if the file
+            has no PROFILE table
+        """
+
+        try:
+            return get_extcsv_columns(
+                self.extcsv,
+                'PROFILE',
+                ['O3PartialPressure', 'Pressure', 'Temperature', 'GPHeight']
+            )
+        except Exception as err:
+            msg = 'Unable to get PROFILE columns. Due to: %s' % str(err)
+            LOGGER.error(msg)
+            raise err(msg)
 
     def pump_flow_rate_uc(self):
         """
@@ -173,38 +228,23 @@ class OzoneSondeHandler(object):
                 LOGGER.error(msg)
                 raise err(msg)
 
-    def derive_volume_mixing_ratio(self):
+    def derive_volume_mixing_ratio(self, columns=None):
         """
         derive and store volume mixing ration:
         Volume mixing ratio of ozone =
         (Partial pressure of ozone *10)/atmospheric pressure (hPa)
+
+        :param columns: PROFILE columns (see get_profile_columns),
+            read if not given
         """
 
-        try:
-            ppO3 = get_extcsv_value(
-                self.extcsv,
-                'PROFILE',
-                'O3PartialPressure',
-                payload=True
-            )
-        except Exception as err:
-            msg = 'Unable to get PROFILE.O3PartialPressure. Due to: %s' %\
-                str(err)
-            LOGGER.error(msg)
-            raise err(msg)
-
-        try:
-            pressure = get_extcsv_value(
-                self.extcsv,
-                'PROFILE',
-                'Pressure',
-                payload=True
-            )
-        except Exception as err:
-            msg = 'Unable to get PROFILE.Pressure. Due to: %s' %\
-                str(err)
-            LOGGER.error(msg)
-            raise err(msg)
+        if columns is None:
+            columns = self.get_profile_columns()
+        if columns is None:
+            ppO3, pressure = None, None
+        else:
+            ppO3 = columns['O3PartialPressure']
+            pressure = columns['Pressure']
 
         i = 0
         vmrs = []
@@ -243,6 +283,133 @@ class OzoneSondeHandler(object):
                 mode='add'
             )
 
+    def derive_integrated_ozone(self, columns=None):
+        """
+        derive and store the ozone column of the sounding:
+        FLIGHT_SUMMARY.derived:IntegratedO3 =
+        trapezoidal integral of the ozone partial pressure over
+        ln(pressure), from the ground to the burst (Dobson units)
+        FLIGHT_SUMMARY.derived:SondeTotalO3 =
+        derived:IntegratedO3 plus the residual column above the burst,
+        at the constant mixing ratio of the last level
+
+        :param columns: PROFILE columns (see get_profile_columns),
+            read if not given
+        """
+
+        if columns is None:
+            columns = self.get_profile_columns()
+        if columns is None or 'FLIGHT_SUMMARY' not in self.extcsv.sections:
+            LOGGER.info('No PROFILE or FLIGHT_SUMMARY table: '
+                        'integrated ozone not derived')
+            return
+
+        typed = _parse_columns(columns, ['Pressure', 'O3PartialPressure'])
+        if typed is None:
+            LOGGER.error('Unable to derive integrated ozone: no '
+                         'PROFILE.Pressure or PROFILE.O3PartialPressure')
+            return
+        (pressure, p_valid), (ppO3, o_valid) = typed
+        valid = p_valid & o_valid
+        valid[valid] = pressure[valid] > 0
+        pressure = pressure[valid]
+        ppO3 = ppO3[valid]
+        if len(pressure) < 2:
+            LOGGER.error('Unable to derive integrated ozone: less than '
+                         'two levels with pressure and ozone')
+            return
+
+        # ascent only: up to the burst (lowest pressure)
+        burst = pressure.argmin() + 1
+        pressure = pressure[:burst]
+        ppO3 = ppO3[:burst]
+        layers = np.log(pressure[:-1] / pressure[1:])
+        integrated = \
+            DU_PER_MPA / 2 * np.dot(ppO3[:-1] + ppO3[1:], layers)
+        total = integrated + DU_PER_MPA * ppO3[-1]
+
+        # add derived values to extcsv
+        for field, value in [('derived:IntegratedO3', integrated),
+                             ('derived:SondeTotalO3', total)]:
+            self.extcsv = \
+                set_extcsv_value(
+                    self.extcsv,
+                    'FLIGHT_SUMMARY',
+                    field,
+                    round(float(value), 1)
+                )
+
+    def derive_hydrostatic_height(self, columns=None):
+        """
+        derive and store the geopotential height of each level from the
+        pressure and temperature profile (hypsometric equation):
+        PROFILE.derived:HydrostaticGPHeight =
+        GPHeight of the first level with one +
+        sum of (Rd / g0) * mean layer temperature (K) *
+        ln(lower pressure / upper pressure) over the layers between
+
+        :param columns: PROFILE columns (see get_profile_columns),
+            read if not given
+        """
+
+        if columns is None:
+            columns = self.get_profile_columns()
+        if columns is None:
+            return
+        typed = _parse_columns(columns,
+                               ['Pressure', 'Temperature', 'GPHeight'])
+        if typed is None:
+            LOGGER.error('Unable to derive hydrostatic heights: no '
+                         'PROFILE.Pressure, Temperature or GPHeight')
+            return
+        (pressure, p_valid), (temperature, t_valid), (height, h_valid) = \
+            typed
+
+        # levels the equation can be integrated over
+        levels = np.flatnonzero(p_valid & t_valid)
+        levels = levels[pressure[levels] > 0]
+        anchors = np.flatnonzero(h_valid[levels])
+        if not len(anchors):
+            LOGGER.error('Unable to derive hydrostatic heights: no level '
+                         'with pressure, temperature and GPHeight')
+            return
+
+        kelvin = temperature[levels] + ZERO_CELSIUS
+        thickness = RD_OVER_G0 * (kelvin[:-1] + kelvin[1:]) / 2 * \
+            np.log(pressure[levels[:-1]] / pressure[levels[1:]])
+        heights = np.concatenate([[0.0], np.cumsum(thickness)])
+        heights += height[levels[anchors[0]]] - heights[anchors[0]]
+
+        derived = [None] * len(pressure)
+        for level, value in zip(levels, np.round(heights, 1).tolist()):
+            derived[level] = value
+
+        # add derived values to extcsv
+        self.extcsv = \
+            set_extcsv_value(
+                self.extcsv,
+                'PROFILE',
+                'derived:HydrostaticGPHeight',
+                derived,
+                mode='add'
+            )
+
+
+def _parse_columns(columns, fields):
+    """
+    helper function: parse payload columns into typed arrays
+
+    :param columns: dict of field to list of values
+    :param fields: fields to parse
+    :returns: list of (values, valid) arrays (see
+        woudc_qa.arrays.parse_column), or None if a field is missing
+    """
+
+    lengths = set(len(columns.get(field, [])) for field in fields)
+    if 0 in lengths or len(lengths) > 1:
+        return None
+    return [parse_column(columns[field]) for field in fields]
+
 
 class TotalOzoneHandler(object):
     """Handles TotalOzone files."""
@@ -312,3 +479,132 @@ class SpectralHandler(object):
         """
         run transformation and update extcsv in place
         """
+
+        self.derive_weighted_irradiance()
+
+    def derive_weighted_irradiance(self):
+        """
+        derive and store the action weighted irradiance of each scan:
+        GLOBAL_SUMMARY N.derived:IntCIE / derived:IntACGIH =
+        trapezoidal integral over wavelength of GLOBAL N S-Irradiance
+        times the CIE erythemal / ACGIH actinic weights (mW/m2)
+
+        All scans are integrated at once, stacked (scan x wavelength).
+        Scans are paired with their summaries by table index, and scans
+        with values that are not numbers are not integrated.
+        """
+
+        instances = get_table_instances(self.extcsv)
+        summaries = instances.get('GLOBAL_SUMMARY', {})
+        indexes = sorted(ti for ti in instances.get('GLOBAL', {})
+                         if ti in summaries)
+        if not indexes:
+            LOGGER.info('No GLOBAL and GLOBAL_SUMMARY tables: weighted '
+                        'irradiance not derived')
+            return
+
+        arrays = ProfileArrays(self.extcsv)
+        for ti in indexes:
+            arrays.prefetch('GLOBAL', ti, ['Wavelength', 'S-Irradiance'])
+        wavelengths, w_valid, found, lengths = \
+            arrays.stack('GLOBAL', indexes, 'Wavelength')
+        irradiance, i_valid, _, _ = \
+            arrays.stack('GLOBAL', indexes, 'S-Irradiance')
+        valid = w_valid & i_valid
+        complete = valid.sum(axis=1) == np.array(lengths)
+
+        # trapezoids between consecutive wavelengths of each scan
+        steps = np.where(valid[:, 1:] & valid[:, :-1],
+                         wavelengths[:, 1:] - wavelengths[:, :-1], 0.0)
+        integrals = []
+        for field, weights in [('derived:IntCIE', erythemal_weights),
+                               ('derived:IntACGIH', acgih_weights)]:
+            weighted = irradiance * weights(wavelengths)
+            integrals.append((field, SUMMARY_SCALE / 2 * np.sum(
+                (weighted[:, 1:] + weighted[:, :-1]) * steps, axis=1)))
+
+        # add derived values to extcsv
+        for i, ti in enumerate(found):
+            if not complete[i] or lengths[i] < 2:
+                LOGGER.info('Unable to derive weighted irradiance of '
+                            'GLOBAL %s: values not numbers', ti)
+                continue
+            summary = self.extcsv.sections[summaries[ti]]
+            for field, values in integrals:
+                summary[field] = '%.3E' % values[i]
+
+
+def erythemal_weights(wavelengths):
+    """
+    CIE erythemal action spectrum (ISO 17166), up to CIE_LIMIT
+
+    :param wavelengths: float64 array of wavelengths (nm)
+    :returns: float64 array of weights (0 above CIE_LIMIT)
+    """
+
+    return np.where(wavelengths > CIE_LIMIT, 0.0,
+                    np.where(wavelengths <= 298, 1.0,
+                             np.where(wavelengths <= 328,
+                                      10 ** (0.094 * (298 - wavelengths)),
+                                      10 ** (0.015 * (140 - wavelengths)))))
+
+
+def acgih_weights(wavelengths):
+    """
+    ACGIH actinic hazard action spectrum, up to ACGIH_LIMIT
+
+    :param wavelengths: float64 array of wavelengths (nm)
+    :returns: float64 array of weights (0 above ACGIH_LIMIT)
+    """
+
+    spectrum = np.array(ACGIH_SPECTRUM)
+    weights = np.exp(np.interp(wavelengths, spectrum[:, 0],
+                               np.log(spectrum[:, 1])))
+    return np.where(wavelengths <= ACGIH_LIMIT, weights, 0.0)
+
+
+class LidarHandler(object):
+    """Handles Lidar files."""
+
+    def __init__(self, extcsv):
+        """
+        Init LidarHandler object
+
+        :param extcsv: woudc_extcsv.Reader object
+        """
+
+        self._extcsv = extcsv
+        # invoke transformation logic
+        self.run_all_transformations()
+
+    @property
+    def extcsv(self):
+        """
+        :returns: extcsv object
+        """
+
+        return self._extcsv
+
+    @extcsv.setter
+    def extcsv(self, extcsv):
+        """
+        Set extcsv
+        """
+        self._extcsv = extcsv
+
+    def run_all_transformations(self):
+        """
+        run transformation and update extcsv in place
+
+        OZONE_PROFILE columns are checked as they are, as whole typed
+        columns (see woudc_qa.arrays): nothing to derive
+        """
+
+
+# dataset handlers by dataset (CONTENT.Category, lower case)
+DATASET_HANDLERS = {
+    'ozonesonde': OzoneSondeHandler,
+    'totalozone': TotalOzoneHandler,
+    'spectral': SpectralHandler,
+    'lidar': LidarHandler
+}
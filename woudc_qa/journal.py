@@ -0,0 +1,234 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Batch progress journal
+
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import closing
+
+from woudc_qa.archive import open_file
+
+LOGGER = logging.getLogger(__name__)
+
+# outcomes not retried when resuming (errors are)
+COMPLETED = ['passed', 'failed']
+
+
+def file_hash(file_path, block_size=1048576):
+    """
+    Hash the content of a file
+
+    :param file_path: path to file
+    :param block_size: bytes read at a time
+    :returns: SHA-256 hex digest, or None if the file cannot be read
+    """
+
+    digest = hashlib.sha256()
+    try:
+        with closing(open_file(file_path)) as ff:
+            for block in iter(lambda: ff.read(block_size), ''):
+                digest.update(block)
+    except IOError as err:
+        LOGGER.warning('Unable to hash %s. Due to: %s', file_path, err)
+        return None
+    return digest.hexdigest()
+
+
+def hash_content(content):
+    """
+    Hash the content of a file already read, as file_hash does
+
+    :param content: file content as string
+    :returns: SHA-256 hex digest
+    """
+
+    return hashlib.sha256(content).hexdigest()
+
+
+class ProgressJournal(object):
+    """
+    Append-only journal of files completed by a batch run, one JSON line
+    (path, content hash, rule set fingerprint, outcome) per file.
+    Records are buffered and appended (and fsync'ed) in batches; a line
+    torn by a crash is ignored when the journal is read back.
+    """
+
+    def __init__(self, journal_path, resume=False, batch_size=100,
+                 interval=10):
+        """
+        Open (and create if needed) a progress journal
+
+        :param journal_path: path to journal file
+        :param resume: load the files completed by earlier runs
+        :param batch_size: number of records buffered per write
+        :param interval: maximum seconds between writes
+        """
+
+        self._journal_path = journal_path
+        self._batch_size = batch_size
+        self._interval = interval
+        self._completed = {}
+        self._pending = []
+        self._last_write = time.time()
+
+        if resume and os.path.exists(journal_path):
+            self._load()
+        self._fh = open(journal_path, 'a+')
+        self._fh.seek(0, os.SEEK_END)
+        if self._fh.tell() > 0:
+            self._fh.seek(-1, os.SEEK_END)
+            if self._fh.read(1) != '\n':
+                # end a torn record so that it is not joined to the next
+                self._fh.seek(0, os.SEEK_END)
+                self._fh.write('\n')
+
+    @property
+    def journal_path(self):
+        """
+        :returns: path to journal file
+        """
+
+        return self._journal_path
+
+    @property
+    def completed(self):
+        """
+        :returns: dict of file path to the latest (content hash, rule
+            set fingerprint, outcome) recorded
+        """
+
+        return self._completed
+
+    @property
+    def due(self):
+        """
+        :returns: `bool` of whether buffered records should be written
+        """
+
+        return bool(self._pending) and (
+            len(self._pending) >= self._batch_size or
+            time.time() - self._last_write >= self._interval)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_done(self, file_path, fingerprint):
+        """
+        Check whether a file was completed with the same content and
+        rule set
+
+        :param file_path: path to file
+        :param fingerprint: fingerprint of the current rule set
+        :returns: `bool` of whether the file can be skipped
+        """
+
+        if file_path not in self._completed:
+            return False
+        content_hash, done_fingerprint, outcome = \
+            self._completed[file_path]
+        return all([outcome in COMPLETED, done_fingerprint == fingerprint,
+                    content_hash == file_hash(file_path)])
+
+    def record(self, file_path, content_hash, fingerprint, outcome):
+        """
+        Buffer the record of one completed file
+
+        :param file_path: path to file
+        :param content_hash: content hash of the file (see file_hash)
+        :param fingerprint: fingerprint of the rule set used
+        :param outcome: passed, failed or error
+        """
+
+        self._completed[file_path] = (content_hash, fingerprint, outcome)
+        self._pending.append(json.dumps(
+            [file_path, content_hash, fingerprint, outcome]))
+
+    def flush(self):
+        """
+        Append buffered records and sync them to disk
+        """
+
+        self._last_write = time.time()
+        if not self._pending:
+            return
+        self._fh.write('%s\n' % '\n'.join(self._pending))
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        LOGGER.debug('Journaled %s files to %s' %
+                     (len(self._pending), self._journal_path))
+        self._pending = []
+
+    def close(self):
+        """
+        Write buffered records and close the journal
+        """
+
+        self.flush()
+        self._fh.close()
+
+    def _load(self):
+        """
+        helper method: read the records of earlier runs
+        """
+
+        with open(self._journal_path) as ff:
+            for num, line in enumerate(ff, 1):
+                try:
+                    file_path, content_hash, fingerprint, outcome = \
+                        json.loads(line)
+                except (TypeError, ValueError):
+                    LOGGER.warning('Ignoring torn record %s of %s', num,
+                                   self._journal_path)
+                    continue
+                self._completed[file_path] = (content_hash, fingerprint,
+                                              outcome)
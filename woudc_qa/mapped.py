@@ -0,0 +1,277 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Memory-mapped loading of Extended CSV files
+#
+# woudc_extcsv parses a file held as one string, copying it into table
+# bodies and re-serialising each data table into its _raw string.  For
+# large files, the file is memory-mapped instead: woudc_extcsv parses a
+# skeleton of the file (metadata tables, the field row of each data
+# table and the comment lines), and the _raw string of a data table is
+# serialised from the mapped file on first use, the way woudc_extcsv
+# would.  Tables no rule reads are never copied into memory.
+
+import logging
+import mmap
+import os
+import re
+from StringIO import StringIO
+
+import unicodecsv as csv
+import woudc_extcsv
+
+from woudc_qa.archive import read_file, split_file_id, COMPRESSED_SUFFIXES
+
+LOGGER = logging.getLogger(__name__)
+
+# files from this size on are memory-mapped
+MAP_SIZE = 1048576
+
+# table headers, as split by woudc_extcsv.Reader.decompose_extcsv
+HEADER = re.compile(r'(?<![ \w\d])#([A-Z][A-Z0-9_]*)')
+
+# tables parsed as metadata by woudc_extcsv.Reader
+METADATA_TABLES = [
+    'CONTENT', 'DATA_GENERATION', 'PLATFORM', 'INSTRUMENT', 'LOCATION',
+    'TIMESTAMP', 'MONTHLY', 'VEHICLE', 'FLIGHT_SUMMARY', 'GLOBAL_SUMMARY',
+    'DAILY_SUMMARY', 'GLOBAL_DAILY_SUMMARY', 'OZONE_SUMMARY',
+    'AUXILIARY_DATA'
+]
+
+WHITESPACE = ' \t\n\r\x0b\x0c'
+
+
+class MappedTable(dict):
+    """
+    Data table of a memory-mapped file, as parsed by woudc_extcsv, with
+    its _raw string serialised from the mapped file on first use
+    """
+
+    def __init__(self, buf, start, end, encoding='utf-8'):
+        """
+        Initialize table
+
+        :param buf: mmap of the file
+        :param start: offset of the table body
+        :param end: offset of the end of the table body
+        :param encoding: encoding of the file
+        """
+
+        dict.__init__(self, _raw=None)
+        self._source = (buf, start, end, encoding)
+
+    def __getitem__(self, key):
+        if key == '_raw' and self._source is not None:
+            self.materialise()
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        if key == '_raw':
+            self._source = None
+        dict.__setitem__(self, key, value)
+
+    def __eq__(self, other):
+        self.materialise()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        self.materialise()
+        return dict, (dict(self),)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        self.materialise()
+        return dict.items(self)
+
+    def values(self):
+        self.materialise()
+        return dict.values(self)
+
+    @property
+    def materialised(self):
+        """
+        :returns: `bool` of whether _raw has been serialised
+        """
+
+        return self._source is None
+
+    def materialise(self):
+        """
+        Serialise _raw from the mapped file, as woudc_extcsv does: the
+        field row and the data rows, without blank and comment rows
+        """
+
+        if self._source is None:
+            return
+        buf, start, end, encoding = self._source
+        payload = StringIO()
+        writer = csv.writer(payload)
+        rows = csv.reader(_lines(buf, start, end), encoding=encoding)
+        writer.writerow(rows.next())
+        for row in rows:
+            if row and '*' not in row[0]:
+                writer.writerow(row)
+        dict.__setitem__(self, '_raw', payload.getvalue())
+        payload.close()
+        self._source = None
+
+
+def is_mappable(file_id, size=MAP_SIZE):
+    """
+    Check whether a file is loaded memory-mapped
+
+    :param file_id: file path or archive!member identifier
+    :param size: minimum size of files mapped
+    :returns: `bool` of whether file_id is a plain file of at least size
+        bytes (compressed files and archive members are read instead)
+    """
+
+    path, member = split_file_id(file_id)
+    if member is not None or path.lower().endswith(
+            tuple(COMPRESSED_SUFFIXES)):
+        return False
+    try:
+        return os.path.getsize(path) >= max(size, 1)
+    except OSError:
+        return False
+
+
+def load_mapped(file_path, encoding='utf-8'):
+    """
+    Load an Extended CSV file memory-mapped
+
+    :param file_path: path to file
+    :param encoding: encoding of the file
+    :returns: woudc_extcsv Reader object, with data tables as
+        MappedTable objects
+    """
+
+    with open(file_path, 'rb') as ff:
+        buf = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+
+    skeleton = []
+    mapped = []
+    previous = None
+    position = 0
+    for match in HEADER.finditer(buf):
+        if previous is not None:
+            position = _add_table(skeleton, mapped, buf, previous,
+                                  match.start())
+        skeleton.append(buf[position:match.end()])
+        position = match.end()
+        previous = match
+    if previous is None:
+        skeleton.append(buf[:])
+    else:
+        _add_table(skeleton, mapped, buf, previous, len(buf))
+
+    ecsv = woudc_extcsv.loads(''.join(skeleton), encoding=encoding)
+    if len(ecsv.data_tables) != len(mapped):
+        LOGGER.warning('Unable to map data tables of %s. Due to: %s data '
+                       'tables parsed, %s mapped', file_path,
+                       len(ecsv.data_tables), len(mapped))
+        buf.close()
+        return woudc_extcsv.loads(read_file(file_path), encoding=encoding)
+    for table, span in zip(ecsv.data_tables, mapped):
+        if span is not None:
+            ecsv.sections[table] = MappedTable(buf, span[0], span[1],
+                                               encoding)
+    return ecsv
+
+
+def _add_table(skeleton, mapped, buf, match, end):
+    """
+    helper function: add the body of a table to the skeleton
+
+    Metadata tables are copied.  Of a data table, only the field row and
+    the lines a comment or table marker (* or #) appears on are copied,
+    which is all woudc_extcsv looks at besides its _raw string.  Tables
+    with quoted fields are copied whole, as their rows may span lines.
+
+    :returns: offset of the end of the table
+    """
+
+    start = match.end()
+    if match.group(1) in METADATA_TABLES:
+        skeleton.append(buf[start:end])
+        return end
+
+    while start < end and buf[start] in WHITESPACE:
+        start += 1
+    stop = end
+    while stop > start and buf[stop - 1] in WHITESPACE:
+        stop -= 1
+    if start == stop or buf.find('"', start, stop) != -1:
+        skeleton.append(buf[match.end():end])
+        mapped.append(None)
+        return end
+
+    skeleton.append(buf[match.end():start])
+    lines = _lines(buf, start, stop)
+    skeleton.append(lines.next())
+    for line in lines:
+        if '*' in line or '#' in line:
+            skeleton.append(line)
+    skeleton.append(buf[stop:end])
+    mapped.append((start, stop))
+    return end
+
+
+def _lines(buf, start, end):
+    """
+    helper function: iterate over the lines of part of a mapped file
+    """
+
+    while start < end:
+        newline = buf.find('\n', start, end)
+        stop = end if newline == -1 else newline + 1
+        yield buf[start:stop]
+        start = stop
@@ -0,0 +1,285 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Read-ahead of batch input files
+#
+# Reader threads prefetch files into memory in the order they are
+# expected to be checked, holding at most a given number of files:
+# readers block when it is reached (backpressure). Per stage (read,
+# parse, check) of a batch run, PipelineStats sums busy and stall
+# seconds and samples queue depths, to tell whether a run is bound by
+# I/O (parse stage waiting on reads) or CPU (readers waiting for room).
+
+import logging
+import threading
+import time
+from collections import deque, OrderedDict
+
+from woudc_qa.archive import read_file
+
+LOGGER = logging.getLogger(__name__)
+
+# files read ahead of the check stage
+READ_AHEAD = 8
+
+# reader threads
+READ_THREADS = 4
+
+# pipeline stages, in order
+STAGES = ['read', 'parse', 'check']
+
+# share of parse and check time waited on reads deemed I/O bound
+IO_BOUND_SHARE = 0.1
+
+
+class PipelineStats(object):
+    """
+    Per-stage counters of a batch run: files, busy seconds, stall
+    seconds and queue depth.  Stall is time a stage waited on its
+    neighbours: readers on room in the read-ahead buffer, parsing on
+    reads, checking (worker processes) on work.  Thread-safe.
+    """
+
+    def __init__(self):
+        """
+        Initialize empty counters
+        """
+
+        self._lock = threading.Lock()
+        self._stages = OrderedDict(
+            (stage, {'files': 0, 'busy': 0.0, 'stall': 0.0,
+                     'depth_total': 0, 'depth_max': 0, 'samples': 0})
+            for stage in STAGES)
+
+    def add(self, stage, busy=0.0, stall=0.0, depth=None):
+        """
+        Record one file passing through a stage
+
+        :param stage: stage (see STAGES)
+        :param busy: seconds spent working on the file
+        :param stall: seconds spent waiting before the file
+        :param depth: queue depth of the stage at the time (optional)
+        """
+
+        with self._lock:
+            counters = self._stages[stage]
+            counters['files'] += 1
+            counters['busy'] += busy
+            counters['stall'] += stall
+            if depth is not None:
+                counters['depth_total'] += depth
+                counters['depth_max'] = max(counters['depth_max'], depth)
+                counters['samples'] += 1
+
+    def report(self):
+        """
+        :returns: list of dicts of stage, files, busy, stall, depth_mean
+            and depth_max, in stage order
+        """
+
+        report = []
+        with self._lock:
+            for stage, counters in self._stages.iteritems():
+                depth_mean = 0.0
+                if counters['samples']:
+                    depth_mean = \
+                        float(counters['depth_total']) / counters['samples']
+                report.append({
+                    'stage': stage,
+                    'files': counters['files'],
+                    'busy': counters['busy'],
+                    'stall': counters['stall'],
+                    'depth_mean': depth_mean,
+                    'depth_max': counters['depth_max']
+                })
+        return report
+
+    @property
+    def bound(self):
+        """
+        :returns: io when parsing waited on reads longer than readers
+            waited for room, and for more than IO_BOUND_SHARE of the
+            parse and check time, else cpu
+        """
+
+        with self._lock:
+            waited = self._stages['parse']['stall']
+            busy = self._stages['parse']['busy'] + \
+                self._stages['check']['busy']
+            if waited > self._stages['read']['stall'] and \
+                    waited > IO_BOUND_SHARE * busy:
+                return 'io'
+        return 'cpu'
+
+
+class ReadAhead(object):
+    """
+    Reads files ahead of their use in a pool of threads, holding at
+    most `depth` files in memory.  Files may be requested out of order;
+    a file no reader has started is read by the caller.
+    """
+
+    def __init__(self, file_paths, depth=READ_AHEAD, threads=READ_THREADS,
+                 stats=None):
+        """
+        Start reading
+
+        :param file_paths: list of file paths, in expected order of use
+        :param depth: number of files held in memory
+        :param threads: number of reader threads
+        :param stats: PipelineStats to record reads in (optional)
+        """
+
+        self._order = deque(file_paths)
+        self._depth = depth
+        self._stats = stats
+        self._slots = threading.Semaphore(depth)
+        self._cond = threading.Condition()
+        self._claimed = set()
+        self._ready = {}
+        self._closed = False
+        self._threads = []
+        for _ in range(min(threads, depth, len(file_paths))):
+            thread = threading.Thread(target=self._read_loop)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def depth(self):
+        """
+        :returns: number of files read and not taken yet
+        """
+
+        with self._cond:
+            return len(self._ready)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, file_path):
+        """
+        Take the content of a file, waiting for its read if under way
+
+        :param file_path: path to file
+        :returns: file content, or None if it could not be read (for
+            the caller to read it again and handle the error)
+        """
+
+        with self._cond:
+            prefetched = file_path in self._claimed
+            if prefetched:
+                while file_path not in self._ready:
+                    # timeout: stay responsive to interrupts
+                    self._cond.wait(0.5)
+                content = self._ready.pop(file_path)
+            else:
+                self._claimed.add(file_path)
+        if prefetched:
+            self._slots.release()
+        else:
+            start = time.time()
+            content = _read(file_path)
+            if self._stats is not None:
+                self._stats.add('read', time.time() - start)
+        return content
+
+    def close(self):
+        """
+        Stop reading ahead and drop files not taken
+        """
+
+        with self._cond:
+            self._closed = True
+            self._ready.clear()
+        for _ in self._threads:
+            self._slots.release()
+        for thread in self._threads:
+            thread.join()
+
+    def _read_loop(self):
+        """
+        helper method: reader thread
+        """
+
+        while True:
+            start = time.time()
+            self._slots.acquire()
+            stall = time.time() - start
+            with self._cond:
+                while self._order and self._order[0] in self._claimed:
+                    self._order.popleft()
+                if self._closed or not self._order:
+                    self._slots.release()
+                    return
+                file_path = self._order.popleft()
+                self._claimed.add(file_path)
+            start = time.time()
+            content = _read(file_path)
+            busy = time.time() - start
+            with self._cond:
+                if self._closed:
+                    return
+                self._ready[file_path] = content
+                depth = len(self._ready)
+                self._cond.notify_all()
+            if self._stats is not None:
+                self._stats.add('read', busy, stall, depth)
+
+
+def _read(file_path):
+    """
+    helper function: read a file, None if it cannot be read
+    """
+
+    try:
+        return read_file(file_path)
+    except IOError as err:
+        LOGGER.debug('Unable to read %s ahead. Due to: %s', file_path, err)
+        return None
@@ -0,0 +1,188 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Station reference profiles
+#
+# A reference profile is a small CSV file per station (e.g. a multi-year
+# mean on pressure levels), named after the station id (PLATFORM.ID) in
+# a directory of reference profiles:
+#
+#     Pressure,O3PartialPressure
+#     1000,3.9
+#     500,2.6
+#     ...
+#
+# The first column holds the levels, the second the reference values.
+# Range function RC_10 interpolates the reference of the station onto
+# the levels of each profile row (in log pressure for Pressure levels)
+# and checks the relative deviation of the row from it. Reference
+# profiles are read once per station and kept in memory.
+
+import csv
+import logging
+import os
+import threading
+
+import numpy as np
+
+from woudc_qa.arrays import level_coordinates
+from woudc_qa.util import get_extcsv_value
+
+LOGGER = logging.getLogger(__name__)
+
+# reference profiles by path, with the modification time they were
+# read at
+_PROFILES = {}
+_PROFILES_LOCK = threading.Lock()
+
+
+class ReferenceProfile(object):
+    """Reference profile of a station."""
+
+    def __init__(self, path):
+        """
+        Read a reference profile
+
+        :param path: path to reference profile
+        """
+
+        levels = []
+        values = []
+        with open(path, 'rb') as ff:
+            rows = csv.reader(ff)
+            header = rows.next()
+            for row in rows:
+                try:
+                    level, value = float(row[0]), float(row[1])
+                except (IndexError, ValueError):
+                    continue
+                levels.append(level)
+                values.append(value)
+        if len(levels) < 2:
+            msg = 'Unable to read reference profile %s: less than two ' \
+                'levels' % path
+            LOGGER.error(msg)
+            raise ValueError(msg)
+
+        self.path = path
+        self.level = header[0].strip()
+        self.element = header[1].strip()
+        self.log = self.level == 'Pressure'
+        coordinates = level_coordinates(np.array(levels), self.log)
+        known = np.isfinite(coordinates)
+        order = np.argsort(coordinates[known])
+        self._coordinates = coordinates[known][order]
+        self._values = np.array(values)[known][order]
+
+    def interpolate(self, levels, valid):
+        """
+        Interpolate the reference onto the levels of a profile
+
+        :param levels: float64 array of levels of the profile rows
+        :param valid: boolean array of which levels are numbers
+        :returns: float64 array of reference values, NaN for rows out
+            of the reference levels
+        """
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x = level_coordinates(levels, self.log)
+            inside = valid & (x >= self._coordinates[0]) & \
+                (x <= self._coordinates[-1])
+        reference = np.full(len(levels), np.nan)
+        reference[inside] = np.interp(x[inside], self._coordinates,
+                                      self._values)
+        return reference
+
+
+def open_reference_profile(directory, station):
+    """
+    Get the reference profile of a station, read once (and again when
+    the file changes)
+
+    :param directory: directory of reference profiles
+    :param station: station id
+    :returns: ReferenceProfile object, or None if the station has none
+    """
+
+    path = os.path.join(directory, '%s.csv' % station)
+    if not os.path.isfile(path):
+        LOGGER.info('No reference profile for station %s in %s',
+                    station, directory)
+        return None
+    mtime = os.path.getmtime(path)
+    with _PROFILES_LOCK:
+        entry = _PROFILES.get(path)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, ReferenceProfile(path))
+            _PROFILES[path] = entry
+    return entry[1]
+
+
+def profile_reference(extcsv, arrays, rule, table_index):
+    """
+    Get the station reference of each row of a profile
+
+    :param extcsv: woudc_extcsv Reader object (handled)
+    :param arrays: ProfileArrays of the file
+    :param rule: QaRule of the test (function_parameter_c: directory of
+        reference profiles)
+    :param table_index: table index of the profile
+    :returns: float64 array of reference values by row (see
+        ReferenceProfile.interpolate), or None if the station has no
+        reference profile or the file no levels
+    """
+
+    station = get_extcsv_value(extcsv, 'PLATFORM', 'ID')
+    if station is None:
+        LOGGER.warning('No PLATFORM.ID')
+        return None
+    profile = open_reference_profile(rule.param_c, station.strip())
+    if profile is None:
+        return None
+    column = arrays.column(rule.table, table_index, profile.level)
+    if column is None:
+        return None
+    return profile.interpolate(*column)
@@ -0,0 +1,228 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Compiled rule packs
+#
+# A rule pack holds the loaded and compiled qa rules of a rule set in
+# one section per dataset, behind a header and a section index, so
+# that loading a pack only maps the file; the rules of a dataset are
+# decoded when first used.
+
+import logging
+import marshal
+import mmap
+import os
+import struct
+from collections import Mapping
+
+LOGGER = logging.getLogger(__name__)
+
+RULE_PACK_MAGIC = 'WOUDCQA\x00'
+
+# bump whenever the layout or the compiled rule attributes change
+RULE_PACK_VERSION = 1
+
+# magic, rule pack version, marshal version, rule definitions
+# fingerprint, section index length
+HEADER = struct.Struct('<8sHH64sQ')
+
+
+def write_rule_pack(pack_path, fingerprint, qa_rules, compiled_rules):
+    """
+    Write loaded and compiled qa rules to a rule pack
+
+    :param pack_path: path to rule pack
+    :param fingerprint: fingerprint of the rule definitions compiled
+    :param qa_rules: dict of dataset to list of rule definitions
+    :param compiled_rules: dict of dataset to list of QaRule objects
+    """
+
+    index = []
+    sections = []
+    offset = 0
+    for dataset, rules in qa_rules.iteritems():
+        compiled = [vars(rule) for rule in compiled_rules.get(dataset, [])]
+        section = marshal.dumps((rules, compiled))
+        index.append((dataset, offset, len(section)))
+        sections.append(section)
+        offset += len(section)
+    index = marshal.dumps(index)
+    header = HEADER.pack(RULE_PACK_MAGIC, RULE_PACK_VERSION,
+                         marshal.version, fingerprint, len(index))
+
+    # write aside and rename, so readers never see a partial pack
+    tmp_path = '%s.%s.tmp' % (pack_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as ff:
+            ff.write(header)
+            ff.write(index)
+            for section in sections:
+                ff.write(section)
+        os.rename(tmp_path, pack_path)
+    except Exception as err:
+        msg = 'Unable to write rule pack %s. Due to: %s' % (pack_path, err)
+        LOGGER.error(msg)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise err
+
+
+def read_rule_pack(pack_path, fingerprint, rule_class):
+    """
+    Read loaded and compiled qa rules from a rule pack
+
+    :param pack_path: path to rule pack
+    :param fingerprint: fingerprint of the current rule definitions
+    :param rule_class: class of compiled rules (QaRule)
+    :returns: tuple of (qa rules, compiled rules) mappings by dataset,
+        or None if the rule pack is missing, stale or unreadable
+    """
+
+    if not os.path.exists(pack_path):
+        return None
+
+    try:
+        with open(pack_path, 'rb') as ff:
+            buf = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, marshal_version, pack_fingerprint, length = \
+            HEADER.unpack_from(buf, 0)
+        if any([magic != RULE_PACK_MAGIC,
+                version != RULE_PACK_VERSION,
+                marshal_version != marshal.version]):
+            LOGGER.info('Ignoring rule pack %s: unsupported version',
+                        pack_path)
+            buf.close()
+            return None
+        if pack_fingerprint != fingerprint:
+            LOGGER.info('Ignoring rule pack %s: stale', pack_path)
+            buf.close()
+            return None
+        index = marshal.loads(buf[HEADER.size:HEADER.size + length])
+        sections = _RulePackSections(buf, HEADER.size + length, index,
+                                     rule_class)
+    except Exception as err:
+        msg = 'Unable to read rule pack %s. Due to: %s' % (pack_path, err)
+        LOGGER.warning(msg)
+        return None
+
+    return DatasetRules(sections, 0), DatasetRules(sections, 1)
+
+
+class DatasetRules(Mapping):
+    """Read-only mapping of dataset to rules, decoded on first access."""
+
+    def __init__(self, sections, position):
+        """
+        :param sections: rule pack sections
+        :param position: 0 for rule definitions, 1 for compiled rules
+        """
+
+        self._sections = sections
+        self._position = position
+
+    def __getitem__(self, dataset):
+        return self._sections.load(dataset)[self._position]
+
+    def __iter__(self):
+        return iter(self._sections.datasets)
+
+    def __len__(self):
+        return len(self._sections.datasets)
+
+
+class _RulePackSections(object):
+    """Dataset sections of a memory-mapped rule pack."""
+
+    def __init__(self, buf, start, index, rule_class):
+        """
+        :param buf: memory-mapped rule pack
+        :param start: offset of the first section
+        :param index: list of (dataset, offset, length) by section
+        :param rule_class: class of compiled rules (QaRule)
+        """
+
+        self._buf = buf
+        self._rule_class = rule_class
+        self._offsets = {}
+        self._loaded = {}
+        self.datasets = []
+        for dataset, offset, length in index:
+            self._offsets[dataset] = (start + offset, length)
+            self.datasets.append(dataset)
+
+    def load(self, dataset):
+        """
+        Decode the rules of a dataset
+
+        :param dataset: dataset name
+        :returns: tuple of (list of rule definitions, list of compiled
+            rules)
+        """
+
+        if dataset not in self._loaded:
+            offset, length = self._offsets[dataset]
+            rules, compiled = marshal.loads(
+                self._buf[offset:offset + length])
+            compiled_rules = []
+            for attributes in compiled:
+                rule = self._rule_class.__new__(self._rule_class)
+                rule.__dict__ = attributes
+                compiled_rules.append(rule)
+            self._loaded[dataset] = (rules, compiled_rules)
+
+        return self._loaded[dataset]
+
+    def __getstate__(self):
+        """
+        Pickle the decoded rules of every dataset in place of the memory
+        map (e.g. to hand a rule set to worker processes)
+        """
+
+        for dataset in self.datasets:
+            self.load(dataset)
+        state = self.__dict__.copy()
+        state['_buf'] = None
+        return state
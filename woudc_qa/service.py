@@ -0,0 +1,516 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+# Long-running Qa service over HTTP
+
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import woudc_extcsv
+from woudc_qa import __version__, qa, QualityChecker,\
+    WOUDCQaBudgetExceeded,\
+    WOUDCQaNotImplementedError,\
+    WOUDCQaValidationError
+from woudc_qa.util import format_violations
+from woudc_qa.watcher import RuleSetWatcher
+
+LOGGER = logging.getLogger(__name__)
+
+# largest request body accepted (bytes)
+MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+
+# per worker process quality checker, built once by _init_worker
+_CHECKER = None
+
+# per worker process budget of each request (QaBudget)
+_BUDGET = None
+
+
+class WOUDCQaServiceBusyError(Exception):
+    """Qa service worker pool is saturated"""
+    pass
+
+
+class QaService(object):
+    """Keeps compiled rules warm in a bounded pool of Qa worker processes."""
+
+    def __init__(self, rule_path=None, workers=None, queue_size=None,
+                 timeout=60, reload_interval=None, budget=None):
+        """
+        Initialize Qa service
+
+        :param rule_path: path to qa rule definitions (optional)
+        :param workers: number of worker processes (default: cpu count)
+        :param queue_size: number of requests allowed to wait for a
+            worker before new requests are rejected (default: 2 * workers)
+        :param timeout: seconds to wait for a result before giving up
+        :param reload_interval: seconds between checks of the rule
+            definitions for changes (default: no hot reload)
+        :param budget: QaBudget of each request (optional).  Workers are
+            recycled after a request exceeds it
+        """
+
+        self._rule_path = rule_path
+        self._workers = workers
+        if self._workers is None:
+            self._workers = multiprocessing.cpu_count()
+        self._queue_size = queue_size
+        if self._queue_size is None:
+            self._queue_size = 2 * self._workers
+        self._timeout = timeout
+        self._budget = budget
+
+        # fail fast on a bad rule set before starting any worker
+        self._checker = QualityChecker(rule_path)
+
+        self._slots = \
+            threading.BoundedSemaphore(self._workers + self._queue_size)
+        self._lock = threading.Lock()
+        self._stats = {
+            'in_flight': 0,
+            'completed': 0,
+            'rejected': 0,
+            'reloads': 0,
+            'exceeded': 0
+        }
+        self._pool = self._start_pool(self._checker)
+        self._retiring = []
+
+        self._watcher = None
+        if reload_interval:
+            self._watcher = RuleSetWatcher(self._checker, self.reload,
+                                           reload_interval)
+            self._watcher.start()
+
+    @property
+    def workers(self):
+        """
+        :returns: number of worker processes
+        """
+
+        return self._workers
+
+    @property
+    def queue_size(self):
+        """
+        :returns: number of requests allowed to wait for a worker
+        """
+
+        return self._queue_size
+
+    @property
+    def fingerprint(self):
+        """
+        :returns: fingerprint of the rule set applied to new requests
+        """
+
+        return self._checker.fingerprint
+
+    def check(self, content, file_path=None, summary=False,
+              validate_metadata=False):
+        """
+        Quality assess file content on the worker pool
+
+        :param content: file as string
+        :param file_path: path to file (optional)
+        :param summary: summarize failed checks (optional)
+        :param validate_metadata: validate file metadata (optional)
+        :returns: tuple of HTTP status code and JSON response body
+        """
+
+        if not self._slots.acquire(False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            msg = 'Qa service busy: %s requests in flight' % \
+                (self._workers + self._queue_size)
+            LOGGER.warning(msg)
+            raise WOUDCQaServiceBusyError(msg)
+
+        try:
+            # the pool is read and used under the lock so that a
+            # concurrent reload never hands work to a retired pool
+            with self._lock:
+                self._stats['in_flight'] += 1
+                task = self._pool.apply_async(
+                    _check, (content, file_path, summary, validate_metadata),
+                    callback=lambda result: self._release(True))
+        except Exception:
+            self._release(False)
+            raise
+
+        # the slot is freed by the callback once the worker is done with
+        # the request, so that a request timed out here still counts
+        # against capacity while it runs
+        try:
+            status, body, exceeded = task.get(self._timeout)
+        except multiprocessing.TimeoutError:
+            raise
+        except Exception:
+            # the callback is not called for failed requests
+            self._release(False)
+            raise
+        if exceeded:
+            self.recycle()
+        return status, body
+
+    def reload(self, checker):
+        """
+        Atomically swap in a new rule set.  Requests already handed to
+        workers finish on the previous rule set; new requests use the
+        new one.
+
+        :param checker: QualityChecker compiled from the new rule set
+        """
+
+        self._swap_pool(checker, 'reloads')
+        LOGGER.info('Switched to rule set %s' % checker.fingerprint)
+
+    def recycle(self):
+        """
+        Replace the worker processes, e.g. after a request exceeded its
+        budget and may have left its worker bloated.  Requests already
+        handed to workers finish on the previous ones.
+        """
+
+        with self._lock:
+            checker = self._checker
+        self._swap_pool(checker, 'exceeded')
+        LOGGER.info('Recycled worker processes')
+
+    def _swap_pool(self, checker, stat):
+        """
+        helper method: switch new requests to a new pool of workers
+        """
+
+        pool = self._start_pool(checker)
+        with self._lock:
+            retired, self._pool = self._pool, pool
+            self._checker = checker
+            self._stats[stat] += 1
+
+        # let the retired pool drain in the background
+        retired.close()
+        drain = threading.Thread(target=retired.join)
+        drain.start()
+        self._retiring = [t for t in self._retiring if t.is_alive()]
+        self._retiring.append(drain)
+
+    def status(self):
+        """
+        :returns: dict of service status
+        """
+
+        with self._lock:
+            status = dict(self._stats)
+        status.update({
+            'version': __version__,
+            'workers': self._workers,
+            'queue_size': self._queue_size,
+            'rule_set': self.fingerprint
+        })
+        return status
+
+    def close(self):
+        """
+        Stop accepting work and wait for in-flight work to finish
+        """
+
+        if self._watcher is not None:
+            self._watcher.stop()
+        self._pool.close()
+        self._pool.join()
+        for drain in self._retiring:
+            drain.join()
+
+    def _start_pool(self, checker):
+        """
+        helper method: start worker processes holding the given rule set
+        """
+
+        return multiprocessing.Pool(self._workers, _init_worker,
+                                    (checker, self._budget))
+
+    def _release(self, completed):
+        """
+        helper method: free the slot of a request
+
+        :param completed: whether the request returned a response body
+        """
+
+        with self._lock:
+            self._stats['in_flight'] -= 1
+            if completed:
+                self._stats['completed'] += 1
+        self._slots.release()
+
+
+class QaHTTPServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server fronting a QaService."""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, service):
+        """
+        Initialize HTTP server
+
+        :param server_address: tuple of (host, port)
+        :param service: QaService object
+        """
+
+        HTTPServer.__init__(self, server_address, QaRequestHandler)
+        self.service = service
+
+
+class QaRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles Qa requests:
+
+    POST /qa[?summary=true&validate_metadata=true&file_path=<path>]
+        request body is the extended CSV file content
+    GET /health
+    """
+
+    server_version = 'woudc-qa/%s' % __version__
+
+    def do_GET(self):
+        """handle GET requests"""
+
+        path = urlparse.urlparse(self.path).path
+        if path == '/health':
+            self._send_json(200, json.dumps(self.server.service.status()))
+        else:
+            self._send_error(404, 'Not found: %s' % path)
+
+    def do_POST(self):
+        """handle POST requests"""
+
+        parsed = urlparse.urlparse(self.path)
+        if parsed.path != '/qa':
+            self._send_error(404, 'Not found: %s' % parsed.path)
+            return
+        params = urlparse.parse_qs(parsed.query)
+
+        try:
+            length = int(self.headers.getheader('content-length'))
+        except (TypeError, ValueError):
+            self._send_error(411, 'Content-Length required')
+            return
+        if length > MAX_CONTENT_LENGTH:
+            self._send_error(413, 'File too large: %s bytes' % length)
+            return
+        content = self.rfile.read(length)
+
+        try:
+            status, body = self.server.service.check(
+                content,
+                params.get('file_path', [None])[0],
+                _to_bool(params.get('summary', ['false'])[0]),
+                _to_bool(params.get('validate_metadata', ['false'])[0]))
+        except WOUDCQaServiceBusyError as err:
+            self._send_error(503, str(err), {'Retry-After': '1'})
+            return
+        except multiprocessing.TimeoutError:
+            self._send_error(504, 'Qa timed out')
+            return
+        except Exception as err:
+            msg = 'Unable to run Qa. Due to: %s' % str(err)
+            LOGGER.error(msg)
+            self._send_error(500, msg)
+            return
+
+        self._send_json(status, body)
+
+    def log_message(self, format, *args):
+        """log requests through the package logger"""
+
+        LOGGER.info('%s - %s' % (self.address_string(), format % args))
+
+    def _send_error(self, status, message, headers=None):
+        """
+        helper method: send a JSON error response
+        """
+
+        body = json.dumps({'status': 'error', 'message': message})
+        self._send_json(status, body, headers)
+
+    def _send_json(self, status, body, headers=None):
+        """
+        helper method: send a JSON response
+        """
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host='localhost', port=8000, rule_path=None, workers=None,
+          queue_size=None, timeout=60, reload_interval=None, budget=None):
+    """
+    Run the Qa service until interrupted
+
+    :param host: host to bind to
+    :param port: port to listen on
+    :param rule_path: path to qa rule definitions (optional)
+    :param workers: number of worker processes (default: cpu count)
+    :param queue_size: requests allowed to wait for a worker
+    :param timeout: seconds to wait for a result before giving up
+    :param reload_interval: seconds between checks of the rule
+        definitions for changes (default: no hot reload)
+    :param budget: QaBudget of each request (optional)
+    """
+
+    service = QaService(rule_path, workers, queue_size, timeout,
+                        reload_interval, budget)
+    server = QaHTTPServer((host, port), service)
+    LOGGER.info('Serving woudc-qa on %s:%s with %s workers' %
+                (host, server.server_address[1], service.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        LOGGER.info('Shutting down')
+    finally:
+        server.server_close()
+        service.close()
+
+
+def _init_worker(checker, budget=None):
+    """
+    helper function: keep the compiled rule set in the worker
+    """
+
+    global _CHECKER, _BUDGET
+    # leave interrupt handling to the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _CHECKER = checker
+    _BUDGET = budget
+
+
+def _check(content, file_path, summary, validate_metadata):
+    """
+    helper function: quality assess file content in a worker process
+
+    :returns: tuple of HTTP status code, JSON response body and whether
+        the budget was exceeded
+    """
+
+    status = 200
+    exceeded = False
+    if _BUDGET is not None:
+        _BUDGET.start(hard_limit=True)
+    try:
+        result = qa(content, file_path=file_path, summary=summary,
+                    validate_metadata=validate_metadata, checker=_CHECKER,
+                    budget=_BUDGET)
+        if summary:
+            body = {'status': 'passed', 'message': result, 'errors': []}
+        else:
+            body = {'status': 'ok', 'results': result}
+    except WOUDCQaValidationError as err:
+        body = {'status': 'failed', 'message': str(err),
+                'errors': err.errors}
+    except WOUDCQaBudgetExceeded as err:
+        # results so far, if checks started
+        status = 422
+        exceeded = True
+        body = {'status': 'exceeded', 'message': str(err)}
+        if summary:
+            body['errors'] = []
+            if err.qa_result is not None:
+                body['errors'] = format_violations(
+                    err.qa_result.violations())
+        else:
+            body['results'] = {}
+            if err.qa_result is not None:
+                body['results'] = err.qa_result.qa_results
+    except WOUDCQaNotImplementedError as err:
+        status = 501
+        body = {'status': 'error', 'message': str(err)}
+    except woudc_extcsv.ExtCSVValidatorException as err:
+        status = 422
+        body = {'status': 'error', 'message': str(err)}
+    except woudc_extcsv.WOUDCExtCSVReaderError as err:
+        status = 400
+        body = {'status': 'error',
+                'message': 'Unable to parse file. Due to: %s' % str(err)}
+    except Exception as err:
+        status = 500
+        body = {'status': 'error', 'message': str(err)}
+    finally:
+        if _BUDGET is not None:
+            _BUDGET.stop()
+
+    body['rule_set'] = _CHECKER.fingerprint
+    # serialize in the worker to keep the HTTP front end light
+    try:
+        return status, json.dumps(body), exceeded
+    except UnicodeDecodeError as err:
+        # e.g. a file_path that is not UTF-8
+        status = 400
+        msg = 'Unable to serialize Qa results. Due to: %s' % str(err)
+    except Exception as err:
+        status = 500
+        msg = 'Unable to serialize Qa results. Due to: %s' % str(err)
+    LOGGER.error(msg)
+    body = {'status': 'error', 'message': msg,
+            'rule_set': _CHECKER.fingerprint}
+    return status, json.dumps(body), exceeded
+
+
+def _to_bool(value):
+    """
+    helper function: parse a boolean query parameter
+    """
+
+    return value.lower() in ['1', 'true', 'yes']
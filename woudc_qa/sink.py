@@ -0,0 +1,492 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+# SQLite Qa result sink
+
+import logging
+import sqlite3
+
+from woudc_qa.util import FAIL, is_precondition, is_summarized
+
+LOGGER = logging.getLogger(__name__)
+
+# (table, field) metadata stored per file
+METADATA = [
+    ('PLATFORM', 'ID'),
+    ('PLATFORM', 'Name'),
+    ('DATA_GENERATION', 'Agency'),
+    ('INSTRUMENT', 'Name'),
+    ('INSTRUMENT', 'Model'),
+    ('INSTRUMENT', 'Number'),
+    ('TIMESTAMP', 'Date')
+]
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY,
+        file_path TEXT NOT NULL UNIQUE,
+        dataset TEXT,
+        station TEXT,
+        station_name TEXT,
+        agency TEXT,
+        instrument TEXT,
+        instrument_model TEXT,
+        instrument_number TEXT,
+        date TEXT,
+        rule_set TEXT,
+        status TEXT NOT NULL,
+        failed_rows INTEGER NOT NULL DEFAULT 0,
+        message TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS tests (
+        file_id INTEGER NOT NULL,
+        test_id TEXT NOT NULL,
+        table_name TEXT,
+        table_index TEXT,
+        element TEXT,
+        rows INTEGER NOT NULL,
+        failed INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS row_ranges (
+        file_id INTEGER NOT NULL,
+        test_id TEXT NOT NULL,
+        row_start INTEGER NOT NULL,
+        row_end INTEGER NOT NULL,
+        result TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS runs (
+        shard INTEGER NOT NULL,
+        shard_count INTEGER NOT NULL,
+        rule_set TEXT,
+        paths TEXT,
+        host TEXT,
+        started TEXT,
+        finished TEXT,
+        files INTEGER NOT NULL,
+        checked INTEGER NOT NULL,
+        complete INTEGER NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_files_dataset ON files (dataset)',
+    'CREATE INDEX IF NOT EXISTS idx_files_station ON files (station)',
+    '''CREATE INDEX IF NOT EXISTS idx_files_station_name
+        ON files (station_name COLLATE NOCASE)''',
+    '''CREATE INDEX IF NOT EXISTS idx_files_instrument
+        ON files (instrument COLLATE NOCASE)''',
+    'CREATE INDEX IF NOT EXISTS idx_files_date ON files (date)',
+    'CREATE INDEX IF NOT EXISTS idx_tests_test_id ON tests (test_id, failed)',
+    'CREATE INDEX IF NOT EXISTS idx_tests_file_id ON tests (file_id)',
+    '''CREATE INDEX IF NOT EXISTS idx_row_ranges_file_id
+        ON row_ranges (file_id, test_id)'''
+]
+
+# columns of the runs table
+RUN_COLUMNS = ['shard', 'shard_count', 'rule_set', 'paths', 'host',
+               'started', 'finished', 'files', 'checked', 'complete']
+
+
+class SQLiteResultSink(object):
+    """
+    Bulk-inserts Qa results into a local SQLite database: one row per
+    file, one row per test and one row per range of consecutive rows
+    sharing the same test result, plus one row per batch run describing
+    it (shard, rule set, paths, host, times, files).  Results are
+    buffered and written in batched transactions.  A file quality
+    assessed again replaces its previous results.  One writer per
+    database.
+    """
+
+    def __init__(self, db_path, batch_size=1000):
+        """
+        Open (and create if needed) a result database
+
+        :param db_path: path to SQLite database
+        :param batch_size: number of files buffered per transaction
+        """
+
+        self._db_path = db_path
+        self._batch_size = batch_size
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+        self._next_id = self._conn.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM files').fetchone()[0] + 1
+        self._files = []
+        self._tests = []
+        self._ranges = []
+        self._runs = []
+
+    @property
+    def db_path(self):
+        """
+        :returns: path to SQLite database
+        """
+
+        return self._db_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, file_path, status, qa_result=None, message=None):
+        """
+        Buffer the results of one file
+
+        :param file_path: path to file
+        :param status: passed, failed or error
+        :param qa_result: QaResult object (optional, e.g. on error)
+        :param message: additional information (optional)
+        """
+
+        file_id = self._next_id
+        self._next_id += 1
+
+        metadata = [None] * 8
+        failed_rows = 0
+        if qa_result is not None:
+            metadata = [qa_result.dataset]
+            for table, field in METADATA:
+                try:
+                    metadata.append(qa_result.get_metadata(table, field))
+                except Exception:
+                    metadata.append(None)
+            for test_id, test_def, results in qa_result.test_results():
+                failed = self._add_test(file_id, test_id, test_def, results)
+                # failed rows are those of the file's violations
+                if not is_precondition(test_id) and is_summarized(test_def):
+                    failed_rows += failed
+
+        self._files.append(
+            [file_id, file_path] + metadata +
+            [getattr(qa_result, 'fingerprint', None), status, failed_rows,
+             message])
+
+        if len(self._files) >= self._batch_size:
+            self.flush()
+
+    def add_run(self, run):
+        """
+        Buffer the description of a batch run
+
+        :param run: dict of RUN_COLUMNS values
+        """
+
+        self._runs.append([run[column] for column in RUN_COLUMNS])
+
+    def flush(self):
+        """
+        Write buffered results in one transaction
+        """
+
+        if not self._files and not self._runs:
+            return
+        # a file added again since the last flush keeps its last results
+        latest = dict((f[1], f[0]) for f in self._files)
+        if len(latest) < len(self._files):
+            file_ids = set(latest.values())
+            self._files = [f for f in self._files if f[0] in file_ids]
+            self._tests = [t for t in self._tests if t[0] in file_ids]
+            self._ranges = [r for r in self._ranges if r[0] in file_ids]
+        with self._conn:
+            paths = [(f[1],) for f in self._files]
+            for table in ['tests', 'row_ranges']:
+                self._conn.executemany(
+                    'DELETE FROM %s WHERE file_id = '
+                    '(SELECT id FROM files WHERE file_path = ?)' % table,
+                    paths)
+            self._conn.executemany('DELETE FROM files WHERE file_path = ?',
+                                   paths)
+            self._conn.executemany(
+                'INSERT INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                self._files)
+            self._conn.executemany('INSERT INTO tests VALUES (?,?,?,?,?,?,?)',
+                                   self._tests)
+            self._conn.executemany(
+                'INSERT INTO row_ranges VALUES (?,?,?,?,?)', self._ranges)
+            self._conn.executemany(
+                'INSERT INTO runs VALUES (?,?,?,?,?,?,?,?,?,?)', self._runs)
+        LOGGER.debug('Wrote results of %s files to %s' %
+                     (len(self._files), self._db_path))
+        self._files = []
+        self._tests = []
+        self._ranges = []
+        self._runs = []
+
+    def merge(self, db_path):
+        """
+        Merge the results and runs of another result database (e.g. the
+        partial results of a shard) into this one.  Results of files
+        already present are replaced.
+
+        :param db_path: path to SQLite result database
+        """
+
+        self.flush()
+        self._conn.execute('ATTACH DATABASE ? AS other', (db_path,))
+        try:
+            with self._conn:
+                paths = 'SELECT file_path FROM other.files'
+                for table in ['tests', 'row_ranges']:
+                    self._conn.execute(
+                        'DELETE FROM %s WHERE file_id IN (SELECT id FROM '
+                        'files WHERE file_path IN (%s))' % (table, paths))
+                self._conn.execute(
+                    'DELETE FROM files WHERE file_path IN (%s)' % paths)
+                # file ids of the other database, shifted past ours
+                offset = self._next_id - 1
+                self._conn.execute(
+                    'INSERT INTO files SELECT id + ?, file_path, dataset, '
+                    'station, station_name, agency, instrument, '
+                    'instrument_model, instrument_number, date, rule_set, '
+                    'status, failed_rows, message FROM other.files',
+                    (offset,))
+                self._conn.execute(
+                    'INSERT INTO tests SELECT file_id + ?, test_id, '
+                    'table_name, table_index, element, rows, failed '
+                    'FROM other.tests', (offset,))
+                self._conn.execute(
+                    'INSERT INTO row_ranges SELECT file_id + ?, test_id, '
+                    'row_start, row_end, result FROM other.row_ranges',
+                    (offset,))
+                if self._conn.execute(
+                        'SELECT COUNT(*) FROM other.sqlite_master '
+                        'WHERE name = \'runs\'').fetchone()[0]:
+                    self._conn.execute(
+                        'INSERT INTO runs SELECT %s FROM other.runs' %
+                        ', '.join(RUN_COLUMNS))
+        finally:
+            self._conn.execute('DETACH DATABASE other')
+        self._next_id = self._conn.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM files').fetchone()[0] + 1
+        LOGGER.debug('Merged %s into %s' % (db_path, self._db_path))
+
+    def runs(self):
+        """
+        Query the batch runs that produced the stored results
+
+        :returns: list of dicts, one per run, by shard and start time
+        """
+
+        self.flush()
+        return [dict(zip(RUN_COLUMNS, row)) for row in self._conn.execute(
+            'SELECT %s FROM runs ORDER BY shard, started' %
+            ', '.join(RUN_COLUMNS))]
+
+    def totals(self):
+        """
+        Count stored files by dataset and status
+
+        :returns: list of dicts of dataset, status, files and failed_rows
+        """
+
+        columns = ['dataset', 'status', 'files', 'failed_rows']
+        self.flush()
+        return [dict(zip(columns, row)) for row in self._conn.execute(
+            'SELECT dataset, status, COUNT(*), SUM(failed_rows) FROM files '
+            'GROUP BY dataset, status ORDER BY dataset, status')]
+
+    def close(self):
+        """
+        Flush buffered results and close the database
+        """
+
+        self.flush()
+        self._conn.close()
+
+    def query(self, dataset=None, station=None, instrument=None,
+              date_from=None, date_to=None, failed_test=None, status=None):
+        """
+        Query file results
+
+        :param dataset: dataset (e.g. ozonesonde)
+        :param station: station id (e.g. 043) or name (e.g. Lerwick)
+        :param instrument: instrument name (e.g. ECC)
+        :param date_from: earliest observation date (YYYY-MM-DD)
+        :param date_to: latest observation date (YYYY-MM-DD)
+        :param failed_test: only files failing this test_id
+        :param status: file status (passed, failed or error)
+        :returns: list of dicts, one per file
+        """
+
+        columns = ['file_path', 'dataset', 'station', 'station_name',
+                   'instrument', 'date', 'status', 'failed_rows', 'rule_set']
+        sql = 'SELECT %s FROM files f' % \
+            ', '.join(['f.%s' % c for c in columns])
+        where = []
+        args = []
+        if failed_test is not None:
+            columns.extend(['test_id', 'failed', 'rows'])
+            sql = sql.replace(' FROM files f', ', t.test_id, t.failed, '
+                              't.rows FROM files f JOIN tests t '
+                              'ON t.file_id = f.id')
+            where.append('t.test_id = ? AND t.failed > 0')
+            args.append(failed_test)
+        if dataset is not None:
+            where.append('f.dataset = ?')
+            args.append(dataset.lower())
+        if station is not None:
+            where.append('(f.station = ? OR '
+                         'f.station_name = ? COLLATE NOCASE)')
+            args.extend([station, station])
+        if instrument is not None:
+            where.append('f.instrument = ? COLLATE NOCASE')
+            args.append(instrument)
+        if date_from is not None:
+            where.append('f.date >= ?')
+            args.append(date_from)
+        if date_to is not None:
+            where.append('f.date <= ?')
+            args.append(date_to)
+        if status is not None:
+            where.append('f.status = ?')
+            args.append(status)
+        if where:
+            sql = '%s WHERE %s' % (sql, ' AND '.join(where))
+        sql = '%s ORDER BY f.date, f.file_path' % sql
+
+        self.flush()
+        return [dict(zip(columns, row))
+                for row in self._conn.execute(sql, args)]
+
+    def row_ranges(self, file_path, test_id=None):
+        """
+        Query row range results of a file
+
+        :param file_path: path to file
+        :param test_id: only ranges of this test_id (optional)
+        :returns: list of dicts, one per row range
+        """
+
+        columns = ['test_id', 'row_start', 'row_end', 'result']
+        sql = 'SELECT r.test_id, r.row_start, r.row_end, r.result ' \
+            'FROM row_ranges r JOIN files f ON r.file_id = f.id ' \
+            'WHERE f.file_path = ?'
+        args = [file_path]
+        if test_id is not None:
+            sql = '%s AND r.test_id = ?' % sql
+            args.append(test_id)
+        sql = '%s ORDER BY r.rowid' % sql
+
+        self.flush()
+        return [dict(zip(columns, row))
+                for row in self._conn.execute(sql, args)]
+
+    def _add_test(self, file_id, test_id, test_def, results):
+        """
+        helper method: buffer per-test and row range results
+
+        :param results: list of (row, result) sorted by row
+        :returns: number of failed rows
+        """
+
+        failed = 0
+        start = current = None
+        end = -1
+        for row, result in results:
+            if result is not None and not isinstance(result, basestring):
+                result = str(result)
+            if result == FAIL:
+                failed += 1
+            if row == end + 1 and result == current:
+                end = row
+                continue
+            if start is not None:
+                self._ranges.append((file_id, test_id, start, end, current))
+            start = end = row
+            current = result
+        if start is not None:
+            self._ranges.append((file_id, test_id, start, end, current))
+
+        self._tests.append((file_id, test_id, test_def['table'],
+                            str(test_def['table_index']),
+                            test_def['element'], len(results), failed))
+        return failed
+
+
+def merge_results(db_path, partial_paths):
+    """
+    Merge partial result databases (e.g. one per shard of a run) into
+    one, and check that they add up to a whole run
+
+    :param db_path: path to SQLite result database to merge into
+    :param partial_paths: list of paths to partial result databases
+    :returns: tuple of runs (list of dicts, the latest run per shard),
+        totals (see SQLiteResultSink.totals) and list of warnings
+    """
+
+    with SQLiteResultSink(db_path) as sink:
+        for partial_path in partial_paths:
+            sink.merge(partial_path)
+        latest = {}
+        for run in sink.runs():
+            latest[(run['shard_count'], run['shard'])] = run
+        runs = [latest[key] for key in sorted(latest)]
+        totals = sink.totals()
+
+    warnings = []
+    counts = sorted(set(run['shard_count'] for run in runs))
+    if len(counts) > 1:
+        warnings.append('Runs of different shard counts: %s' %
+                        ', '.join(map(str, counts)))
+    for count in counts:
+        missing = sorted(set(range(1, count + 1)) -
+                         set(run['shard'] for run in runs
+                             if run['shard_count'] == count))
+        if missing:
+            warnings.append('Missing shards of %s: %s' %
+                            (count, ', '.join(map(str, missing))))
+    for run in runs:
+        if not run['complete']:
+            warnings.append('Shard %s/%s incomplete: %s of %s files checked'
+                            % (run['shard'], run['shard_count'],
+                               run['checked'], run['files']))
+    if len(set(run['rule_set'] for run in runs)) > 1:
+        warnings.append('Shards used different rule sets')
+
+    return runs, totals, warnings
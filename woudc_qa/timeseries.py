@@ -0,0 +1,313 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+
+# Station time series across files
+#
+# Daily values (e.g. DAILY.ColumnO3 of totalozone files) arrive one file
+# per station and month, so day-to-day checks within a file miss the
+# jump between the last day of a file and the first day of the next.
+# TimeSeriesStore keeps a rolling window of the most recent days of each
+# series, by station (PLATFORM.ID), instrument (INSTRUMENT.Name and
+# Number) and column, as day number and value arrays. The time series
+# functions of a file are evaluated over the window of its series
+# followed by the file's own rows, and the store is updated with the
+# file once it is checked, so files are best checked in date order.
+# The store can be persisted as JSON between runs.
+
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from woudc_qa.util import get_extcsv_columns, get_extcsv_value, \
+    get_table_ranges
+
+LOGGER = logging.getLogger(__name__)
+
+# days of each series kept
+DEFAULT_WINDOW = 62
+
+# column holding the dates of a time series, unless function_parameter_c
+# names another
+DATE_FIELD = 'Date'
+
+# first day of the day numbers (days since)
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+class TimeSeriesStore(object):
+    """Rolling windows of recent daily values by station series."""
+
+    def __init__(self, path=None, window=DEFAULT_WINDOW):
+        """
+        Load the store
+
+        :param path: path to JSON store, loaded if it exists and written
+            by save (optional)
+        :param window: days kept of each series, counting back from its
+            latest day
+        """
+
+        self._path = path
+        self._window = window
+        # series key -> (int64 array of day numbers, float64 array of
+        # values), sorted by day
+        self._series = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as ff:
+                    for key, (days, values) in json.load(ff).iteritems():
+                        self._series[key] = (
+                            np.array(days, dtype=np.int64),
+                            np.array(values, dtype=np.float64))
+            except (IOError, ValueError, TypeError) as err:
+                msg = 'Unable to load time series store %s. Due to: %s' % (
+                    path, err)
+                LOGGER.warning(msg)
+
+    @property
+    def window(self):
+        """
+        :returns: days kept of each series
+        """
+
+        return self._window
+
+    def __len__(self):
+        return len(self._series)
+
+    def series(self, key):
+        """
+        Get the window of a series
+
+        :param key: series key (see series_key)
+        :returns: tuple of int64 array of day numbers and float64 array
+            of values, sorted by day (empty if the series is unknown)
+        """
+
+        return self._series.get(key, (np.zeros(0, dtype=np.int64),
+                                      np.zeros(0)))
+
+    def history(self, key, days):
+        """
+        Get the window of a series, less the days of a file
+
+        :param key: series key (see series_key)
+        :param days: int64 array of the day numbers of the file
+        :returns: tuple of day numbers and values, sorted by day, of the
+            days the file does not hold (a file checked again is not
+            checked against itself)
+        """
+
+        known, values = self.series(key)
+        kept = ~np.in1d(known, days)
+        return known[kept], values[kept]
+
+    def update(self, key, days, values):
+        """
+        Add the values of a file to a series, replacing the values of
+        the same days, and drop the days outside the window
+
+        :param key: series key (see series_key)
+        :param days: int64 array of day numbers
+        :param values: float64 array of values
+        """
+
+        if not len(days):
+            return
+        known, known_values = self.history(key, days)
+        days = np.concatenate([known, days])
+        values = np.concatenate([known_values, values])
+        order = np.argsort(days, kind='mergesort')
+        days, values = days[order], values[order]
+        kept = days > days[-1] - self._window
+        self._series[key] = (days[kept], values[kept])
+
+    def add_file(self, qa_result, rules):
+        """
+        Add the columns the time series checks of a file ran on, less
+        the rows a time series check failed on, so that later files are
+        not checked against outliers
+
+        :param qa_result: QaResult object
+        :param rules: compiled rules of the dataset
+        """
+
+        # imported on first use: woudc_qa.arrays evaluates time series
+        # checks through this module
+        from woudc_qa.arrays import CODE_FALSE
+
+        added = OrderedDict()
+        for rule in rules:
+            if not rule.status or rule.category != 'timeseries':
+                continue
+            a, b = get_table_ranges(qa_result.extcsv, rule.table,
+                                    rule.table_index)
+            for ti in range(a, b):
+                key = series_key(qa_result.extcsv, rule, ti)
+                if key is None:
+                    continue
+                if key not in added:
+                    series = file_series(qa_result, rule, ti)
+                    if series is None:
+                        continue
+                    added[key] = series
+                days, values, valid = added[key]
+                codes = qa_result.outcomes.get((rule.test_id, ti))
+                if codes is not None and len(codes) == len(valid):
+                    valid &= np.frombuffer(codes, np.uint8) != CODE_FALSE
+
+        for key, (days, values, valid) in added.iteritems():
+            self.update(key, days[valid], values[valid])
+
+    def save(self):
+        """
+        Write the store
+        """
+
+        if self._path is None:
+            return
+        try:
+            with open(self._path, 'w') as ff:
+                json.dump(dict(
+                    (key, (days.tolist(), values.tolist()))
+                    for key, (days, values) in self._series.iteritems()),
+                    ff, sort_keys=True)
+        except IOError as err:
+            msg = 'Unable to save time series store %s. Due to: %s' % (
+                self._path, err)
+            LOGGER.warning(msg)
+
+
+def series_key(extcsv, rule, table_index):
+    """
+    Get the key of the series a time series check runs on
+
+    :param extcsv: woudc_extcsv Reader object
+    :param rule: QaRule of the test
+    :param table_index: table index
+    :returns: key as station|instrument|number|table|element, or None if
+        the station or instrument is not known
+    """
+
+    station = get_extcsv_value(extcsv, 'PLATFORM', 'ID')
+    instrument = get_extcsv_value(extcsv, 'INSTRUMENT', 'Name')
+    number = get_extcsv_value(extcsv, 'INSTRUMENT', 'Number')
+    if station in [None, ''] or instrument in [None, '']:
+        return None
+    table = rule.table
+    if table_index > 1:
+        table = '%s%s' % (table, table_index)
+    return '|'.join([station, instrument, number or '', table,
+                     rule.element])
+
+
+def date_field_of(rule):
+    """
+    :param rule: QaRule of a time series check
+    :returns: column holding the dates of the series
+    """
+
+    if isinstance(rule.param_c, basestring) and rule.param_c != '':
+        return rule.param_c
+    return DATE_FIELD
+
+
+def file_series(qa_result, rule, table_index):
+    """
+    Get the series of a file a time series check runs on
+
+    :param qa_result: QaResult object
+    :param rule: QaRule of the test
+    :param table_index: table index
+    :returns: tuple of int64 array of day numbers, float64 array of
+        values and boolean array of which rows have both a date and a
+        number, or None if the table or its dates are not found
+    """
+
+    column = qa_result.arrays.column(rule.table, table_index, rule.element)
+    date_field = date_field_of(rule)
+    dates = get_extcsv_columns(qa_result.extcsv, rule.table, [date_field],
+                               table_index)
+    if column is None or dates is None or \
+            len(dates[date_field]) != len(column[0]):
+        return None
+    days, dated = parse_dates(dates[date_field])
+    return days, column[0], column[1] & dated
+
+
+def parse_dates(values):
+    """
+    Parse dates into day numbers
+
+    :param values: list of dates (YYYY-MM-DD) as found in the file
+    :returns: tuple of int64 array of days since 1970-01-01 (0 where not
+        a date) and boolean array of which values are dates
+    """
+
+    try:
+        dates = np.array(values, dtype='datetime64[D]')
+        # empty values parse as NaT
+        valid = ~np.isnat(dates)
+        days = np.where(valid, (dates - EPOCH).astype(np.int64), 0)
+        return days, valid
+    except (TypeError, ValueError):
+        pass
+
+    # some values are not dates: parse one by one
+    days = np.zeros(len(values), dtype=np.int64)
+    valid = np.zeros(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            date = np.datetime64(value, 'D')
+        except (TypeError, ValueError):
+            continue
+        if not np.isnat(date):
+            days[i] = (date - EPOCH).astype(np.int64)
+            valid[i] = True
+    return days, valid
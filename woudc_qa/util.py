@@ -47,10 +47,25 @@
 
 import logging
 import csv
+import os
+import sys
+from collections import namedtuple
 from StringIO import StringIO
 
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
 LOGGER = logging.getLogger(__name__)
 
+FAIL = '0'
+
+# consecutive failed rows of one test
+Violation = namedtuple('Violation', [
+    'test_id', 'table', 'table_index', 'element', 'row_start', 'row_end',
+    'count', 'message'])
+
 
 def get_extcsv_value(extcsv, table, field, table_index=1, raw=False,
                      payload=False):
@@ -107,6 +122,40 @@ def get_extcsv_value(extcsv, table, field, table_index=1, raw=False,
         return value
 
 
+def get_extcsv_columns(extcsv, table, fields, table_index=1):
+    """
+    get payload columns from extcsv in one pass
+
+    :param extcsv: woudc_extcsv.Reader object
+    :param table: table to retrieve data from
+    :param fields: fields to retrieve data from
+    :param table_index: index of table
+    :returns: dict of field to list of values (as get_extcsv_value with
+        payload=True), or None if the table is not found
+    """
+
+    if table_index > 1:
+        table = '%s%s' % (table, table_index)
+
+    if table not in extcsv.sections:
+        return None
+
+    data_rows = csv.reader(StringIO(extcsv.sections[table]['_raw']))
+    header = data_rows.next()
+    columns = dict((field, []) for field in fields)
+    positions = [(columns[field], header.index(field)) for field in fields
+                 if field in header]
+    for row in data_rows:
+        length = len(row)
+        for column, position in positions:
+            if position < length:
+                column.append(row[position])
+            else:
+                column.append('')
+
+    return columns
+
+
 def set_extcsv_value(extcsv, table, field, value, table_index=1,
                      mode='update'):
     """
@@ -141,39 +190,33 @@ def set_extcsv_value(extcsv, table, field, value, table_index=1,
             LOGGER.error(msg)
             raise err(msg)
 
-        new_rows = []
+        # write updated profile row by row, without holding all rows
+        new_payload = StringIO()
+        csv_writer = csv.writer(new_payload)
         rows = csv.reader(body)
         fields = rows.next()
         if mode == 'add':
             fields.append(field)
-            row_count = 0
-            for row in rows:
+        else:
+            field_index = fields.index(field)
+        csv_writer.writerow(fields)
+        row_count = 0
+        for row in rows:
+            if mode == 'add':
                 try:
                     row.append(value[row_count])
                 except IndexError:
                     row.append(None)
-                    pass
-                new_rows.append(row)
-                row_count += 1
-        else:
-            field_index = fields.index(field)
-            row_count = 0
-            for row in rows:
+            else:
                 row[field_index] = value[row_count]
-                new_rows.append(row)
-                row_count += 1
-
-        # write updated profile
-        new_payload = StringIO()
-        csv_writer = csv.writer(new_payload)
-        csv_writer.writerow(fields)
-        for row in new_rows:
+            row_count += 1
             try:
                 csv_writer.writerow(row)
             except Exception as err:
                 msg = 'Unable to write row to payload. Due to: %s' % (str(err))
                 LOGGER.error(msg)
                 continue
+        body.close()
         value = new_payload.getvalue()
         new_payload.close()
         set_extcsv_value(extcsv, table, '_raw', value)
@@ -181,6 +224,29 @@ def set_extcsv_value(extcsv, table, field, value, table_index=1,
     return extcsv
 
 
+def is_precondition(test_id):
+    """
+    whether a test is a pre-condition of others (e.g. 25P): its failures
+    are not violations of the file
+
+    :param test_id: test id
+    :returns: `bool` of whether the test is a pre-condition test
+    """
+
+    return 'P' in test_id
+
+
+def is_summarized(test_def):
+    """
+    whether failures of a test are summarized as violations of the file
+
+    :param test_def: test definition
+    :returns: `bool` of whether the test function has a summary message
+    """
+
+    return _build_summary_message(test_def) is not None
+
+
 def summarize(qa_result):
     """
     summarize qa result
@@ -189,82 +255,154 @@ def summarize(qa_result):
     :returns: list of summary strings of the form
     """
 
-    # iterate over test results by row:
-    v_id = 0
     violations = []
-    test_def = None
-    fail = '0'
-    error_type = 'error'
     for file, tests in qa_result.iteritems():
         for test_id, rows in tests.iteritems():
-            test_id = test_id
-            if 'P' not in test_id:  # skip pre-condition test results
-                test_def = rows['test_def']
-                for k, v in rows.iteritems():
-                    if k != 'test_def':
-                        row_num = k
-                        result = v['result']
-                        if result == fail:  # summary all failed qa
-                            ss = _build_summary_string(
-                                v_id,
-                                error_type,
-                                test_id,
-                                row_num,
-                                test_def)
-                            if ss is not None:
-                                violations.append(ss)
-                                v_id += 1
+            if not is_precondition(test_id):
+                results = sorted((row, value['result'])
+                                 for row, value in dict.iteritems(rows)
+                                 if row != 'test_def')
+                violations.extend(
+                    find_violations(test_id, rows['test_def'], results))
+
+    return format_violations(violations)
+
+
+def find_violations(test_id, test_def, results):
+    """
+    collapse failed rows of a test into violations, one per run of
+    consecutive failed rows
+
+    :param test_id: test id
+    :param test_def: test definition
+    :param results: list of (row, result) sorted by row
+    :returns: list of Violation objects
+    """
+
+    msg = _build_summary_message(test_def)
+    if msg is None:
+        return []
+
+    violations = []
+    start = end = None
+    for row, result in results:
+        if result == FAIL:
+            if start is not None and row == end + 1:
+                end = row
+                continue
+            if start is not None:
+                violations.append(_violation(test_id, test_def, start, end,
+                                             msg))
+            start = end = row
+        elif start is not None:
+            violations.append(_violation(test_id, test_def, start, end, msg))
+            start = end = None
+    if start is not None:
+        violations.append(_violation(test_id, test_def, start, end, msg))
 
     return violations
 
 
-def _build_summary_string(
-        violation_id,
-        error_type,
-        test_id,
-        row_number,
-        test_def):
+def format_violations(violations):
     """
-    build qa result summary message like so:
+    build qa result summary messages like so:
     [violation-id]-[error-type]-[test-id]-[table]\
-    -[table index]-[field]-[row number]-[message]
+    -[table index]-[field]-[row number(s)]-[message]
+
+    Row ranges are written as [first row]..[last row] followed by the
+    row count, e.g. 5..9 (5 rows).
+
+    :param violations: list of Violation objects
+    :returns: list of summary strings
+    """
+
+    summaries = []
+    for violation_id, violation in enumerate(violations):
+        if violation.count == 1:
+            rows = violation.row_start
+        else:
+            rows = '%s..%s' % (violation.row_start, violation.row_end)
+        summary = '%s-%s-%s-%s-%s-%s-%s-%s' % (
+            violation_id,
+            'error',
+            violation.test_id,
+            violation.table,
+            violation.table_index,
+            violation.element,
+            rows,
+            violation.message)
+        if violation.count > 1:
+            summary = '%s (%s rows)' % (summary, violation.count)
+        summaries.append(summary)
+
+    return summaries
+
+
+def _violation(test_id, test_def, row_start, row_end, msg):
+    """
+    helper function: build a Violation for a run of failed rows
+    """
+
+    return Violation(test_id, test_def['table'], test_def['table_index'],
+                     test_def['element'], row_start, row_end,
+                     row_end - row_start + 1, msg)
+
+
+def _build_summary_message(test_def):
+    """
+    build qa result summary message for a test definition
 
-    :returns: summary string
+    :returns: message, or None if the test function has no message
     """
     function = test_def['function']
     msg_stem = 'WOUDC data quality assessment failed.'
     messages = {
-        'RC_1': '%s Due to value = x outside the range:\
-a <= x <= b, where a=A, b=B' % msg_stem,
-        'RC_5': '%s Due to value is less then A' % msg_stem,
-        'RC_6': '%s Due to value is greater then A' % msg_stem,
+        'RC_1': 'Due to value = x outside the range:\
+a <= x <= b, where a={a}, b={b}',
+        'RC_5': 'Due to value is less then {a}',
+        'RC_6': 'Due to value is greater then {a}',
+        'RC_7': 'Due to value is greater then {a} times {c}',
+        'TS_3': 'Due to values not strictly increasing',
+        'CC_1': 'Due to value differing from the number of rows of {c} \
+by more than {a}',
+        'CC_2': 'Due to value differing from the minimum of {c} \
+by more than {a}',
+        'CC_3': 'Due to value differing from the maximum of {c} \
+by more than {a}',
+        'CC_4': 'Due to value differing from {c} by more than {a} of it',
+        'RC_8': 'Due to value differing from {c} by more than {a}',
+        'SC_1': 'Due to value more than {b} scaled MADs off the median \
+of {a} rows',
+        'SC_2': 'Due to value more than {b} standard deviations off the \
+mean of {a} rows',
+        'RC_9': 'Due to value more than {a} standard deviations off the \
+climatology {c}',
+        'RC_10': 'Due to value differing from the station reference \
+profile by more than {a} of it',
+        'TS_4': 'Due to values not strictly decreasing',
+        'TS_5': 'Due to values decreasing',
+        'TS_6': 'Due to values increasing',
+        'TS_7': 'Due to gradient per unit of {c} greater then {a}',
+        'TC_1': 'Due to value differing from the previous value of the \
+station series by more than {a}',
+        'TC_2': 'Due to value differing from the mean of the previous {b} \
+days of the station series by more than {a}',
+        'SN_1': 'Due to value differing from the median of all {table} \
+tables by more than {a}',
+        'SN_2': 'Due to spectrum not smooth: log curvature greater \
+than {a}',
+        'CC_5': 'Due to value differing from {c} by more than {a} of it \
+plus {b}',
     }
 
-    if function in messages.keys():
-        msg = messages[function]
-
-        msg = msg.replace('A', test_def['function_parameter_a'])
-        if function == 'RC_1':
-            msg = msg.replace('B', test_def['function_parameter_b'])
-    else:
-        # msg = msg_stem
+    if function not in messages:
         return None
 
-    table = test_def['table']
-    table_ix = test_def['table_index']
-    field = test_def['element']
-
-    summary = '%s-%s-%s-%s-%s-%s-%s-%s' % (
-        violation_id,
-        error_type,
-        test_id,
-        table,
-        table_ix,
-        field,
-        row_number,
-        msg)
-
-    return summary
+    msg = messages[function].format(
+        a=test_def['function_parameter_a'],
+        b=test_def['function_parameter_b'],
+        c=test_def['function_parameter_c'], table=test_def['table'])
+    return '%s %s' % (msg_stem, msg)
 
 
 def get_table_count(extcsv, table):
@@ -274,12 +412,37 @@ def get_table_count(extcsv, table):
     """
     count = 0
     for t in extcsv.sections.keys():
-        if table in t:
+        # TABLE, TABLE2, ... but not e.g. TABLE_SUMMARY
+        if t == table or \
+                (t.startswith(table) and t[len(table):].isdigit()):
             count += 1
 
     return count
 
 
+def get_table_instances(extcsv):
+    """
+    Index the table instances of extcsv in one pass over its sections
+
+    :param extcsv: woudc_extcsv.Reader object
+    :returns: dict of table to dict of table index to section name
+        (e.g. GLOBAL_SUMMARY -> 2 -> GLOBAL_SUMMARY2)
+    """
+
+    instances = {}
+    for section in extcsv.sections.keys():
+        table = section.rstrip('0123456789')
+        if table == section:
+            table_index = 1
+        elif table:
+            table_index = int(section[len(table):])
+        else:
+            continue
+        instances.setdefault(table, {})[table_index] = section
+
+    return instances
+
+
 def get_table_ranges(extcsv, table, table_index):
     """
     Determine range of tables to assess based on
@@ -295,3 +458,24 @@ def get_table_ranges(extcsv, table, table_index):
         b = table_index + 1
 
     return [a, b]
+
+
+def get_rss():
+    """
+    get resident memory of this process
+
+    :returns: resident memory (bytes), peak resident memory where the
+        current is not available, or None where neither is
+    """
+
+    try:
+        with open('/proc/self/statm') as ff:
+            return int(ff.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, IndexError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024  # kilobytes elsewhere
@@ -0,0 +1,159 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is covered under Crown Copyright, Government of
+# Canada, and is distributed under the MIT License.
+#
+# The Canada wordmark and related graphics associated with this
+# distribution are protected under trademark law and copyright law.
+# No permission is granted to use them outside the parameters of
+# the Government of Canada's corporate identity program. For
+# more information, see
+# http://www.tbs-sct.gc.ca/fip-pcim/index-eng.asp
+#
+# Copyright title to all 3rd party software distributed with this
+# software is held by the respective copyright holders as noted in
+# those files. Users are asked to read the 3rd Party Licenses
+# referenced with those assets.
+#
+# Copyright (c) 2016 Government of Canada
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+# Rule set hot reload
+
+import logging
+import os
+import threading
+import time
+
+from woudc_qa import QualityChecker
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RuleSetWatcher(threading.Thread):
+    """
+    Watches qa rule definitions and compiles new versions in the
+    background, handing each successfully compiled rule set to a
+    callback.  A rule set that fails to compile is logged and ignored,
+    leaving the current one in place.
+    """
+
+    def __init__(self, checker, on_reload, interval=5):
+        """
+        Initialize rule set watcher
+
+        :param checker: QualityChecker currently in use
+        :param on_reload: callable receiving each new QualityChecker
+        :param interval: seconds between checks of the rule definitions
+        """
+
+        threading.Thread.__init__(self, name='woudc-qa-rule-watcher')
+        self.daemon = True
+        self._rule_path = checker.rule_path
+        self._fingerprint = checker.fingerprint
+        self._on_reload = on_reload
+        self._interval = interval
+        self._stat = self._get_stat()
+        # changed modification time and size seen by the previous poll
+        self._pending = None
+        self._stopped = threading.Event()
+
+    @property
+    def fingerprint(self):
+        """
+        :returns: fingerprint of the latest compiled rule set
+        """
+
+        return self._fingerprint
+
+    def run(self):
+        """poll rule definitions until stopped"""
+
+        while not self._stopped.wait(self._interval):
+            try:
+                self.poll()
+            except Exception as err:
+                msg = 'Unable to reload rule set. Due to: %s' % str(err)
+                LOGGER.error(msg)
+
+    def stop(self):
+        """stop watching"""
+
+        self._stopped.set()
+
+    def poll(self):
+        """
+        Check rule definitions for changes, compiling and handing over
+        a new rule set if found.  A changed file is compiled once its
+        modification time and size are unchanged for two consecutive
+        polls, or its modification time is older than one interval, so
+        that a file still being written is not compiled.
+
+        :returns: new QualityChecker, or None if nothing changed
+        """
+
+        stat = self._get_stat()
+        if stat is None or stat == self._stat:
+            self._pending = None
+            return None
+        settled = stat == self._pending or \
+            time.time() - stat[0] >= self._interval
+        self._pending = stat
+        if not settled:
+            return None
+        self._stat = stat
+        self._pending = None
+
+        try:
+            checker = QualityChecker(self._rule_path)
+        except Exception as err:
+            msg = 'Keeping rule set %s. Unable to compile %s. Due to: %s' % \
+                (self._fingerprint, self._rule_path, str(err))
+            LOGGER.error(msg)
+            return None
+
+        if checker.fingerprint == self._fingerprint:
+            return None
+
+        LOGGER.info('Compiled rule set %s from %s' %
+                    (checker.fingerprint, self._rule_path))
+        self._fingerprint = checker.fingerprint
+        self._on_reload(checker)
+        return checker
+
+    def _get_stat(self):
+        """
+        helper method: rule definitions modification time and size,
+        or None while the file is unavailable (e.g. mid-save)
+        """
+
+        try:
+            stat = os.stat(self._rule_path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size